@@ -1,4 +1,6 @@
 from .main import main
 from . import sub
 
+__version__ = '0.1.0'
+
 __all__ = ['main', 'sub']
@@ -5,12 +5,28 @@ from __future__ import unicode_literals
 
 from . import base
 
-from . import help
-from . import commands
-from . import init
+__all__ = ['find', 'is_builtin']
 
-__all__ = ['find']
+# Built-in command names and the modules that implement them. Modules are only
+# imported when their command is run, so that running a user command does not
+# pay for loading all built-ins and their dependencies.
+BUILTINS = {
+    'help': 'help',
+    'commands': 'commands',
+    'init': 'init',
+    'daemon': 'daemon',
+    'completions': 'completions',
+    'zygote': 'zygote',
+    'run-many': 'runmany',
+    'catalog': 'catalog',
+}
+
+def is_builtin(name):
+    return name in BUILTINS
 
 def find(name):
+    module = BUILTINS.get(name)
+    if module is None:
+        return None
+    __import__(__name__ + '.' + module)
     return base.registry.get(name)
-
@@ -0,0 +1,52 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import json
+import sys
+
+from . import base
+
+
+def parse_args(argv):
+    """ Parse and validate command line arguments """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--format", choices=['ndjson', 'json'], default='ndjson')
+    parser.add_argument("--verify", action='store_true')
+    return parser.parse_args(argv)
+
+
+@base.built_in_command('catalog')
+class Catalog(base.BuiltInCommand):
+    """
+    Describe every command of the sub as JSON, one object per line
+    """
+
+    def __init__(self, args, paths):
+        super(Catalog, self).__init__(args, paths)
+
+    def __call__(self):
+        from subdue.sub import catalog
+        args = parse_args(self.args[1:])
+        commands = catalog.Catalog.load(self.paths.command_roots)
+
+        # Records are written as they are found, even as a single array
+        separator = '[\n' if args.format == 'json' else ''
+        for record in commands.walk(verify=args.verify):
+            for key in ('summary', 'usage'):
+                if record[key]:
+                    record[key] = self.expand(record[key], record['command'])
+            sys.stdout.write(separator + json.dumps(record, sort_keys=True))
+            if args.format == 'json':
+                separator = ',\n'
+            else:
+                sys.stdout.write('\n')
+        if args.format == 'json':
+            print('[]' if separator == '[\n' else '\n]')
+        commands.save()
+        return 0
+
+    def expand(self, text, tokens):
+        """ Expand the variables supported in documentation, as help does """
+        return text.replace('%COMMAND%', ' '.join([self.paths.name] + tokens))
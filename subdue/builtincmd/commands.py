@@ -3,32 +3,182 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from . import base
+import argparse
+import json
 import os
 
+
+def parse_args(argv):
+    """ Parse and validate command line arguments """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("container", nargs='*')
+    parser.add_argument("-r", "--recursive", action='store_true')
+    parser.add_argument("--json", action='store_true')
+    parser.add_argument("--sort", action='store_true')
+    return parser.parse_args(argv)
+
+
+def iter_entries(directories):
+    """
+    Generate (entry, kind, directory) for a container that is in the given
+    directories, one per command root that has it. A container in a single
+    root is listed as it is read; otherwise the listings are merged, see
+    index.merge_listings.
+    """
+    from subdue.sub import index as cmdindex
+    if len(directories) == 1:
+        for entry, kind in cmdindex.iter_dir(directories[0]):
+            yield entry, kind, directories[0]
+        return
+    listings = []
+    for directory in directories:
+        try:
+            listings.append(cmdindex.scan_dir(directory))
+        except OSError:
+            listings.append({})
+    entries, owners = cmdindex.merge_listings(listings)
+    for entry, kind in entries.items():
+        yield entry, kind, directories[owners[entry]]
+
+
+def container_directories(directories, tokens):
+    """
+    Return the directories of the container made of the given tokens, in the
+    given command roots, or an empty list if it is not a container.
+    """
+    from subdue.sub import index as cmdindex
+    for token in tokens:
+        # A command in a root hides containers with its name in later roots
+        if len(directories) > 1 and not any(
+                entry == token and kind == cmdindex.KIND_DIR
+                for entry, kind, _ in iter_entries(directories)):
+            return []
+        directories = [os.path.join(directory, token)
+                       for directory in directories
+                       if os.path.isdir(os.path.join(directory, token))]
+    return directories
+
+
+def iter_commands(directories, tokens=(), recursive=False, sort=False):
+    """
+    Generate (tokens, path, kind) for the commands in a container, given the
+    directories it is in, as they are found, with the kinds of the command
+    index. Eval commands are named without their sh- prefix and Python
+    function commands without their .py suffix. When recursive, the commands
+    in a container follow the container itself. When sorted, each container is
+    sorted by name. Entries that a command line never resolves to, like an
+    eval command next to a command of the same name, are left out, see
+    index.unique_commands.
+    """
+    from subdue.sub import index as cmdindex
+    commands = cmdindex.unique_commands(
+            (cmdindex.command_name(entry, kind), entry, kind, directory)
+            for entry, kind, directory in iter_entries(directories))
+    if sort:
+        commands = sorted(commands, key=lambda item: item[0])
+    for name, entry, kind, directory in commands:
+        entry_path = os.path.join(directory, entry)
+        entry_tokens = tokens + (name,)
+        yield entry_tokens, entry_path, kind
+        if recursive and kind == cmdindex.KIND_DIR:
+            entry_directories = [os.path.join(d, entry) for d in directories
+                                 if os.path.isdir(os.path.join(d, entry))]
+            for item in iter_commands(entry_directories, entry_tokens,
+                                      recursive, sort):
+                yield item
+
+
+def iter_index_commands(index, rel='', tokens=(), recursive=False, sort=False):
+    """
+    Generate (tokens, relative path, kind) for the commands in a container of
+    a command index, like iter_commands does for directories. Used for packed
+    subs, which have no directories to list.
+    """
+    from subdue.sub import index as cmdindex
+    entries = index.entries(rel) or {}
+    commands = cmdindex.unique_commands(
+            (cmdindex.command_name(entry, kind), entry, kind)
+            for entry, kind in entries.items())
+    if sort:
+        commands = sorted(commands, key=lambda item: item[0])
+    for name, entry, kind in commands:
+        entry_rel = cmdindex.join(rel, entry)
+        entry_tokens = tokens + (name,)
+        yield entry_tokens, entry_rel, kind
+        if recursive and kind == cmdindex.KIND_DIR:
+            for item in iter_index_commands(index, entry_rel, entry_tokens,
+                                            recursive, sort):
+                yield item
+
+
 @base.built_in_command('commands')
 class Commands(base.BuiltInCommand):
+    """
+    List the commands in the sub or in one of its containers
+    """
 
     def __init__(self, args, paths):
         super(Commands, self).__init__(args, paths)
 
     def __call__(self):
-        path = os.path.join(self.paths.commands, *self.args[1:])
-        if os.path.isdir(path):
-            commands = self.get_container_commands(path)
-            for command in commands:
-                print(command)
-            return 0
-        return 1
-
-    def get_container_commands(self, path):
-        commands = []
-        for path, dirs, files in os.walk(path):
-            commands += dirs
-            for f in files:
-                if os.access(os.path.join(path, f), os.X_OK):
-                    if f.startswith('sh-'):
-                        f = f[3:]
-                    commands.append(f)
-            break
-        return sorted(commands)
+        from subdue.sub import index as cmdindex
+        args = parse_args(self.args[1:])
+        # A plain listing of one container has always been sorted
+        sort = args.sort or not (args.recursive or args.json)
+        # JSON objects have all the words needed to run each command, text
+        # lines only those that follow the container
+        tokens = tuple(args.container) if args.json else ()
+        if any(cmdindex.is_archive(root) for root in self.paths.command_roots):
+            commands = self.iter_from_index(args, tokens, sort)
+        else:
+            roots = [root for root in self.paths.command_roots
+                     if os.path.isdir(root)]
+            directories = container_directories(roots, args.container)
+            commands = None
+            if directories:
+                commands = iter_commands(directories, tokens,
+                                         recursive=args.recursive, sort=sort)
+        if commands is None:
+            return 1
+
+        for tokens, command_path, kind in commands:
+            if args.json:
+                print(self.to_json(tokens, command_path, kind))
+            else:
+                print(' '.join(tokens))
+        return 0
+
+    def iter_from_index(self, args, tokens, sort):
+        """
+        Generate the commands of the container in the arguments from the
+        command index, as iter_commands does, or return None if it is not a
+        container. Paths are only looked up for JSON output. Those of entries
+        of packed subs are their paths in the archive, so that listing them
+        does not extract them.
+        """
+        from subdue.sub import index as cmdindex
+        index = cmdindex.load_index(self.paths.command_roots)
+        rel = ''
+        for token in args.container:
+            if (index.entries(rel) or {}).get(token) != cmdindex.KIND_DIR:
+                return None
+            rel = cmdindex.join(rel, token)
+        commands = iter_index_commands(index, rel, tokens,
+                                       recursive=args.recursive, sort=sort)
+        def path_for(rel):
+            member = index.member(rel)
+            if member is None:
+                return index.path_for(rel)
+            archive, name = member
+            return os.path.join(archive.path, *name.split('/'))
+        return ((tokens, path_for(entry_rel) if args.json else None, kind)
+                for tokens, entry_rel, kind in commands)
 
+    @staticmethod
+    def to_json(tokens, path, kind):
+        from subdue.sub import index as cmdindex
+        return json.dumps({
+            'command': list(tokens),
+            'path': path,
+            'kind': cmdindex.kind_name(os.path.basename(path), kind),
+            }, sort_keys=True)
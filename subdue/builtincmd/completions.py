@@ -0,0 +1,59 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from . import base
+
+
+def complete(index, words, builtins=()):
+    """
+    Return the sorted command names that complete the last of the given words,
+    in the container formed by all the previous ones. Eval commands are
+    completed without their sh- prefix, and Python function commands without
+    their .py suffix. The names in builtins are also completed at the top
+    level. Options are never completed, and are skipped among the previous
+    words.
+    """
+    from subdue.sub import index as cmdindex
+    words = list(words)
+    prefix = words.pop() if words else ''
+    if prefix.startswith('-'):
+        return []
+    words = [word for word in words if not word.startswith('-')]
+
+    rel = ''
+    for word in words:
+        entries = index.entries(rel)
+        if entries is None or entries.get(word) != cmdindex.KIND_DIR:
+            return []
+        rel = cmdindex.join(rel, word)
+
+    entries = index.entries(rel)
+    if entries is None:
+        return []
+    names = set()
+    for name, _, _ in cmdindex.container_commands(entries):
+        if name.startswith(prefix):
+            names.add(name)
+    if not rel:
+        names.update(name for name in builtins if name.startswith(prefix))
+    return sorted(names)
+
+
+@base.built_in_command('completions')
+class Completions(base.BuiltInCommand):
+    """
+    Print the possible completions for the last word in a command line
+    """
+
+    def __init__(self, args, paths):
+        super(Completions, self).__init__(args, paths)
+
+    def __call__(self):
+        from subdue.sub import index as cmdindex
+        from subdue import builtincmd
+        index = cmdindex.load_index(self.paths.command_roots)
+        for name in complete(index, self.args[1:], builtincmd.BUILTINS):
+            print(name)
+        index.save()
+        return 0
@@ -2,10 +2,174 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import sys
+
 from . import base
 
+UNDOCUMENTED = "This command isn't documented yet."
+
+
+def format_summaries(rows):
+    """
+    Format (name, summary, is container) rows as aligned lines, marking
+    containers with chevrons.
+    """
+    width = max(len(name) for name, _, _ in rows)
+    return ['   {0} {1}  {2}'.format('>>' if is_container else '  ',
+                                     name.ljust(width), summary or '--')
+            for name, summary, is_container in rows]
+
 
 @base.built_in_command('help')
 class Help(base.BuiltInCommand):
+    """
+    Show the available commands or the documentation of one of them
+    """
+
     def __init__(self, args, paths):
         super(Help, self).__init__(args, paths)
+
+    def __call__(self):
+        from subdue.sub import _main
+        from subdue.sub import headers
+        from subdue.sub import index as cmdindex
+        self.tokens = self.args[1:]
+        self.headers = headers.HeaderCache.load(self.paths.root)
+        self.index = cmdindex.load_index(self.paths.command_roots)
+
+        if not self.tokens:
+            lines = self.container_help('')
+        elif len(self.tokens) == 1 and self.builtin(self.tokens[0]):
+            lines = self.builtin_help(self.tokens[0])
+        else:
+            command = _main.find_command_path(
+                    self.tokens, self.paths, index=self.index)
+            if not command.found:
+                sys.exit(_main.not_found_message(
+                    self.paths, command.tokens, self.index))
+            self.tokens = command.tokens
+            if command.is_container:
+                lines = self.container_help('/'.join(command.tokens))
+            else:
+                lines = self.command_help(command.path)
+
+        self.headers.save()
+        self.index.save()
+        for line in lines:
+            print(line)
+        return 0
+
+    @staticmethod
+    def builtin(name):
+        from subdue import builtincmd
+        return builtincmd.find(name)
+
+    def expand(self, text, tokens=None):
+        """
+        Expand the variables supported in the documentation of the command
+        made of the given tokens, or of the one help was requested for.
+        """
+        if tokens is None:
+            tokens = self.tokens
+        command = ' '.join([self.paths.name] + tokens)
+        return text.replace('%COMMAND%', command)
+
+    def container_help(self, rel):
+        from subdue.sub import headers
+        from subdue.sub import index as cmdindex
+        doc = self.entry_help(cmdindex.join(rel, headers.DOC_FILE))
+        command = ' '.join([self.paths.name] + self.tokens)
+
+        lines = ['Usage: ' + self.expand(
+            doc['usage'] or command + ' <command> [<args>]'), '']
+        if rel:
+            # The help text of the sub is shown in all the help screens
+            root_doc = self.entry_help(headers.DOC_FILE)
+            texts = [root_doc['help'], doc['help']]
+        else:
+            texts = [doc['help']]
+        for text in texts:
+            if text:
+                lines += [self.expand(text), '']
+
+        commands = cmdindex.container_commands(self.index.entries(rel) or {})
+        entry_rels = []
+        for name, entry, kind in commands:
+            entry_rel = cmdindex.join(rel, entry)
+            if kind == cmdindex.KIND_DIR:
+                entry_rel = cmdindex.join(entry_rel, headers.DOC_FILE)
+            entry_rels.append(entry_rel)
+        rows = []
+        summaries = self.summaries(entry_rels)
+        for (name, _, kind), (summary, _) in zip(commands, summaries):
+            if summary:
+                summary = self.expand(summary, self.tokens + [name])
+            rows.append((name, summary, kind == cmdindex.KIND_DIR))
+        if rows:
+            lines.append("These are the available subcommands for {0}:".format(
+                command))
+            lines += format_summaries(rows)
+            lines.append('')
+            lines.append("See '{0} help {1}<command>' for information on "
+                         "a specific command.".format(
+                             self.paths.name,
+                             ''.join(token + ' ' for token in self.tokens)))
+        elif lines[-1] == '':
+            lines.pop()
+        return lines
+
+    def entry_help(self, rel):
+        """
+        Return all the headers of an entry of the index, see headers.read_help.
+        Entries of packed subs are read from the archive, not extracted.
+        """
+        from subdue.sub import headers
+        member = self.index.member(rel)
+        if member is None:
+            return headers.read_help(self.index.path_for(rel))
+        archive, name = member
+        if name not in archive.members:
+            return headers.parse_headers([])
+        return headers.parse_headers(
+                archive.read(name).decode('utf-8', 'replace').split('\n'))
+
+    def summaries(self, rels):
+        """
+        Return the (summary, usage) pairs of several entries of the index,
+        from the header cache for files, or from the archive for entries of
+        packed subs.
+        """
+        from subdue.sub import headers
+        packed = {}
+        paths = []
+        for rel in rels:
+            member = self.index.member(rel)
+            if member is None:
+                paths.append(self.index.path_for(rel))
+                continue
+            archive, name = member
+            lines = []
+            if name in archive.members:
+                lines = headers.prefix_lines(archive.read(name))
+            doc = headers.parse_headers(lines)
+            packed[rel] = doc['summary'], doc['usage']
+        summaries = iter(self.headers.summaries(paths))
+        return [packed[rel] if rel in packed else next(summaries)
+                for rel in rels]
+
+    def command_help(self, path):
+        from subdue.sub import headers
+        doc = headers.read_help(path)
+        if not doc['usage']:
+            return [UNDOCUMENTED]
+        lines = ['Usage: ' + self.expand(doc['usage'])]
+        text = doc['help'] or doc['summary']
+        if text:
+            lines += ['', self.expand(text)]
+        return lines
+
+    def builtin_help(self, name):
+        doc = (self.builtin(name).__doc__ or '').strip()
+        if not doc:
+            return [UNDOCUMENTED]
+        return ["{0} {1}: {2}".format(self.paths.name, name, doc)]
@@ -6,7 +6,10 @@ import argparse
 import pkgutil
 import string
 import os
+import re
 import sys
+import time
+import zlib
 
 from . import base
 
@@ -29,10 +32,89 @@ def guess_shell():
     return shell
 
 
+def shell_quote(value):
+    """
+    Quote a string so that a POSIX shell reads it as a single literal word
+    """
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def template_path(name):
+    """
+    Return the path of a template file, which may not exist if the package is
+    not installed as plain files.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'templates', name)
+
+
+def load_template(name):
+    """ Return the text of a template """
+    return pkgutil.get_data(TEMPLATES_PACKAGE, name).decode('utf-8')
+
+
+def template_hash(shell):
+    """
+    Return a hash of the templates the cached init output of a shell is made
+    from, as an hexadecimal string.
+    """
+    text = ''.join([load_template('init_full_{0}.tpl'.format(shell)),
+                    load_template('init_cached_{0}.tpl'.format(shell))])
+    return '{0:08x}'.format(zlib.crc32(text.encode('utf-8')) & 0xffffffff)
+
+
+def init_cache_path(driver, shell):
+    """
+    Return the path of the file where the full init output of a driver for a
+    shell is cached, or None if caching has been disabled. The path depends on
+    the version of subdue and on the templates too, so that upgrading either
+    never reuses an older output, whatever the modification times of the
+    installed files.
+    """
+    import subdue
+    from subdue.sub import cache
+    directory = cache.cache_dir()
+    if directory is None:
+        return None
+    key = '\0'.join([driver, shell, subdue.__version__,
+                     template_hash(shell)]).encode('utf-8')
+    return os.path.join(directory, 'init-{0:08x}.{1}'.format(
+        zlib.crc32(key) & 0xffffffff, shell))
+
+
+def make_dispatch_table(index):
+    """
+    Return the command table of a sub as a sorted list of (key, kind) tuples,
+    where key is the command tokens joined with '/' and kind is 'c' for
+    containers, 'x' for commands and 's' for eval commands, which are found by
+    adding the sh- prefix to the last token. Commands whose output may be
+    memoized are 'm', since only the driver can serve them from the cache.
+    """
+    from subdue.sub import index as cmdindex
+    table = {}
+    for rel, entries in index.walk():
+        for name, kind in entries.items():
+            key = cmdindex.join(rel, name)
+            if kind == cmdindex.KIND_DIR:
+                table[key] = 'c'
+            elif kind == cmdindex.KIND_EXEC:
+                memoized = index.declares_memo(key)
+                table[key] = 'm' if memoized else 'x'
+                if name.startswith('sh-') and len(name) > 3:
+                    # Containers and commands take precedence over the eval
+                    # command, as in find_command_path
+                    sh_key = cmdindex.join(rel, name[3:])
+                    if entries.get(name[3:]) not in (cmdindex.KIND_DIR,
+                                                     cmdindex.KIND_EXEC):
+                        table[sh_key] = 'm' if memoized else 's'
+    return sorted(table.items())
+
+
 def parse_args(argv):
     """ Parse and validate command line arguments """
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("--full", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--native", action='store_true', help=argparse.SUPPRESS)
     parser.add_argument("--shell", help=argparse.SUPPRESS)
     args = parser.parse_args(argv)
 
@@ -58,26 +140,141 @@ class Init(base.BuiltInCommand):
     def __call__(self):
         args = parse_args(self.args[1:])
         if args.full:
-            return self.do_full_mode(args.shell)
+            return self.do_full_mode(args.shell, args.native)
         self.do_simple_mode(args.shell)
 
     def do_simple_mode(self, shell):
+        """
+        Print the snippet to load the sub from a startup file. It sources the
+        cached output of the full mode when there is one, so that the driver
+        only runs when that output has to be generated again.
+        """
+        sub_bin = os.path.abspath(self.paths.calling_script)
+        load_command = 'eval "$({0} init --full --shell {1})"'.format(
+            shell_quote(sub_bin), shell)
+        cache_path = init_cache_path(sub_bin, shell)
+        if cache_path is not None:
+            load_command = 'source {0} 2>/dev/null || {1}'.format(
+                shell_quote(cache_path), load_command)
         simple_tpl_name = 'init_simple_{}.tpl'.format(shell)
-        print(self.eval_template(simple_tpl_name))
+        print(self.eval_template(simple_tpl_name, load_command=load_command))
 
-    def do_full_mode(self, shell):
+    def do_full_mode(self, shell, native=False):
         full_tpl_name = 'init_full_{}.tpl'.format(shell)
-        print(self.eval_template(full_tpl_name))
+        output = self.eval_template(full_tpl_name)
+        print(output)
+        if native:
+            self.do_native_mode(shell)
+        else:
+            # The native table is made for each shell, so it is never cached
+            self.write_init_cache(shell, output)
+
+    def write_init_cache(self, shell, output):
+        """
+        Store the output of the full mode in the cache, behind a check that
+        makes the shell generate it again when the driver, the templates or
+        subdue itself are newer than the cached copy. Other versions of subdue
+        or of the templates use another file, see init_cache_path.
+        """
+        import subdue
+        from subdue.sub import cache
+
+        sub_bin = os.path.abspath(self.paths.calling_script)
+        path = init_cache_path(sub_bin, shell)
+        if path is None:
+            return
+        full_tpl_name = 'init_full_{}.tpl'.format(shell)
+        cached_tpl_name = 'init_cached_{}.tpl'.format(shell)
+        sources = [sub_bin, template_path(full_tpl_name),
+                   template_path(cached_tpl_name), os.path.abspath(subdue.__file__)]
+        stale_test = ' ||\n      '.join('! -e {0} || {0} -nt {1}'.format(
+            shell_quote(source), shell_quote(path)) for source in sources)
+        header = self.eval_template(cached_tpl_name,
+                                    version=subdue.__version__,
+                                    template_hash=template_hash(shell),
+                                    stale_test=stale_test)
+        data = (header + output + '\n').encode('utf-8')
+
+        try:
+            with open(path, 'rb') as f:
+                unchanged = f.read() == data
+        except (IOError, OSError):
+            unchanged = False
+        if unchanged:
+            # Only the sources were touched, trust the cached copy again
+            try:
+                os.utime(path, None)
+                return
+            except OSError:
+                pass
+        cache.write_atomic(path, data)
+
+    def do_native_mode(self, shell):
+        """
+        Print the native dispatcher for the sub, with its command table built
+        in, along with the version stamp file that allows the dispatcher to
+        detect that the table is out of date.
+        """
+        from subdue.sub import cache
+        from subdue.sub import index as cmdindex
+
+        directory = cache.cache_dir()
+        if directory is None:
+            print("# Native dispatch is not available with caches disabled")
+            return
+        if self.paths.command_roots != [self.paths.commands]:
+            # The dispatcher only knows about the commands directory. Roots
+            # added to the environment later are checked by the dispatcher.
+            print("# Native dispatch is not available with several command roots")
+            return
+
+        # Anything modified after the table is generated must make it stale.
+        # Be conservative with filesystems that have a coarse time resolution.
+        generated = time.time() - cmdindex.RACY_WINDOW
+        index = cmdindex.open_index(self.paths.commands)
+        table = make_dispatch_table(index)
+        index.save()
+
+        lines = ''.join('    [{0}]={1}\n'.format(shell_quote(key), kind)
+                        for key, kind in table)
+        key = '\0'.join([self.paths.commands, lines]).encode('utf-8')
+        stamp = os.path.join(directory, 'native-{0:08x}.stamp'.format(
+            zlib.crc32(key) & 0xffffffff))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(stamp, 'a'):
+                pass
+            os.utime(stamp, (generated, generated))
+        except (IOError, OSError):
+            print("# Native dispatch is not available: cannot write {0}".format(stamp))
+            return
+
+        native_tpl_name = 'init_native_{}.tpl'.format(shell)
+        print(self.eval_template(native_tpl_name,
+                                 table=lines,
+                                 stamp_q=shell_quote(stamp)))
 
     def make_template_mapping(self):
+        from subdue.sub import _main
         return {
             'sub_name' : self.paths.name,
             'sub_bin' : os.path.abspath(self.paths.calling_script),
             'sub_bin_dir' : self.paths.bin,
+            'eval_marker' : _main.EVAL_MARKER,
+            'sub_ident' : re.sub(r'[^A-Za-z0-9_]', '_', self.paths.name),
+            'sub_name_q' : shell_quote(self.paths.name),
+            'sub_bin_q' : shell_quote(os.path.abspath(self.paths.calling_script)),
+            'root_q' : shell_quote(self.paths.root),
+            'bin_dir_q' : shell_quote(self.paths.bin),
+            'lib_q' : shell_quote(self.paths.lib),
+            'shared_q' : shell_quote(self.paths.shared),
+            'commands_q' : shell_quote(self.paths.commands),
+            'roots_var' : _main.command_roots_var(self.paths.name),
             }
 
     def eval_template(self, name, **kwargs):
-        tpl = pkgutil.get_data(TEMPLATES_PACKAGE, name)
+        tpl = load_template(name)
         mapping = self.make_template_mapping()
         return string.Template(tpl).safe_substitute(mapping, **kwargs)
 
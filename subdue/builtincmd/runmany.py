@@ -0,0 +1,223 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from . import base
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+PLACEHOLDER = '{}'
+""" Argument replaced with the item, instead of appending the item """
+
+PYTHON_BOOTSTRAP = (
+        "import sys; sys.path.insert(0, {0!r}); "
+        "from subdue.sub import pycommand; "
+        "sys.exit(pycommand.run_python_command(sys.argv[1:]))")
+"""
+Program run by a new interpreter for each item of a Python function command,
+since those normally run inside the driver process
+"""
+
+
+def default_jobs():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def parse_args(argv):
+    """
+    Parse and validate command line arguments. Items given after -- are
+    returned separately, or None when there is no --.
+    """
+    items = None
+    if '--' in argv:
+        position = argv.index('--')
+        argv, items = argv[:position], argv[position + 1:]
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("--group", action='store_true')
+    parser.add_argument("-q", "--quiet", action='store_true')
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    args.items = items
+    return args
+
+
+def read_items(stream):
+    """ Return the non empty lines of a stream, without line endings """
+    return [line.rstrip('\r\n') for line in stream if line.strip()]
+
+
+def command_line(args, item):
+    """
+    Return the command line for one item: the item replaces every {} argument
+    or, if there are none, is appended to the arguments.
+    """
+    if PLACEHOLDER not in args[1:]:
+        return args + [item]
+    return args[:1] + [item if arg == PLACEHOLDER else arg for arg in args[1:]]
+
+
+def exit_status(returncode):
+    """ Return the shell style exit status for a subprocess return code """
+    return 128 - returncode if returncode < 0 else returncode
+
+
+class Job(object):
+    """
+    One run of the command, for one item
+    """
+
+    def __init__(self, item, args):
+        self.item = item
+        self.args = args
+        self.status = None
+        self.elapsed = None
+
+
+class Output(object):
+    """
+    Write the output of concurrent jobs, one whole line at a time, each line
+    prefixed with the item of its job. When grouped, the output of each job
+    is instead written all at once, without prefixes, when the job finishes.
+    """
+
+    def __init__(self, group=False):
+        self.group = group
+        self.lock = threading.Lock()
+
+    def write(self, stream, text):
+        with self.lock:
+            stream.write(text)
+            stream.flush()
+
+    def run(self, job, env):
+        """ Run a job, writing its output. Return its exit status. """
+        proc = subprocess.Popen(job.args, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if self.group:
+            out, err = proc.communicate()
+            with self.lock:
+                for stream, data in ((sys.stdout, out), (sys.stderr, err)):
+                    stream.write(data.decode('utf-8', 'replace'))
+                    stream.flush()
+            return exit_status(proc.returncode)
+
+        prefix = '{0}\t'.format(job.item)
+        stderr_reader = threading.Thread(target=self.copy_lines,
+                args=(proc.stderr, sys.stderr, prefix))
+        stderr_reader.daemon = True
+        stderr_reader.start()
+        self.copy_lines(proc.stdout, sys.stdout, prefix)
+        stderr_reader.join()
+        return exit_status(proc.wait())
+
+    def copy_lines(self, pipe, stream, prefix):
+        for line in iter(pipe.readline, b''):
+            line = line.decode('utf-8', 'replace')
+            if not line.endswith('\n'):
+                line += '\n'
+            self.write(stream, prefix + line)
+        pipe.close()
+
+
+@base.built_in_command('run-many')
+class RunMany(base.BuiltInCommand):
+    """
+    Run a command once for each of many items, several at a time
+    """
+
+    def __init__(self, args, paths):
+        super(RunMany, self).__init__(args, paths)
+
+    def __call__(self):
+        from subdue.sub import headers
+        args = parse_args(self.args[1:])
+        if not args.command:
+            sys.exit("{0}: run-many needs a command".format(self.paths.name))
+        items = args.items
+        if items is None:
+            items = read_items(sys.stdin)
+
+        # The command is resolved only once for all items
+        command, env = self.resolve(args.command)
+        fixed_args = [command.path] + command.arguments
+        if command.is_python:
+            import subdue
+            subdue_path = os.path.dirname(os.path.dirname(
+                os.path.abspath(subdue.__file__)))
+            fixed_args = [sys.executable, '-c',
+                          PYTHON_BOOTSTRAP.format(subdue_path)] + fixed_args
+        jobs = [Job(item, command_line(fixed_args, item)) for item in items]
+
+        output = Output(group=args.group)
+
+        def run(job):
+            start = monotonic()
+            try:
+                job.status = output.run(job, env)
+            except OSError as e:
+                output.write(sys.stderr, '{0}\t{1}\n'.format(job.item, e))
+                job.status = 127
+            job.elapsed = monotonic() - start
+
+        start = monotonic()
+        headers.parallel_map(run, jobs, max(args.jobs or default_jobs(), 1))
+        elapsed = monotonic() - start
+
+        if not args.quiet:
+            for line in self.summary(command, jobs, elapsed):
+                sys.stderr.write(line + '\n')
+        return max([job.status for job in jobs] or [0])
+
+    def resolve(self, tokens):
+        """
+        Find the command to run and build its environment, as the driver
+        would. Return (command, environment).
+        """
+        from subdue.sub import _main
+        from subdue.sub import index as cmdindex
+        paths = self.paths
+        index = cmdindex.open_index(paths.command_roots)
+        command = _main.find_command_path(tokens, paths, index=index)
+        if not command.found:
+            sys.exit("{0}: no such command `{1}'".format(paths.name, command.command))
+        if command.is_container:
+            sys.exit("{0}: can't run a container `{1}'".format(paths.name, command.command))
+        if command.found_with_sh:
+            sys.exit("{0}: can't run an eval command `{1}' many times".format(
+                paths.name, command.command))
+
+        env = _main.Environment(paths)
+        env.shell = ''
+        env.prepend_to_path(paths.lib)
+        env.prepend_to_path(paths.bin)
+        env.command = command.command
+        env.path_command = command.path
+        return command, env.child_environment()
+
+    def summary(self, command, jobs, elapsed):
+        """ Return the lines of the timing summary """
+        name = '{0} {1}'.format(self.paths.name, command.command)
+        failed = [job for job in jobs if job.status != 0]
+        busy = sum(job.elapsed for job in jobs)
+        lines = ['{0}: {1} runs, {2} failed, {3:.3f}s elapsed, {4:.3f}s busy'.format(
+            name, len(jobs), len(failed), elapsed, busy)]
+        if jobs:
+            slowest = max(jobs, key=lambda job: job.elapsed)
+            lines.append('{0}: slowest {1:.3f}s ({2})'.format(
+                name, slowest.elapsed, slowest.item))
+        for job in failed:
+            lines.append('{0}: failed with status {1} ({2})'.format(
+                name, job.status, job.item))
+        return lines
@@ -0,0 +1,8 @@
+# Output of '${sub_name} init --full --shell bash', cached by subdue ${version}
+# (template ${template_hash}). It is only trusted while none of the files it was
+# made from is newer than it, otherwise it is generated again.
+if [[ ${stale_test} ]]; then
+    eval "$$(${sub_bin_q} init --full --shell bash)"
+    return 0
+fi
+
@@ -9,20 +9,33 @@ if ! [[ ":$$PATH:" == *":${sub_bin_dir}:"* ]]; then
     export PATH=${sub_bin_dir}:$$PATH
 fi
 
-# Wrapper to handle eval subcommands
+# Wrapper to handle eval subcommands. The driver is started only once: eval
+# commands write a marker line followed by their output to file descriptor 3,
+# which is captured here and evaluated, while any other command writes to the
+# original standard output, which is kept in file descriptor 4.
 function _subdue_${sub_name}_wrapper()
 {
-    local ret=0
-    if [[ -n $$1 ]] && command ${sub_name} --shell bash --is-eval "$$@"; then
-        eval "$$(command ${sub_name} --shell bash "$$@")"
+    local out ret
+    {
+        out=$$(command ${sub_name} --shell bash --eval-fd 3 "$$@" 3>&1 1>&4 4>&-)
         ret=$$?
-    else
-        command ${sub_name} --shell bash "$$@"
+    } 4>&1
+    if [[ $$out == "${eval_marker}"* ]]; then
+        eval "$$out"
         ret=$$?
     fi
     return $$ret
 }
 
+# Completion of command names at any container level. Anything after the
+# command itself falls back to the default bash completion.
+function _subdue_${sub_name}_complete()
+{
+    local IFS=$$'\n'
+    COMPREPLY=( $$(command ${sub_name} completions "$${COMP_WORDS[@]:1:COMP_CWORD}") )
+}
+complete -o default -F _subdue_${sub_name}_complete ${sub_name}
+
 # Use the wrapper by default
 alias ${sub_name}=_subdue_${sub_name}_wrapper
 
@@ -0,0 +1,60 @@
+
+# Native dispatch for '${sub_name}'. The table below describes all of its
+# commands, so that bash can run them directly without starting the driver:
+# c is a container, x a command and s an eval command (with the sh- prefix
+# added), while m is a command whose output may be memoized, which is left to
+# the driver. The table is only trusted while none of the containers involved is
+# newer than its version stamp file, and while no extra command roots are set
+# in ${roots_var}, otherwise the driver is used.
+declare -A _subdue_${sub_ident}_table=(
+${table})
+
+function _subdue_${sub_name}_native()
+{
+    local stamp=${stamp_q}
+    local dir=${commands_q} key='' kind='' token='' script=''
+    local -a args=("$$@")
+    local i=0 is_eval=0 ret=0 out='' IFS=' '
+    while (( i < $${#args[@]} )); do
+        token=$${args[i]}
+        if [[ -z $$token || $$token == -* || $$token == */* ]]; then
+            break
+        fi
+        if [[ -n $${${roots_var}:-} || ! -e $$stamp || $$dir -nt $$stamp ]]; then
+            break
+        fi
+        key=$${key:+$$key/}$$token
+        kind=$${_subdue_${sub_ident}_table[$$key]}
+        i=$$((i + 1))
+        case $$kind in
+            c) dir=$$dir/$$token; continue ;;
+            x) script=$$dir/$$token; is_eval=0 ;;
+            s) script=$$dir/sh-$$token; is_eval=1 ;;
+            *) break ;;
+        esac
+        local -a vars=(
+            _SUB_NAME_=${sub_name_q}
+            "_SUB_COMMAND_=$${args[*]:0:i}"
+            "_SUB_PATH_COMMAND_=$$script"
+            _SUB_PATH_ROOT_=${root_q}
+            _SUB_PATH_SHARED_=${shared_q}
+            _SUB_PATH_LIB_=${lib_q}
+            _SUB_IS_EVAL_=$$is_eval
+            _SUB_SHELL_=bash
+            PATH=${bin_dir_q}:${lib_q}:"$$PATH"
+        )
+        if (( is_eval )); then
+            out=$$(export "$${vars[@]}"; exec "$$script" "$${args[@]:i}")
+            eval "$$out"
+            ret=$$?
+        else
+            (export "$${vars[@]}"; exec "$$script" "$${args[@]:i}")
+            ret=$$?
+        fi
+        return $$ret
+    done
+    _subdue_${sub_name}_wrapper "$$@"
+}
+
+# Use the native dispatcher by default
+alias ${sub_name}=_subdue_${sub_name}_native
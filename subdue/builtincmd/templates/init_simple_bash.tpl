@@ -2,4 +2,4 @@
 # 
 # Load ${sub_name} automatically by adding the following to ~/.bash_profile
 
-eval "$$(${sub_bin} init --full --shell bash)"
+${load_command}
@@ -0,0 +1,75 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import os
+import sys
+
+from . import base
+
+
+def parse_args(argv):
+    """ Parse and validate command line arguments """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("action", choices=['start', 'stop', 'status'])
+    parser.add_argument("--idle-timeout", type=float, default=None)
+    parser.add_argument("--foreground", action='store_true')
+    return parser.parse_args(argv)
+
+
+@base.built_in_command('zygote')
+class Zygote(base.BuiltInCommand):
+    """
+    Manage the zygote that runs the Python scripts of the sub
+    """
+
+    def __init__(self, args, paths):
+        super(Zygote, self).__init__(args, paths)
+
+    def __call__(self):
+        from subdue.sub import zygote
+        from subdue.sub import daemon
+        args = parse_args(self.args[1:])
+
+        if args.action == 'status':
+            response = zygote.request(self.paths.root, {'op': 'ping'})
+            if response is None:
+                print("not running")
+                return 1
+            print("running (pid {0})".format(response['pid']))
+            for name in response['preloaded']:
+                print("preloaded: {0}".format(name))
+            for name in response['failed']:
+                print("failed to preload: {0}".format(name))
+            return 0
+
+        if args.action == 'stop':
+            if zygote.request(self.paths.root, {'op': 'stop'}) is None:
+                print("not running")
+                return 1
+            return 0
+
+        if not zygote.is_supported():
+            sys.exit("{0}: the zygote needs Python 3.3 or newer".format(
+                self.paths.name))
+        idle_timeout = args.idle_timeout
+        if idle_timeout is None:
+            idle_timeout = zygote.IDLE_TIMEOUT
+        server = zygote.Zygote(self.paths, idle_timeout)
+        try:
+            bound = server.bind()
+        except OSError as e:
+            sys.exit("{0}: cannot start the zygote: {1}".format(
+                self.paths.name, e.strerror or e))
+        if not bound:
+            sys.exit("{0}: zygote already running".format(self.paths.name))
+        if args.foreground or daemon.daemonize():
+            server.preload()
+            server.serve_forever()
+            if not args.foreground:
+                os._exit(0)
+        else:
+            # The listening socket belongs to the detached process now
+            server.sock.close()
+        return 0
@@ -1,11 +1,13 @@
 __all__ = [
     'BANNER',
-    'DEFAULT_DRIVER_CODE'
+    'DEFAULT_DRIVER_CODE',
+    'make_driver_code',
     'die',
     'verbose',
     'set_color_policy',
 ]
 
+import os as _os
 import sys as _sys
 from . import color as _color
 
@@ -18,11 +20,47 @@ BANNER = """\
 """
 
 DEFAULT_DRIVER_CODE = """\
-#!/usr/bin/env python
-from subdue.sub import main
-main()
+#!{interpreter}
+# Generated by subdue with the paths of this sub built in. Run
+# 'subdue modify --compile <sub>' to generate it again if the sub is moved.
+{path_setup}from subdue.sub import main
+main(sub_path={sub_path!r}, driver_path={driver_path!r})
 """
 
+_DRIVER_PATH_SETUP_CODE = """\
+import sys
+if {lib!r} not in sys.path:
+    sys.path.append({lib!r})
+"""
+
+
+def make_driver_code(root, driver):
+    """
+    Return the code of a driver, located at the path given in driver, for the
+    sub at root.
+
+    Both paths are built into the driver, so that it does not need to derive
+    them on every run. When possible, the driver runs the current interpreter
+    with -S, which skips the scanning of site directories, and adds the
+    location of subdue to sys.path itself, since subdue has no other
+    dependencies.
+    """
+    import subdue
+    root = _os.path.abspath(root)
+    driver = _os.path.abspath(driver)
+    lib = _os.path.dirname(_os.path.dirname(_os.path.abspath(subdue.__file__)))
+    executable = _sys.executable
+    if executable and not any(c.isspace() for c in executable):
+        interpreter = executable + ' -S'
+        path_setup = _DRIVER_PATH_SETUP_CODE.format(lib=lib)
+    else:
+        interpreter = '/usr/bin/env python'
+        path_setup = ''
+    return DEFAULT_DRIVER_CODE.format(interpreter=interpreter,
+                                      path_setup=path_setup,
+                                      sub_path=root,
+                                      driver_path=driver)
+
 verbose = False
 
 
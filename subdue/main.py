@@ -6,7 +6,6 @@ from __future__ import print_function
 __description__ = ''
 
 import sys
-import argparse
 import os
 import stat
 
@@ -92,12 +91,45 @@ def check(args):
             args.subname, "\n - ".join(errors)))
 
 
+@command
+def modify(args):
+    """
+    Modify an existing sub
+    """
+    root = os.path.abspath(args.subname)
+    if args.compile:
+        driver = os.path.join(root, 'bin', os.path.basename(root))
+        if not os.path.isfile(driver):
+            core.die("Sub {0} has no driver to compile: {1} does not exist".format(
+                args.subname, os.path.relpath(driver)))
+        create_default_driver(root, os.path.basename(root), args.verbose)
+
+
+@command
+def pack(args):
+    """
+    Pack the commands, libraries and shared files of a sub into one archive
+    """
+    from subdue.sub import archive
+    from subdue.sub import index as cmdindex
+    root = os.path.abspath(args.subname)
+    if not os.path.isdir(os.path.join(root, 'commands')):
+        core.die("Not a sub: {0} has no commands directory".format(args.subname))
+    output = args.output or root + cmdindex.ARCHIVE_SUFFIX
+    if not cmdindex.is_archive(output):
+        core.die("The name of the archive must end with {0}".format(
+            cmdindex.ARCHIVE_SUFFIX))
+    count = archive.pack(root, output)
+    print("Packed {0} files into {1}".format(count, os.path.relpath(output)))
+    return output
+
+
 def create_default_driver(root, subname, verbose=False):
     driver = os.path.join(root, 'bin', subname)
     if verbose:
         print("Creating driver {0}".format(driver))
     with open(driver, "w") as f:
-        f.write(core.DEFAULT_DRIVER_CODE.lstrip())
+        f.write(core.make_driver_code(root, driver))
 
     # Make executable by current user
     if verbose:
@@ -131,6 +163,9 @@ def parse_args(argv):
     """
     Parse and validate command line arguments
     """
+    # Imported here so that drivers, which import this package, don't pay for
+    # it
+    import argparse
 
     def add_flag(parser, short, longn, help, default=False):
         parser.add_argument(
@@ -159,6 +194,11 @@ def parse_args(argv):
     modify.add_argument("subname", metavar="SUB_NAME", help="Name of the sub to modify")
     modify.add_flag("-t", "--thin", help="Turn this fat sub into a thin sub")
     modify.add_flag("-f", "--fat", help="Turn this thin sub into a fat sub")
+    modify.add_flag("-c", "--compile", help="Generate the driver again with the current paths of the sub built in")
+
+    pack = subparsers.add_parser('pack')
+    pack.add_argument("subname", metavar="SUB_NAME", help="Name of the sub to pack")
+    pack.add_argument("-o", "--output", help="Path of the archive (default: SUB_NAME.zip)")
 
     args = parser.parse_args(argv[1:])
     if args.subcommand is None:
@@ -184,6 +224,10 @@ def main(argv=None):
                 populate_example(root)
         elif args.subcommand == 'check':
             check(args)
+        elif args.subcommand == 'modify':
+            modify(args)
+        elif args.subcommand == 'pack':
+            pack(args)
 
     except KeyboardInterrupt:
         sys.exit(-1)
@@ -6,22 +6,67 @@ from __future__ import unicode_literals
 
 import os
 import sys
-import inspect
-import argparse
 
 from subdue import builtincmd
+from . import cache
+from . import index as cmdindex
+
+def command_roots_var(name):
+    """
+    Return the environment variable with the extra command roots of a sub
+    """
+    ident = ''.join(c if c.isalnum() else '_' for c in name.upper())
+    return 'SUBDUE_{0}_COMMAND_ROOTS'.format(ident)
+
+
+def command_roots_for(root, name, command_roots):
+    """
+    Return the directories with commands of a sub, in order of precedence:
+    those in the environment, then the given ones. Relative paths are relative
+    to the root of the sub.
+    """
+    roots = os.environ.get(command_roots_var(name), '').split(os.pathsep)
+    result = []
+    for path in roots + list(command_roots):
+        if path:
+            path = os.path.join(root, os.path.expanduser(path))
+            if path not in result:
+                result.append(path)
+    return result
+
 
 class SubPaths(object):
-    def __init__(self, root=None):
+    def __init__(self, root=None, driver=None, command_roots=None):
         # print __file__
-        self.calling_script = self._find_calling_script()
+        if driver is None:
+            driver = self._find_calling_script()
+        self.calling_script = driver
         self.name = os.path.basename(self.calling_script)
         self.bin = os.path.dirname(os.path.abspath(self.calling_script))
         self.root = os.path.dirname(self.bin) if root is None else root
+        self.archive = None
+        default_roots = None
+        if cmdindex.is_archive(self.root):
+            # A packed sub is run from the tree where it is extracted, and its
+            # commands are resolved from the archive itself
+            from . import archive
+            self.archive = self.root
+            try:
+                self.root = archive.Archive.open(self.archive).materialize()
+            except archive.ArchiveError as e:
+                sys.exit("{0}: {1}".format(self.name, e))
+            default_roots = [self.archive]
         self.commands = os.path.join(self.root, 'commands')
         self.lib = os.path.join(self.root, 'lib')
         self.shared = os.path.join(self.root, 'shared')
 
+        # Directories with commands: those in the environment, then those
+        # given by the driver or the commands directory
+        if command_roots is None:
+            command_roots = default_roots or [self.commands]
+        self.command_roots = command_roots_for(self.root, self.name,
+                                               command_roots)
+
     @staticmethod
     def _find_calling_script():
         """
@@ -30,17 +75,26 @@ class SubPaths(object):
         """
         # In cPython, the bottom of the callstack has the main script, but in
         # pypy, app_main.py appears in the first three levels.
-        for record in reversed(inspect.stack()):
-            if record[1] != 'app_main.py':
-                return record[1]
+        # Walk the frames directly, inspect.stack() would also read the source
+        # code of every frame.
+        frames = []
+        frame = sys._getframe()
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        for frame in reversed(frames):
+            if frame.f_code.co_filename != 'app_main.py':
+                return frame.f_code.co_filename
 
 
     def __repr__(self):
         return """
             ROOT: {0.root}
+            ARCHIVE: {0.archive}
             LIB: {0.lib}
             BIN: {0.bin}
             COMMANDS: {0.commands}
+            COMMAND ROOTS: {0.command_roots}
             """.format(self)
 
 
@@ -54,6 +108,22 @@ class EnvProp(object):
     def __set__(self, obj, val):
         obj._set(self.name, val)
 
+def normalize_path(entries):
+    """
+    Return a list of PATH entries, normalized and without duplicates, keeping
+    the first occurrence of each. Empty entries stand for the current
+    directory, so they are turned into '.'.
+    """
+    seen = set()
+    normalized = []
+    for entry in entries:
+        entry = os.path.normpath(entry) if entry else '.'
+        if entry not in seen:
+            seen.add(entry)
+            normalized.append(entry)
+    return normalized
+
+
 class Environment:
 
     class SubVar:
@@ -65,7 +135,7 @@ class Environment:
 
     def __init__(self, paths):
         self.vars = {}
-        self.path = os.environ['PATH'].split(':')
+        self.path = os.environ.get('PATH', os.defpath).split(':')
 
         self.name = paths.name
         self.command = ''
@@ -85,8 +155,14 @@ class Environment:
             self._apply_path()
 
     def _apply_path(self):
-        new_path = ':'.join(self.path)
-        os.environ['PATH'] = new_path
+        os.environ['PATH'] = self.path_string()
+
+    def path_string(self):
+        """
+        Return the value of PATH for commands. Prepending the directories of a
+        sub more than once, as nested calls to subs do, leaves PATH unchanged.
+        """
+        return ':'.join(normalize_path(self.path))
 
     def _set(self, name, value):
         if value is not None:
@@ -101,10 +177,24 @@ class Environment:
 
 
     def save(self):
+        """
+        Commit all environment changes to the environment of this process
+        """
         for var in self.vars.values():
             os.environ[var.name] = var.value
         self._apply_path()
 
+    def child_environment(self):
+        """
+        Return the environment for commands as a new dictionary, built from
+        the environment of this process, which is left untouched.
+        """
+        child = dict(os.environ)
+        for var in self.vars.values():
+            child[var.name] = var.value
+        child['PATH'] = self.path_string()
+        return child
+
     name = EnvProp('name')
     command = EnvProp('command')
     path_command = EnvProp('path_command')
@@ -124,7 +214,8 @@ class Command(object):
     searched command could not be found.
 
     """
-    def __init__(self, tokens, path, is_sh, is_container, arguments):
+    def __init__(self, tokens, path, is_sh, is_container, arguments,
+                 is_python=False):
 
         self.tokens = tokens
         """ The tokens that make up the command, excluding the sub name """
@@ -141,12 +232,19 @@ class Command(object):
 
         self.is_container = is_container
 
-    def run_with(self, runner):
+        self.is_python = is_python
+        """ True when the command is a Python module with a main function, to
+        be run in the driver process """
+
+    def run_with(self, runner, env=None):
         """
         Execute this command with a given runner, which must take an array of
-        argv to run
+        argv to run and, when an environment mapping is given, an env keyword
+        argument with it.
         """
-        runner([self.path] + self.arguments)
+        if env is None:
+            return runner([self.path] + self.arguments)
+        return runner([self.path] + self.arguments, env=env)
 
     @property
     def is_eval(self):
@@ -194,6 +292,7 @@ class Command(object):
                 "is_eval={0.is_eval}, "
                 "found_with_sh={0.found_with_sh}, "
                 "is_container={0.is_container}, "
+                "is_python={0.is_python}, "
                 "arguments={0.arguments})".format(self))
 
 
@@ -204,13 +303,17 @@ def mkcmd(command, sh_flag=False):
     """
     return "sh-%s" % command if sh_flag else command
 
-def find_command_path(argv, paths, start_dir=None):
+def find_command_path(argv, paths, start_dir=None, index=None):
     """
     Given a command line with tokens representing both the subcommand structure
     and eventually the arguments for a command, figure out the path to the
     command and extract the items from the command line that are to be passed
     as parameters of that command.
 
+    When a command index is given, it is used to resolve the command without
+    probing the filesystem for every token. If the index is out of date, the
+    filesystem is probed instead and the index is refreshed afterwards.
+
     Returns a Command object, which contains:
         * The full path to the command, which can be either a file or a
           directory. This will be None if the command cannot be found.
@@ -219,49 +322,230 @@ def find_command_path(argv, paths, start_dir=None):
         * The arguments to be passed to the command. this will be None if the
           command cannot be found.
     """
-    running_path = paths.commands if start_dir is None else start_dir
+    if index is not None and start_dir is None:
+        command = find_command_in_index(argv, index)
+        if command is not None:
+            return command
+        if any(cmdindex.is_archive(root) for root in paths.command_roots):
+            # Packed subs have no directories to probe, so the containers
+            # that are out of date are scanned through the index instead
+            command = find_command_in_index(argv, index, scan=True)
+            index.save()
+            if command is not None:
+                return command
+
+    command = find_command_in_filesystem(argv, paths, start_dir)
+    if index is not None:
+        # Bring the index up to date for every container along the way, not
+        # just for the first stale one
+        tokens = command.tokens if command.is_container else command.tokens[:-1]
+        containers = ['']
+        for token in tokens:
+            if '/' in token or token in ('.', '..'):
+                break
+            containers.append(cmdindex.join(containers[-1], token))
+        if (command.found and not command.is_container
+                and len(containers) == len(tokens) + 1):
+            # The index may have missed the command, see find_command_in_index
+            index.invalidate(containers[-1])
+        index.refresh(containers)
+    return command
+
+def find_command_in_index(argv, index, scan=False):
+    """
+    Resolve a command line using only the command index. Returns None when the
+    index cannot answer, either because one of the containers involved is out
+    of date or because a token is not a plain name. With scan, containers
+    that are out of date are scanned again instead.
+
+    Making a file executable does not change the modification time of its
+    container, so the index cannot tell a command is missing: None is
+    returned too, unless scanning, and the filesystem has the last word.
+    """
+    rel = ''
     shift = 0
     command = []
     is_sh = False
     is_dir = False
+    is_python = False
     for (shift, token) in enumerate(argv):
 
-        # If we still have not resolved the script name and we are already
-        # seeing flags in the command line. This means user passing flags to a
-        # container, which is not supported, so just jump out and show help for
-        # the container that has been built so far.
+        # See find_command_in_filesystem for the rationale
         if token[0] == '-':
             break
 
+        # Tokens that the filesystem would interpret as paths
+        if '/' in token or token in ('.', '..'):
+            return None
+
         command.append(token)
-        possible_path = os.path.join(running_path, token)
+        entries = index.entries(rel) if scan else index.listing(rel)
+        if entries is None:
+            return None
+        kind = entries.get(token)
         is_dir = False
 
-        # If the current token is part of the path but it is not the script
-        # itself, just add to running path and keep looking.
-        if os.path.isdir(possible_path):
-            running_path = possible_path
+        if kind == cmdindex.KIND_DIR:
+            rel = cmdindex.join(rel, token)
             is_dir = True
             continue
 
-        # But if the current token is the script, set the path and return.
-        if os.access(possible_path, os.X_OK):
-            running_path = possible_path
+        if kind == cmdindex.KIND_EXEC:
+            rel = cmdindex.join(rel, token)
             break
 
-        # Perhaps it's an "sh-type" script
-        possible_path_sh = os.path.join(running_path, mkcmd(token, sh_flag=True))
-        if os.access(possible_path_sh, os.X_OK):
-            running_path = possible_path_sh
+        sh_token = mkcmd(token, sh_flag=True)
+        if entries.get(sh_token) == cmdindex.KIND_EXEC:
+            rel = cmdindex.join(rel, sh_token)
             is_sh = True
             break
 
-        # Otherwise, we have a token that is not a directory and appears before
-        # the script is found. This is an error. Make sure we still return the
-        # command, so it can be shown in the error.
+        py_token = token + cmdindex.PYTHON_SUFFIX
+        if entries.get(py_token) == cmdindex.KIND_PYTHON:
+            rel = cmdindex.join(rel, py_token)
+            is_python = True
+            break
+
+        if not scan:
+            return None
         return Command.create_not_found(command)
 
-    return Command(command, running_path, is_sh, is_dir, argv[shift+1:])
+    return Command(command, index.path_for(rel), is_sh, is_dir,
+                   argv[shift+1:], is_python)
+
+def _find_in_root(base, token, listings):
+    """
+    Look a token up in the directory of a container in one root: as a
+    container or an executable, then as an eval command, then as a Python
+    function command, which executables never are. Return (path, is container,
+    is eval, is Python) for the first one found, or None.
+    """
+    for _, path, entry in _candidates([base], token, listings):
+        if _is_dir(path, entry):
+            return path, True, False, False
+        if _is_executable(path):
+            return path, False, False, False
+    for _, path, _ in _candidates(
+            [base], mkcmd(token, sh_flag=True), listings):
+        if _is_executable(path):
+            return path, False, True, False
+    for _, path, entry in _candidates(
+            [base], token + cmdindex.PYTHON_SUFFIX, listings):
+        if (_is_file(path, entry) and not _is_executable(path)
+                and cmdindex.declares_main(path)):
+            return path, False, False, True
+    return None
+
+def _candidates(running_paths, name, listings):
+    """
+    Generate (position, path, entry) for an entry name in each of the given
+    directories that has it, where entry is its scandir entry, if known. The
+    directories are listed on demand, once, and their listings are kept in the
+    given dictionary. Names that are paths are not looked up in listings, so
+    they are generated for every directory with no entry.
+    """
+    listed = not ('/' in name or name in ('.', '..'))
+    for position, base in enumerate(running_paths):
+        entry = None
+        if listed:
+            listing = listings.get(base)
+            if listing is None:
+                listing = listings[base] = cmdindex.list_dir(base)
+            if name not in listing:
+                continue
+            entry = listing[name]
+        yield position, os.path.join(base, name), entry
+
+def _is_dir(path, entry):
+    """ Check whether a path is a directory, from its scandir entry if any """
+    if entry is None or entry.is_symlink():
+        cmdindex.Probes.count += 1
+        return os.path.isdir(path)
+    return entry.is_dir()
+
+def _is_file(path, entry):
+    """ Check whether a path is a file, from its scandir entry if any """
+    if entry is None or entry.is_symlink():
+        cmdindex.Probes.count += 1
+        return os.path.isfile(path)
+    return entry.is_file()
+
+def _is_executable(path):
+    cmdindex.Probes.count += 1
+    return os.access(path, os.X_OK)
+
+def find_command_in_filesystem(argv, paths, start_dir=None):
+    """
+    Resolve a command line by reading the filesystem, in each of the command
+    roots of the sub that have the container so far. See find_command_path
+    and index.merge_listings for the precedence rules.
+
+    Each container is listed once, and a token and its eval and Python
+    variants are all looked up in that listing, so a level costs a listing
+    per root that is reached, plus one probe for the entry that matches, if
+    it is not a plain container. Entries that are not in the listing cost
+    nothing. The probes are counted in index.Probes.
+
+    All the variants of a token are tried in a root before going on to the
+    next one, so an eval command in a root wins over a command with the same
+    name in a later root, see _find_in_root.
+    """
+    running_paths = paths.command_roots if start_dir is None else [start_dir]
+    running_path = running_paths[0]
+    listings = {}
+    shift = 0
+    command = []
+    is_sh = False
+    is_dir = False
+    is_python = False
+    for (shift, token) in enumerate(argv):
+
+        # If we still have not resolved the script name and we are already
+        # seeing flags in the command line. This means user passing flags to a
+        # container, which is not supported, so just jump out and show help for
+        # the container that has been built so far.
+        if token[0] == '-':
+            break
+
+        command.append(token)
+        found = None
+        for position, base in enumerate(running_paths):
+            found = _find_in_root(base, token, listings)
+            if found is not None:
+                break
+
+        # A token that is in no root, before the script is found, is an error.
+        # Make sure we still return the command, so it can be shown in the
+        # error.
+        if found is None:
+            return Command.create_not_found(command)
+
+        running_path, is_dir, is_sh, is_python = found
+        if is_dir:
+            # If the current token is part of the path but it is not the
+            # script itself, keep looking. The container continues in the
+            # following roots that have it.
+            later = _candidates(running_paths[position + 1:], token, listings)
+            running_paths = [running_path] + [path for _, path, entry in later
+                                              if _is_dir(path, entry)]
+            continue
+        break
+
+    return Command(command, running_path, is_sh, is_dir, argv[shift+1:],
+                   is_python)
+
+def not_found_message(paths, tokens, index=None):
+    """
+    Return the error message for a command line whose last token could not be
+    found, followed by the commands it was probably meant to be, if any.
+    """
+    from . import suggest
+    message = "{0}: no such command `{1}'".format(paths.name, ' '.join(tokens))
+    if index is None:
+        index = cmdindex.load_index(paths.command_roots)
+    lines = suggest.format_suggestions(paths.name, tokens, index)
+    index.save()
+    return '\n'.join([message] + lines)
 
 def path_prepend(directory):
     """
@@ -270,6 +554,14 @@ def path_prepend(directory):
     os.environ['PATH'] = ":".join((directory, os.environ['PATH']))
 
 
+def default_sub_root():
+    """
+    Cheap guess of the sub root for drivers that live in the bin directory of
+    their sub, without inspecting the call stack like SubPaths does.
+    """
+    return os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+
+
 def find_builtin_command(args, paths):
     cmd = builtincmd.find(args[0])
     if cmd is not None:
@@ -278,20 +570,116 @@ def find_builtin_command(args, paths):
 def command_help():
     return True
 
-def execvp_runner(args):
-    os.execvp(args[0], args)
+def execvp_runner(args, env=None):
+    if env is None:
+        os.execvp(args[0], args)
+    else:
+        os.execvpe(args[0], args, env)
+
+def environ_runner(runner):
+    """
+    Adapt a command runner given to main, which only takes the argv of the
+    command, to be called like the internal runners: the environment given as
+    env is applied to the environment of this process before calling it.
+    """
+    def adapted_runner(args, env=None):
+        if env is not None:
+            os.environ.update(env)
+        return runner(args)
+    return adapted_runner
+
 
 def bool_to_rc(result):
     sys.exit(0 if result else 1)
 
+EVAL_MARKER = '# subdue eval output'
+"""
+First line written to the eval file descriptor when the command must be
+evaluated by the shell wrapper
+"""
+
+def redirect_eval_output(fd, is_eval):
+    """
+    Implement the single process eval protocol used by the shell wrapper.
+
+    The wrapper passes a file descriptor whose contents it captures. For eval
+    commands, the driver writes EVAL_MARKER to it and makes it the standard
+    output of the command, so that the wrapper knows it has to eval what it
+    captured. For any other command the descriptor is just closed, and the
+    command writes to the real standard output.
+    """
+    if is_eval:
+        sys.stdout.flush()
+        os.write(fd, (EVAL_MARKER + '\n').encode('utf-8'))
+        os.dup2(fd, 1)
+    os.close(fd)
+
+
+class DriverArgs(object):
+    """
+    Options given to the driver before the command tokens
+    """
+    def __init__(self):
+        self.is_eval = False
+        self.eval_fd = None
+        self.shell = None
+        self.help = False
+        self.no_cache = False
+        self.args = []
+
 
 def parse_args(argv):
-    """ Parse and validate command line arguments """
+    """
+    Parse and validate command line arguments.
+
+    Driver options are few and simple, so they are parsed by hand to avoid the
+    cost of importing argparse and building a parser on every run. argparse is
+    only used to report errors.
+    """
+    args = DriverArgs()
+    position = 0
+    while position < len(argv):
+        token = argv[position]
+        if not token.startswith('-'):
+            break
+        position += 1
+        option, has_value, value = token.partition('=')
+        if option in ('--shell', '--eval-fd') and not has_value:
+            if position == len(argv):
+                return parse_args_strictly(argv)
+            value = argv[position]
+            position += 1
+        elif has_value and option not in ('--shell', '--eval-fd'):
+            return parse_args_strictly(argv)
+
+        if option in ('-h', '--help'):
+            args.help = True
+        elif option == '--is-eval':
+            args.is_eval = True
+        elif option == '--no-cache':
+            args.no_cache = True
+        elif option == '--shell':
+            args.shell = value
+        elif option == '--eval-fd' and value.isdigit():
+            args.eval_fd = int(value)
+        else:
+            return parse_args_strictly(argv)
+    args.args = argv[position:]
+    return args
+
+
+def parse_args_strictly(argv):
+    """ Parse command line arguments with argparse, for proper error reporting """
+    import argparse
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("--is-eval", action='store_true')
+    # Single process alternative to --is-eval, see redirect_eval_output
+    parser.add_argument("--eval-fd", type=int, help=argparse.SUPPRESS)
     # The shell function wrapper will use this to inform the driver about the shell:
     parser.add_argument("--shell", help=argparse.SUPPRESS)
     parser.add_argument("-h", "--help", action='store_true')
+    # Run commands even if their output is memoized
+    parser.add_argument("--no-cache", action='store_true')
     parser.add_argument("args", nargs=argparse.REMAINDER)
 
     args = parser.parse_args(argv)
@@ -310,27 +698,105 @@ def do_main(argv=None, **kwargs):
       * docfilename
       * summaryformatter
       * helpformatter
-      * lookupinpath
 
 
     :param list argv: Command line arguments
-    :param str root_path: The path to the root of the sub
-    :param callable command_runner: A callable to run the found command script
+    :param str root_path: The path to the root of the sub, or to the archive
+                          of a packed sub, see archive
+    :param str driver_path: The path to the driver script, to avoid finding it
+                            by inspecting the call stack
+    :param list command_roots: Directories with the commands of the sub, in
+                              order of precedence, relative to its root
+                              (default: ['commands'])
+    :param callable command_runner: A callable to run the found command script,
+                                    which gets its argv, with the environment
+                                    of the command already in os.environ
+    :param callable python_runner: A callable to run Python function commands
+                                   (default: pycommand.run_python_command)
+    :param bool use_index: Resolve commands through the on-disk command index
+                           (default: True)
+    :param bool use_daemon: Resolve commands through the resolver daemon of
+                            the sub, when it is running (default: True)
+    :param bool use_zygote: Run Python scripts in the zygote of the sub, when
+                            it is running and no command_runner is given
+                            (default: True)
+    :param bool lookupinpath: Run <sub name>-<command> from PATH when the first
+                              token is not a command of the sub
+                              (default: False)
+    :param bool use_memo: Serve commands with a Cache-TTL header from the memo
+                          cache (default: True, unless a command_runner is
+                          given)
 
     """
 
-    # Parse command line arguments
     if argv is None:
         argv = sys.argv[1:]
+
+    # Memoized output is captured with a subprocess, which a custom runner
+    # would not expect
+    kwargs.setdefault('use_memo', 'command_runner' not in kwargs)
+    if 'command_runner' in kwargs:
+        kwargs['command_runner'] = environ_runner(kwargs['command_runner'])
+
+    # Python scripts go to the zygote of the sub, when it is running
+    if 'command_runner' not in kwargs and kwargs.get('use_zygote', True):
+        root = kwargs.get('sub_path') or default_sub_root()
+        if cache.find_runtime_socket('zygote', root) is not None:
+            from . import zygote
+            kwargs['command_runner'] = zygote.ZygoteRunner(root, execvp_runner)
+
+    # Tracing is opt-in, see the trace module
+    trace_path = os.environ.get('SUBDUE_TRACE')
+    if not trace_path:
+        return _dispatch(argv, None, kwargs)
+
+    from . import trace as tracing
+    trace = tracing.Trace(trace_path, argv)
+    kwargs['command_runner'] = trace.wrap_runner(
+            kwargs.get('command_runner', execvp_runner))
+    try:
+        return _dispatch(argv, trace, kwargs)
+    finally:
+        trace.mark('end')
+        trace.write()
+
+
+def _dispatch(argv, trace, kwargs):
+    """
+    Do the work of do_main, recording the end of each phase in the given trace,
+    if any.
+    """
+
+    # If a resolver daemon is serving this sub, let it do all the work
+    if kwargs.get('use_daemon', True):
+        root = kwargs.get('sub_path') or default_sub_root()
+        if cache.find_runtime_socket('resolver', root) is not None:
+            from . import daemon
+            handled = daemon.run_through_daemon(root, argv, **kwargs)
+            if trace:
+                trace.mark('daemon')
+            if handled:
+                return
+
+    # Parse command line arguments
     args = parse_args(argv)
+    if trace:
+        trace.mark('parse_args')
 
     # Derive all necessary paths
-    paths = SubPaths(kwargs.get('sub_path'))
+    paths = SubPaths(kwargs.get('sub_path'), kwargs.get('driver_path'),
+                     kwargs.get('command_roots'))
+    if trace:
+        trace.mark('paths')
 
     # Check for the -h or --help option, or no arguments at all: That should
     # print help
     if args.help or not args.args:
-        help_cmd = find_builtin_command(['help'], paths)
+        if args.eval_fd is not None:
+            redirect_eval_output(args.eval_fd, False)
+        help_cmd = find_builtin_command(['help'] + args.args, paths)
+        if trace:
+            trace.builtin('help')
         help_cmd()
         return 0
 
@@ -341,12 +807,41 @@ def do_main(argv=None, **kwargs):
     env.prepend_to_path(paths.lib)
     env.prepend_to_path(paths.bin)
 
+    if trace:
+        trace.mark('environment')
+
     internal_command = find_builtin_command(args.args, paths)
     if internal_command is not None:
+        if args.eval_fd is not None:
+            redirect_eval_output(args.eval_fd, False)
+        if trace:
+            trace.builtin(args.args[0])
         return internal_command()
 
     # Try finding the command under the commands directory of the sub
-    command = find_command_path(args.args, paths)
+    index = None
+    if kwargs.get('use_index', True):
+        index = cmdindex.open_index(paths.command_roots)
+    try:
+        command = find_command_path(args.args, paths, index=index)
+    except Exception as e:
+        # Commands of packed subs are extracted as they are found
+        from . import archive
+        if not isinstance(e, archive.ArchiveError):
+            raise
+        sys.exit("{0}: {1}".format(paths.name, e))
+
+    # Built-in and in-tree commands take precedence over external commands
+    if (not command.found and len(command.tokens) == 1
+            and kwargs.get('lookupinpath')):
+        from . import pathindex
+        external = pathindex.find_external_command(
+                args.args, paths.name, env.path_string())
+        if external is not None:
+            command = external
+    if trace:
+        trace.mark('find_command_path')
+        trace.resolved(command)
 
     # If we are querying for eval commands, say NO even when the command is not
     # found. This will probably be folowed by a normal call to the command,
@@ -354,8 +849,12 @@ def do_main(argv=None, **kwargs):
     if args.is_eval:
         return bool_to_rc(command.found and command.found_with_sh)
 
+    if args.eval_fd is not None:
+        redirect_eval_output(args.eval_fd,
+                             command.found and command.found_with_sh)
+
     if not command.found:
-        sys.exit("{0}: no such command `{1}'".format(paths.name, command.command))
+        sys.exit(not_found_message(paths, command.tokens, index))
 
     if command.is_container:
         # TODO: show container help and don't die
@@ -368,11 +867,44 @@ def do_main(argv=None, **kwargs):
     env.command = command.command   # _SUB_COMMAND_
     env.path_command = command.path # _SUB_PATH_COMMAND_
 
-    # This will commit all environment changes to the real environment
-    env.save()
+    # The environment of the command is handed to the runner as a whole, the
+    # one of this process is not modified
+    child_env = env.child_environment()
+    if trace:
+        trace.mark('environment_save')
+
+    # Commands may declare that their output can be reused for a while, which
+    # is looked for in a bounded read of the command
+    if (kwargs.get('use_memo') and not args.no_cache and not command.is_python
+            and cache.cache_dir() is not None
+            and cmdindex.declares_memo(command.path)):
+        from . import memo
+        status = memo.run(command, child_env)
+        if status is not None:
+            if trace:
+                trace.mark('memo')
+            return status
 
     api_runner = kwargs.get('command_runner', execvp_runner)
-    command.run_with(api_runner)
+    if command.is_python:
+        from . import pycommand
+        api_runner = kwargs.get('python_runner', pycommand.run_python_command)
+        if trace:
+            api_runner = trace.wrap_runner(api_runner)
+    try:
+        return command.run_with(api_runner, env=child_env)
+    except OSError as e:
+        if command.is_python:
+            raise
+        if not os.access(command.path, os.X_OK):
+            # The index still lists a command that is no longer executable
+            if index is not None:
+                container = '/'.join(command.tokens[:-1])
+                index.invalidate(container)
+                index.refresh([container])
+            sys.exit(not_found_message(paths, command.tokens, index))
+        sys.exit("{0}: cannot run `{1}': {2}".format(
+            paths.name, command.command, e.strerror or e))
 
 
 def main(argv=None, **kwargs):
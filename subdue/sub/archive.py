@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Subs packed into a single archive.
+
+A packed sub is a zip file with the commands, lib and share directories of a
+sub, plus a member index: a marshalled record, stored uncompressed as the last
+member, with the listing of every container of the commands tree and the
+location of every member in the file. The offset of the index member is kept
+in the comment of the zip file, so that the driver can find it by reading the
+end of the file, without going through the central directory or importing
+zipfile. The archive is mapped in memory, so resolving a command line reads a
+few pages of it and makes no filesystem probes at all.
+
+Files are only extracted when they are about to be run or read, to a content
+addressed store in the cache directory, and then linked into a directory tree
+for the archive that looks like an unpacked sub. Files with the same contents
+in several archives, like successive versions of the same sub, are extracted
+once. The lib and share directories are extracted in full the first time the
+archive is used, since commands expect to find them in place.
+
+Archives are written with the standard zipfile module, so they can be
+inspected and unpacked with the usual tools. Marshal format version 2 is used
+for the member index, which every supported version of Python can read.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import marshal
+import mmap
+import os
+import re
+import stat
+import struct
+import zlib
+
+from . import cache
+from . import index as cmdindex
+
+INDEX_MEMBER = '.subdue/index'
+
+INDEX_VERSION = 1
+
+PACKED_DIRECTORIES = ['commands', 'lib', 'share', 'shared']
+""" Directories of a sub that go into its archive """
+
+EXTRACTED_DIRECTORIES = PACKED_DIRECTORIES[1:]
+""" Directories extracted in full the first time an archive is used """
+
+COMMENT_FORMAT = 'subdue-index {0} {1}'
+COMMENT_PATTERN = re.compile(br'^subdue-index (\d+) ([0-9a-f]{40})$')
+
+_END_RECORD = b'PK\x05\x06'
+_END_RECORD_SIZE = 22
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+_STORED = 0
+_DEFLATED = 8
+
+# Fixed timestamp for all members, so that packing the same files twice gives
+# the same archive
+_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def extract_dir():
+    """
+    Return the directory where archives are extracted: in the cache directory,
+    or in the runtime directory when caches are disabled. Files found there
+    are run as they are, so the runtime directory must be private to the
+    user, see cache.is_private_dir, or ArchiveError is raised.
+    """
+    directory = cache.cache_dir()
+    if directory is None:
+        try:
+            directory = cache.make_runtime_dir()
+        except OSError as e:
+            raise ArchiveError("Cannot extract archives: {0}".format(
+                e.strerror or e))
+    return os.path.join(directory, 'archives')
+
+
+def _has_digest(path, digest):
+    """ Tell whether the contents of a file have the given sha1 """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest() == digest
+    except (IOError, OSError):
+        return False
+
+
+def _walk_commands(root):
+    """
+    Generate (relative path, entries) for every container of a commands tree,
+    with the kinds of the command index. Symlinks are followed, but a
+    container is only visited once.
+    """
+    seen = set()
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        path = os.path.join(root, *rel.split('/')) if rel else root
+        real = os.path.realpath(path)
+        if real in seen:
+            continue
+        seen.add(real)
+        entries = cmdindex.scan_dir(path)
+        yield rel, entries
+        pending.extend(cmdindex.join(rel, name)
+                       for name, kind in sorted(entries.items(), reverse=True)
+                       if kind == cmdindex.KIND_DIR)
+
+
+def _walk_files(root):
+    """ Generate the relative paths of all the files under a directory """
+    for path, dirs, files in os.walk(root, followlinks=True):
+        dirs.sort()
+        rel = os.path.relpath(path, root)
+        for name in sorted(files):
+            yield name if rel == '.' else '/'.join(rel.split(os.sep) + [name])
+
+
+def pack(root, output):
+    """
+    Pack the sub at root into an archive at output. Return the number of files
+    packed.
+    """
+    import zipfile
+
+    dirs = {}
+    files = []
+    commands = os.path.join(root, 'commands')
+    for rel, entries in _walk_commands(commands):
+        dirs[rel] = entries
+        files.extend('commands/' + cmdindex.join(rel, name)
+                     for name, kind in sorted(entries.items())
+                     if kind != cmdindex.KIND_DIR)
+    for directory in EXTRACTED_DIRECTORIES:
+        if os.path.isdir(os.path.join(root, directory)):
+            files.extend(directory + '/' + name for name in
+                         _walk_files(os.path.join(root, directory)))
+
+    members = {}
+    tmp_output = output + '.tmp'
+    with zipfile.ZipFile(tmp_output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in files:
+            path = os.path.join(root, *name.split('/'))
+            with open(path, 'rb') as f:
+                data = f.read()
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            info = zipfile.ZipInfo(name, _DATE_TIME)
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, data)
+            members[name] = (info.header_offset, info.compress_type,
+                             info.compress_size, mode,
+                             hashlib.sha1(data).hexdigest())
+
+        index = marshal.dumps({
+            'version': INDEX_VERSION,
+            'dirs': dirs,
+            'members': members,
+            }, 2)
+        info = zipfile.ZipInfo(INDEX_MEMBER, _DATE_TIME)
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = (stat.S_IFREG | 0o644) << 16
+        archive.writestr(info, index)
+        archive.comment = COMMENT_FORMAT.format(
+            info.header_offset, hashlib.sha1(index).hexdigest()).encode('ascii')
+    os.rename(tmp_output, output)
+    return len(files)
+
+
+class Archive(object):
+    """
+    A packed sub, mapped in memory
+    """
+
+    _open = {}
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.mtime = os.fstat(f.fileno()).st_mtime
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise ArchiveError("Cannot open archive {0}: {1}".format(path, e))
+
+        offset, self.key = self._find_index()
+        index = self._read_at(offset, _STORED, None)
+        try:
+            index = marshal.loads(index)
+        except (EOFError, ValueError, TypeError):
+            index = None
+        if not isinstance(index, dict) or index.get('version') != INDEX_VERSION:
+            raise ArchiveError("Unsupported archive {0}".format(path))
+        self.dirs = index['dirs']
+        """ Maps relative container paths to {name: kind} """
+        self.members = index['members']
+        """ Maps member names to (offset, method, size, mode, sha1) """
+
+        self._tree = None
+
+    @property
+    def tree(self):
+        """
+        Where the files of the archive are extracted, as in a sub. Only
+        looked up when something is extracted, see extract_dir.
+        """
+        if self._tree is None:
+            self._tree = os.path.join(extract_dir(), self.key)
+        return self._tree
+
+    @classmethod
+    def open(cls, path):
+        """
+        Return the archive at a path, mapping it only once per process
+        """
+        archive = cls._open.get(path)
+        if archive is None:
+            archive = cls._open[path] = cls(path)
+        return archive
+
+    def _find_index(self):
+        """
+        Return the offset of the member index and the key of the archive, as
+        stored in the comment at the end of the file.
+        """
+        data = self.data
+        start = max(0, len(data) - _END_RECORD_SIZE - 0xffff)
+        end = data.rfind(_END_RECORD, start)
+        match = None
+        if end >= 0:
+            length, = struct.unpack('<H', data[end + 20:end + 22])
+            match = COMMENT_PATTERN.match(
+                    data[end + _END_RECORD_SIZE:end + _END_RECORD_SIZE + length])
+        if match is None:
+            raise ArchiveError("Not a packed sub: {0}".format(self.path))
+        return int(match.group(1)), match.group(2).decode('ascii')
+
+    def _read_at(self, offset, method, size):
+        """
+        Return the contents of the member whose local header is at offset. The
+        size is taken from the header when not given.
+        """
+        header = self.data[offset:offset + _LOCAL_HEADER.size]
+        if len(header) != _LOCAL_HEADER.size:
+            raise ArchiveError("Corrupt archive {0}".format(self.path))
+        (signature, _, _, _, _, _, _, header_size, _,
+         name_length, extra_length) = _LOCAL_HEADER.unpack(header)
+        if signature != b'PK\x03\x04':
+            raise ArchiveError("Corrupt archive {0}".format(self.path))
+        start = offset + _LOCAL_HEADER.size + name_length + extra_length
+        data = self.data[start:start + (header_size if size is None else size)]
+        if method == _DEFLATED:
+            data = zlib.decompress(data, -15)
+        return data
+
+    def read(self, name):
+        """ Return the contents of a member """
+        offset, method, size, _, _ = self.members[name]
+        return self._read_at(offset, method, size)
+
+    def extract(self, name):
+        """
+        Return the path of a member, or of a container, in the extracted tree
+        of the archive, extracting it first if needed. Raise ArchiveError if
+        a member cannot be extracted.
+        """
+        path = os.path.join(self.tree, *name.split('/'))
+        member = self.members.get(name)
+        if member is None:
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+            return path
+        if os.path.exists(path):
+            return path
+
+        # Members are stored once per contents and mode, and linked into the
+        # trees of the archives that have them, once their contents are known
+        # to be those in the index
+        offset, method, size, mode, digest = member
+        objects = os.path.join(os.path.dirname(self.tree), 'objects')
+        stored = os.path.join(objects, '{0}-{1:o}'.format(digest, mode))
+        if not _has_digest(stored, digest):
+            cache.write_atomic(stored, self.read(name), mode | 0o600)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError:
+            pass
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            os.link(stored, tmp_path)
+            os.rename(tmp_path, path)
+        except OSError as e:
+            # No hard links here, keep a copy instead
+            if not cache.write_atomic(path, self.read(name), mode | 0o600):
+                raise ArchiveError(
+                        "Cannot extract {0} from {1} to {2}: {3}".format(
+                            name, self.path, path, e.strerror or e))
+        return path
+
+    def materialize(self):
+        """
+        Make sure the directories of the archive that are not commands are
+        extracted, and return the root of the extracted tree.
+        """
+        marker = os.path.join(self.tree, '.complete')
+        if not os.path.exists(marker):
+            for name in sorted(self.members):
+                if name.split('/', 1)[0] in EXTRACTED_DIRECTORIES:
+                    self.extract(name)
+            self.extract('commands')
+            cache.write_atomic(marker, b'')
+        return self.tree
+
+
+class ArchiveIndex(object):
+    """
+    The commands tree of a packed sub, with the same interface as
+    index.CommandIndex. An archive does not change while it is mapped, so its
+    listings are never out of date.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.root = archive.path
+        self.dirs = dict((rel, (archive.mtime, entries))
+                         for rel, entries in archive.dirs.items())
+        self.stale = set()
+
+    @classmethod
+    def load(cls, path):
+        return cls(Archive.open(path))
+
+    def listing(self, rel):
+        return self.archive.dirs.get(rel)
+
+    entries = listing
+
+    def path_for(self, rel):
+        """
+        Return the path of an entry in the extracted tree of the archive,
+        extracting it if needed
+        """
+        return self.archive.extract(cmdindex.join('commands', rel))
+
+    def member(self, rel):
+        """ See index.CommandIndex.member """
+        return self.archive, cmdindex.join('commands', rel)
+
+    def declares_memo(self, rel):
+        """ See index.CommandIndex.declares_memo """
+        data = self.archive.read(cmdindex.join('commands', rel))
+        return cmdindex.MEMO_HEADER in data[:cmdindex.HEADER_BYTES]
+
+    def walk(self, rel=''):
+        entries = self.entries(rel)
+        if entries is None:
+            return
+        yield rel, entries
+        for name, kind in entries.items():
+            if kind == cmdindex.KIND_DIR:
+                for item in self.walk(cmdindex.join(rel, name)):
+                    yield item
+
+    def invalidate(self, rel, subtree=False):
+        pass
+
+    def refresh(self, containers=()):
+        pass
+
+    def save(self):
+        pass
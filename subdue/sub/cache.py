@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to keep per-user cache files for subs.
+
+All caches live under a single directory, which is taken from the
+SUBDUE_CACHE_DIR environment variable, then from XDG_CACHE_HOME, and finally
+defaults to ~/.cache/subdue. Setting SUBDUE_CACHE_DIR to an empty string
+disables all on-disk caches.
+
+Cache files are always written atomically (write to a temporary file in the
+same directory, then rename over the destination), so any number of
+concurrent invocations can rebuild the same cache without readers ever seeing
+a partially written file.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import stat
+import zlib
+import errno
+import marshal
+import binascii
+
+CACHE_DIR_VAR = 'SUBDUE_CACHE_DIR'
+
+# Marshal data is only readable by the same Python version that wrote it
+_PYTAG = 'py{0}{1}'.format(*sys.version_info[:2])
+
+
+def cache_dir():
+    """
+    Return the directory where cache files are stored, or None if caching has
+    been disabled.
+    """
+    directory = os.environ.get(CACHE_DIR_VAR)
+    if directory is not None:
+        return directory or None
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'subdue')
+
+
+def cache_file(kind, key):
+    """
+    Return the path to the cache file of a given kind for a given key (usually
+    a path), or None if caching has been disabled.
+    """
+    directory = cache_dir()
+    if directory is None:
+        return None
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    checksum = zlib.crc32(key) & 0xffffffff
+    name = '{0}-{1:08x}-{2}.marshal'.format(kind, checksum, _PYTAG)
+    return os.path.join(directory, name)
+
+
+def runtime_dir():
+    """
+    Return the per-user directory for runtime files, like sockets. It is taken
+    from XDG_RUNTIME_DIR, or is a directory only accessible by the current user
+    in the system temporary directory.
+    """
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if directory:
+        return os.path.join(directory, 'subdue')
+    tmp = os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(tmp, 'subdue-{0}'.format(os.getuid()))
+
+
+def is_private_dir(path):
+    """
+    Tell whether a directory can only be used by the current user: it is not a
+    symlink, it belongs to the user and its mode is 0700. Anybody can create
+    the default runtime directory in /tmp before its user does, so sockets
+    found anywhere else are not trusted.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+            and stat.S_IMODE(st.st_mode) == 0o700)
+
+
+def make_runtime_dir():
+    """
+    Create the runtime directory if needed and return it. Raise OSError if it
+    is not private to the current user, see is_private_dir.
+    """
+    directory = runtime_dir()
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if not is_private_dir(directory):
+        raise OSError(errno.EPERM,
+                      "{0} is not a directory private to the current "
+                      "user".format(directory))
+    return directory
+
+
+def find_runtime_socket(kind, key):
+    """
+    Return the path of the socket of a given kind for a given key if it exists
+    in a private runtime directory, None otherwise.
+    """
+    path = runtime_file(kind, key, 'sock')
+    if os.path.exists(path) and is_private_dir(os.path.dirname(path)):
+        return path
+    return None
+
+
+def peer_is_current_user(sock):
+    """
+    Tell whether the process at the other end of a connected Unix socket runs
+    as the current user. Where the credentials of the peer cannot be read,
+    sockets are only protected by the private runtime directory.
+    """
+    import socket
+    import struct
+    option = getattr(socket, 'SO_PEERCRED', None)
+    if option is None:
+        return True
+    size = struct.calcsize('3i')
+    try:
+        credentials = sock.getsockopt(socket.SOL_SOCKET, option, size)
+    except socket.error:
+        return False
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+
+def runtime_file(kind, key, extension):
+    """
+    Return the path to a runtime file of a given kind for a given key.
+    """
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    checksum = zlib.crc32(key) & 0xffffffff
+    name = '{0}-{1:08x}.{2}'.format(kind, checksum, extension)
+    return os.path.join(runtime_dir(), name)
+
+
+def read_marshal(path):
+    """
+    Load the contents of a cache file. Return None when the file does not
+    exist or cannot be read for any reason, so that callers treat a corrupt
+    cache as a missing one.
+    """
+    if path is None:
+        return None
+    try:
+        # Reading the whole file first is much faster than letting marshal
+        # read it an object at a time
+        with open(path, 'rb') as f:
+            return marshal.loads(f.read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_atomic(path, data, mode=0o600):
+    """
+    Write the given bytes to path atomically, with the given permissions.
+    Return True on success, False if the file could not be written (read only
+    cache directory, full disk...).
+    """
+    directory = os.path.dirname(path)
+    tmp_path = '{0}.{1}.{2}.tmp'.format(
+            path, os.getpid(), binascii.hexlify(os.urandom(4)).decode('ascii'))
+    try:
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another writer may have created it in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def write_marshal(path, value):
+    """
+    Atomically store a marshallable value in a cache file.
+    """
+    if path is None:
+        return False
+    return write_atomic(path, marshal.dumps(value))
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of the commands of a sub, with what their headers say about them, for
+tools that need a description of every command.
+
+Besides the documentation directives of headers, commands can declare the
+environment variables they use in an ``# Env:`` directive, with the names
+separated by spaces. The names in the ``# Cache-Env:`` directive of memoized
+commands, see memo, count as declared too.
+
+The catalog is kept in a per-root cache with a record for every container:
+its modification time and, for each of its entries, the kind, modification
+time and size of the file along with what was parsed from its headers. A
+container whose modification time has not changed is taken from the cache as
+it is, so cataloging an unchanged tree only stats its containers. A container
+that changed is listed again, and only its files that changed are read.
+
+Editing a file in place does not change the modification time of its
+container, so such a change is only noticed once something else in the
+container changes, or when the catalog is verified, which stats every file.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import re
+import stat
+import time
+
+from . import cache
+from . import headers
+from . import index as cmdindex
+
+_ENV = re.compile(r'^\s*#\s*(?:Cache-)?Env:(.*)$')
+
+
+def shebang_interpreter(line):
+    """
+    Return the interpreter named in a shebang line, as the program env would
+    run, or None if the line is not a shebang.
+    """
+    if not line.startswith('#!'):
+        return None
+    words = line[2:].split()
+    if words and os.path.basename(words[0]) == 'env':
+        words = [word for word in words[1:]
+                 if not word.startswith('-') and '=' not in word]
+    return words[0] if words else None
+
+
+def parse_lines(lines):
+    """
+    Return (summary, usage, environment variable names, interpreter) from the
+    first lines of a command file.
+    """
+    doc = headers.parse_headers(lines)
+    names = set()
+    for line in lines[:headers.MAX_LINES]:
+        match = _ENV.match(line)
+        if match is not None:
+            names.update(match.group(1).split())
+    interpreter = shebang_interpreter(lines[0]) if lines else None
+    return doc['summary'], doc['usage'], sorted(names), interpreter
+
+
+class DirectorySource(object):
+    """
+    Access to the files of a commands directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, rel):
+        if not rel:
+            return self.root
+        return os.path.join(self.root, *rel.split('/'))
+
+    def mtime(self, rel):
+        """ Return the modification time of a container, None if missing """
+        cmdindex.Probes.count += 1
+        try:
+            st = os.stat(self.path(rel))
+        except OSError:
+            return None
+        return st.st_mtime if stat.S_ISDIR(st.st_mode) else None
+
+    def listing(self, rel):
+        cmdindex.Probes.count += 1
+        try:
+            return cmdindex.scan_dir(self.path(rel))
+        except OSError:
+            return {}
+
+    def stat(self, rel):
+        """ Return (modification time, size) of a file, None if missing """
+        cmdindex.Probes.count += 1
+        try:
+            st = os.stat(self.path(rel))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def read(self, rel):
+        cmdindex.Probes.count += 1
+        try:
+            return headers.read_prefix(self.path(rel))
+        except (IOError, OSError):
+            return []
+
+
+class ArchiveSource(object):
+    """
+    Access to the commands of a packed sub, without extracting them. Paths
+    are those of the members in the archive, as in commands --json.
+    """
+
+    def __init__(self, root):
+        from . import archive
+        self.archive = archive.Archive.open(root)
+
+    def path(self, rel):
+        return os.path.join(self.archive.path, 'commands', *rel.split('/'))
+
+    def mtime(self, rel):
+        return self.archive.mtime if rel in self.archive.dirs else None
+
+    def listing(self, rel):
+        return dict(self.archive.dirs.get(rel) or {})
+
+    def stat(self, rel):
+        member = self.archive.members.get(cmdindex.join('commands', rel))
+        if member is None:
+            return None
+        return self.archive.mtime, member[2]
+
+    def read(self, rel):
+        return headers.prefix_lines(
+                self.archive.read(cmdindex.join('commands', rel)))
+
+
+class RootCatalog(object):
+    """
+    Cached catalog of a single command root, keyed by container path relative
+    to the root, as in index.CommandIndex.
+    """
+
+    VERSION = 2
+
+    def __init__(self, root, cache_path=None):
+        self.root = root
+        self.cache_path = cache_path
+        if cmdindex.is_archive(root):
+            self.source = ArchiveSource(root)
+        else:
+            self.source = DirectorySource(root)
+        self.dirs = {}
+        """ Maps relative container paths to (mtime, {name: record}), where
+        each record is (kind, mtime, size, parsed headers) and the headers
+        are None for containers, see parse_lines """
+
+        self._visited = set()
+        self._updated = False
+
+    @classmethod
+    def load(cls, root):
+        catalog = cls(root, cache.cache_file('catalog', root))
+        data = cache.read_marshal(catalog.cache_path)
+        if (isinstance(data, dict) and data.get('version') == cls.VERSION
+                and data.get('root') == root
+                and isinstance(data.get('dirs'), dict)):
+            catalog.dirs = data['dirs']
+        return catalog
+
+    def container(self, rel, verify=False):
+        """
+        Return the records of the entries of a container, or None if it does
+        not exist. The container is only scanned again if it changed, or if
+        verify is set, in which case every file in it is stat'ed.
+        """
+        self._visited.add(rel)
+        mtime = self.source.mtime(rel)
+        if mtime is None:
+            return None
+        record = self.dirs.get(rel)
+        if record is not None and record[0] == mtime and not verify:
+            return record[1]
+        return self.scan(rel, mtime, record[1] if record else {})
+
+    def scan(self, rel, mtime, previous):
+        """
+        List a container and read the headers of the files that changed since
+        the previous records of its entries.
+        """
+        entries = {}
+        changed = []
+        for name, kind in self.source.listing(rel).items():
+            if kind == cmdindex.KIND_DIR:
+                entries[name] = (kind, None, None, None)
+                continue
+            if (cmdindex.command_name(name, kind) is None
+                    and name != headers.DOC_FILE):
+                continue
+            st = self.source.stat(cmdindex.join(rel, name))
+            if st is None:
+                continue
+            old = previous.get(name)
+            if old is not None and old[:3] == (kind,) + st:
+                entries[name] = old
+            else:
+                changed.append((name, kind, st))
+
+        parsed = headers.parallel_map(
+                lambda item: parse_lines(self.source.read(
+                    cmdindex.join(rel, item[0]))),
+                changed, headers.scan_workers())
+        now = time.time()
+        trusted = now - mtime >= cmdindex.RACY_WINDOW
+        for (name, kind, st), doc in zip(changed, parsed):
+            entries[name] = (kind, st[0], st[1], doc)
+            # Files modified this recently may change again unnoticed
+            if now - st[0] < headers.RACY_WINDOW:
+                trusted = False
+        self.dirs[rel] = (mtime if trusted else None, entries)
+        self._updated = True
+        return entries
+
+    def save(self):
+        """
+        Write the records of the containers visited back to the cache file,
+        dropping those of containers that are gone, if anything changed.
+        """
+        dirs = dict((rel, record) for rel, record in self.dirs.items()
+                    if rel in self._visited)
+        if self.cache_path is None or not (self._updated or
+                                           len(dirs) != len(self.dirs)):
+            return
+        cache.write_marshal(self.cache_path, {
+            'version': self.VERSION,
+            'root': self.root,
+            'dirs': dirs,
+            })
+        self._updated = False
+
+
+class Catalog(object):
+    """
+    Catalog of all the commands in a list of command roots, in order of
+    precedence, merged as index.LayeredIndex does.
+    """
+
+    def __init__(self, catalogs):
+        self.layers = list(catalogs)
+
+    @classmethod
+    def load(cls, roots):
+        existing = [root for root in roots if os.path.isdir(root) or
+                    cmdindex.is_archive(root) and os.path.isfile(root)]
+        return cls(RootCatalog.load(root) for root in existing)
+
+    def _listings(self, rel, positions, verify):
+        listings = {}
+        for position in positions:
+            entries = self.layers[position].container(rel, verify)
+            if entries is not None:
+                listings[position] = entries
+        return listings
+
+    def walk(self, verify=False):
+        """
+        Generate a dictionary describing each command, every container before
+        the commands in it, sorted by name within each container.
+        """
+        positions = list(range(len(self.layers)))
+        listings = self._listings('', positions, verify)
+        return self._walk('', (), listings, verify)
+
+    def _walk(self, rel, tokens, listings, verify):
+        positions = sorted(listings)
+        kinds, owners = cmdindex.merge_listings(
+                [dict((name, record[0]) for name, record in listings[p].items())
+                 for p in positions])
+        for name, entry, kind in cmdindex.container_commands(kinds):
+            layer = self.layers[positions[owners[entry]]]
+            entry_rel = cmdindex.join(rel, entry)
+            doc = listings[positions[owners[entry]]][entry][3]
+            child_listings = None
+            if kind == cmdindex.KIND_DIR:
+                child_listings = self._listings(entry_rel, [
+                    p for p in positions
+                    if listings[p].get(entry, (None,))[0] == cmdindex.KIND_DIR],
+                    verify)
+                docs = [child_listings[p][headers.DOC_FILE][3]
+                        for p in sorted(child_listings)
+                        if headers.DOC_FILE in child_listings[p]]
+                doc = docs[0] if docs else None
+            summary, usage, env, interpreter = doc or (None, None, [], None)
+            yield {
+                'command': list(tokens + (name,)),
+                'path': layer.source.path(entry_rel),
+                'kind': cmdindex.kind_name(entry, kind),
+                'container': kind == cmdindex.KIND_DIR,
+                'eval': kind == cmdindex.KIND_EXEC and entry != name,
+                'summary': summary,
+                'usage': usage,
+                'env': list(env),
+                'interpreter': interpreter,
+                }
+            if child_listings:
+                for item in self._walk(entry_rel, tokens + (name,),
+                                       child_listings, verify):
+                    yield item
+
+    def save(self):
+        for layer in self.layers:
+            layer.save()
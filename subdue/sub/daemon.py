@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Optional per-user resolver daemon.
+
+The daemon keeps the command index and the environment of a sub in memory and
+resolves command lines sent to it over a Unix domain socket. A driver that
+finds the socket of its sub sends it the command line and only has to exec the
+command with the argv and environment it gets back, skipping the derivation of
+paths, the parsing of driver options and the resolution of the command.
+
+The protocol is a single JSON object per line in each direction. Requests:
+
+    {"op": "resolve", "argv": [...], "shell": "bash", "root": "/path/to/sub",
+     "roots": [...]}
+    {"op": "ping"}
+    {"op": "stop"}
+
+Responses to resolve requests have a "status" of "exec" (the command was found
+and can be run), "error" (with a "message" to exit with) or "fallback", which
+means the driver must handle the command line itself, for instance for
+built-in commands or help. Socket names only carry a checksum of the root of
+the sub, so the daemon declines requests for other roots, and echoes its root
+in its answers for the driver to check. It also declines requests whose
+command roots, which the environment of the driver can change, are not the
+ones it was started with.
+
+Sockets live in a runtime directory that must be private to the user, see
+cache.is_private_dir, and both ends check that the other one runs as the same
+user before trusting it.
+
+The daemon exits on its own after a period with no requests.
+
+The command index of the daemon is kept up to date by a watcher, see watch,
+so resolving a command line takes no filesystem probes at all while nothing
+changes. The daemon also watches the templates of subdue, which are replaced
+when subdue is upgraded, and exits when they change, so that drivers fall
+back to resolving by themselves until a new daemon is started.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import socket
+
+from . import cache
+from . import index as cmdindex
+from . import _main
+
+IDLE_TIMEOUT = 600
+""" Seconds without requests after which the daemon shuts down """
+
+CLIENT_TIMEOUT = 2.0
+""" Seconds a driver waits for the daemon before resolving by itself """
+
+
+def socket_path_for(root):
+    """
+    Return the path of the socket of the daemon for the sub at root.
+    """
+    return cache.runtime_file('resolver', root, 'sock')
+
+
+def template_dir():
+    """
+    Return the directory of the templates of the built-in commands, which
+    changes whenever subdue is installed again.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(
+        _main.builtincmd.__file__)), 'templates')
+
+
+def _read_line(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks)
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def request(root, message, timeout=CLIENT_TIMEOUT):
+    """
+    Send a request to the daemon of the sub at root. Return the response, or
+    None if there is no daemon or it does not answer properly.
+    """
+    path = socket_path_for(root)
+    if not cache.is_private_dir(os.path.dirname(path)):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        if not cache.peer_is_current_user(sock):
+            return None
+        _send(sock, message)
+        return json.loads(_read_line(sock).decode('utf-8'))
+    except (socket.error, socket.timeout, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def parse_driver_options(argv):
+    """
+    Split the driver options the daemon client understands from the command
+    line. Return (shell, eval_fd, args), or None if the command line has to be
+    handled by the full driver.
+    """
+    shell = None
+    eval_fd = None
+    args = list(argv)
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if '=' in option:
+            option, value = option.split('=', 1)
+        elif args and option in ('--shell', '--eval-fd'):
+            value = args.pop(0)
+        else:
+            return None
+        if option == '--shell':
+            shell = value
+        elif option == '--eval-fd' and value.isdigit():
+            eval_fd = int(value)
+        else:
+            return None
+    if not args:
+        return None
+    return shell, eval_fd, args
+
+
+def run_through_daemon(root, argv, **kwargs):
+    """
+    Try running a command line through the daemon of the sub at root. Return
+    False if the daemon could not handle it, in which case the caller must
+    resolve the command line by itself.
+    """
+    options = parse_driver_options(argv)
+    if options is None:
+        return False
+    shell, eval_fd, args = options
+    name = os.path.basename(kwargs.get('driver_path') or sys.argv[0])
+    roots = _main.command_roots_for(
+            root, name,
+            kwargs.get('command_roots') or [os.path.join(root, 'commands')])
+    response = request(root, {'op': 'resolve', 'argv': args, 'shell': shell,
+                              'root': root, 'roots': roots})
+    if response is None or response.get('status') not in ('exec', 'error'):
+        return False
+    if response.get('root') != os.path.abspath(root):
+        # The daemon of another sub whose socket has the same name
+        return False
+    if response['status'] == 'error' and kwargs.get('lookupinpath'):
+        # The command may be an external one, which the daemon does not know
+        return False
+
+    if response['status'] == 'error':
+        if eval_fd is not None:
+            _main.redirect_eval_output(eval_fd, False)
+        sys.exit(response['message'])
+
+    command = _main.Command(response['tokens'], response['path'],
+                            response['is_sh'], False, response['arguments'])
+    if eval_fd is not None:
+        _main.redirect_eval_output(eval_fd, command.found_with_sh)
+
+    env = dict(os.environ)
+    env.update(response['env'])
+    env['PATH'] = ':'.join(_main.normalize_path(response['path_prepend'] +
+            os.environ.get('PATH', os.defpath).split(':')))
+
+    if (kwargs.get('use_memo') and cache.cache_dir() is not None
+            and cmdindex.declares_memo(command.path)):
+        from . import memo
+        status = memo.run(command, env)
+        if status is not None:
+            sys.exit(status)
+
+    api_runner = kwargs.get('command_runner', _main.execvp_runner)
+    command.run_with(api_runner, env=env)
+    return True
+
+
+class ResolverDaemon(object):
+    """
+    Resolve command lines for one sub, keeping everything needed in memory.
+    """
+
+    def __init__(self, paths, idle_timeout=IDLE_TIMEOUT, use_watch=True):
+        self.paths = paths
+        self.idle_timeout = idle_timeout
+        self.socket_path = socket_path_for(paths.root)
+        self.index = cmdindex.load_index(paths.command_roots)
+        self.env = _main.Environment(paths)
+        self.sock = None
+        self.running = False
+        self.use_watch = use_watch
+        self.watcher = None
+
+    def bind(self):
+        """
+        Create the listening socket. Return False if another daemon is
+        already serving this sub.
+        """
+        cache.make_runtime_dir()
+        if os.path.exists(self.socket_path):
+            if request(self.paths.root, {'op': 'ping'}) is not None:
+                return False
+            # Left behind by a daemon that did not exit cleanly
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.sock.listen(64)
+        self.sock.settimeout(self.idle_timeout)
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        """
+        Answer requests until stopped or idle for longer than idle_timeout.
+        """
+        self.running = True
+        if self.use_watch:
+            # Started here, in the detached process, which owns the watches
+            from . import watch
+            self.watcher = watch.Watcher(self.index, [template_dir()])
+        try:
+            while self.running:
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    break
+                if not cache.peer_is_current_user(conn):
+                    conn.close()
+                    continue
+                try:
+                    conn.settimeout(CLIENT_TIMEOUT)
+                    self.handle(conn)
+                except (socket.error, socket.timeout, ValueError):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            if self.watcher is not None:
+                self.watcher.close()
+            self.close()
+
+    def handle(self, conn):
+        message = json.loads(_read_line(conn).decode('utf-8'))
+        op = message.get('op')
+        if op == 'resolve':
+            response = self.resolve(message.get('argv') or [],
+                                    message.get('shell'), message.get('root'),
+                                    message.get('roots'))
+        elif op == 'ping':
+            response = {'status': 'ok', 'pid': os.getpid()}
+        elif op == 'stop':
+            response = {'status': 'ok'}
+            self.running = False
+        else:
+            response = {'status': 'error', 'message': 'unknown request'}
+        _send(conn, response)
+
+    def resolve(self, argv, shell=None, root=None, roots=None):
+        """
+        Resolve a command line, without driver options, into the response
+        sent back to the driver, which carries the root of the sub.
+        """
+        if roots is not None and list(roots) != self.paths.command_roots:
+            response = {'status': 'fallback'}
+        else:
+            response = self._resolve(argv, shell, root)
+        response['root'] = os.path.abspath(self.paths.root)
+        return response
+
+    def _resolve(self, argv, shell, root):
+        if root is not None and (os.path.abspath(root) !=
+                                 os.path.abspath(self.paths.root)):
+            return {'status': 'fallback'}
+        if not argv or argv[0].startswith('-') or _main.builtincmd.is_builtin(argv[0]):
+            return {'status': 'fallback'}
+        if self.watcher is not None and self.watcher.poll():
+            # Subdue was upgraded, this daemon runs the old version
+            self.running = False
+            return {'status': 'fallback'}
+
+        try:
+            command = _main.find_command_path(argv, self.paths, index=self.index)
+        except Exception as e:
+            from . import archive
+            if not isinstance(e, archive.ArchiveError):
+                raise
+            return {'status': 'error',
+                    'message': "{0}: {1}".format(self.paths.name, e)}
+        if not command.found:
+            return {'status': 'error',
+                    'message': _main.not_found_message(
+                        self.paths, command.tokens, self.index)}
+        if command.is_python:
+            # Python function commands run in the driver process
+            return {'status': 'fallback'}
+        if command.is_container:
+            return {'status': 'error',
+                    'message': "{0}: can't run a container `{1}'".format(
+                        self.paths.name, command.command)}
+
+        env = self.env
+        env.shell = shell or ''
+        env.is_eval = 1 if command.found_with_sh else 0
+        env.command = command.command
+        env.path_command = command.path
+        return {
+            'status': 'exec',
+            'tokens': command.tokens,
+            'path': command.path,
+            'is_sh': command.is_sh,
+            'arguments': command.arguments,
+            'env': dict((var.name, var.value) for var in env.vars.values()),
+            'path_prepend': [self.paths.bin, self.paths.lib],
+            }
+
+
+def daemonize():
+    """
+    Detach the current process from its parent and terminal. Return True in
+    the detached process and False in the original one.
+    """
+    pid = os.fork()
+    if pid > 0:
+        os.waitpid(pid, 0)
+        return False
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
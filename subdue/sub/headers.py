@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Extraction of the documentation headers of commands.
+
+Commands document themselves with comment directives: ``# Usage:``,
+``# Summary:`` and ``# Help:``, which must appear within the first
+MAX_LINES lines of the file. Listing a container only needs the usage and
+summary lines, so only a bounded prefix of each file is read for those, and
+the results are kept in a per-sub HeaderCache, keyed by the modification time
+and size of each file, so that listing a large tree again does no I/O on the
+command files at all.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import re
+import time
+import threading
+
+from . import cache
+
+MAX_LINES = 100
+""" Directives must appear within this many lines """
+
+MAX_BYTES = 16384
+""" At most this many bytes are read when looking for the one line headers """
+
+DOC_FILE = 'doc.txt'
+""" File with the documentation of a container """
+
+RACY_WINDOW = 2.0
+""" Files modified this recently are not cached, see index.RACY_WINDOW """
+
+WORKERS_VAR = 'SUBDUE_SCAN_WORKERS'
+""" Environment variable with the number of threads that read headers """
+
+DEFAULT_WORKERS = 8
+
+_DIRECTIVE = re.compile(r'^\s*#\s*(Usage|Summary|Help):(.*)$')
+_COMMENT = re.compile(r'^\s*#(.*)$')
+
+
+def read_prefix(path, max_lines=MAX_LINES, max_bytes=MAX_BYTES):
+    """
+    Return the first lines of a file, reading at most max_bytes from it. A
+    line cut by the byte limit is dropped.
+    """
+    with io.open(path, 'rb') as f:
+        data = f.read(max_bytes + 1)
+    return prefix_lines(data, max_lines, max_bytes)
+
+
+def prefix_lines(data, max_lines=MAX_LINES, max_bytes=MAX_BYTES):
+    """
+    Return the first lines of the contents of a file, as read_prefix does.
+    """
+    lines = data[:max_bytes].split(b'\n')
+    if len(data) > max_bytes:
+        lines.pop()
+    return [line.decode('utf-8', 'replace') for line in lines[:max_lines]]
+
+
+def parse_headers(lines):
+    """
+    Return a dictionary with the usage, summary and long help text found in
+    the given lines. Missing items are None.
+    """
+    headers = {'usage': None, 'summary': None, 'help': None}
+    help_lines = None
+    for number, line in enumerate(lines):
+        if help_lines is not None:
+            match = _COMMENT.match(line)
+            if match is None:
+                break
+            text = match.group(1)
+            help_lines.append(text[1:] if text.startswith(' ') else text)
+            continue
+        if number >= MAX_LINES:
+            break
+        match = _DIRECTIVE.match(line)
+        if match is None:
+            continue
+        key = match.group(1).lower()
+        if key == 'help':
+            help_lines = []
+        elif headers[key] is None:
+            headers[key] = match.group(2).strip()
+
+    if help_lines is not None:
+        help_lines = [line.rstrip() for line in help_lines]
+        while help_lines and not help_lines[-1]:
+            help_lines.pop()
+        while help_lines and not help_lines[0]:
+            help_lines.pop(0)
+        headers['help'] = '\n'.join(help_lines)
+    return headers
+
+
+def read_summary(path):
+    """
+    Return (summary, usage) for a command file, reading only a bounded prefix
+    of it. Unreadable files have neither.
+    """
+    try:
+        headers = parse_headers(read_prefix(path))
+    except (IOError, OSError):
+        return None, None
+    return headers['summary'], headers['usage']
+
+
+def read_help(path):
+    """
+    Return all the headers of a command file. The long help text may extend
+    beyond the bounded prefix, so the file is read for as long as needed.
+    """
+    try:
+        with io.open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return parse_headers(f)
+    except (IOError, OSError):
+        return parse_headers([])
+
+
+def scan_workers():
+    """
+    Return the number of threads to use to read headers, taken from the
+    SUBDUE_SCAN_WORKERS environment variable. A value of 1 or less reads them
+    serially, in the calling thread.
+    """
+    value = os.environ.get(WORKERS_VAR)
+    if not value:
+        return DEFAULT_WORKERS
+    try:
+        return max(int(value), 1)
+    except ValueError:
+        return DEFAULT_WORKERS
+
+
+def parallel_map(function, items, workers):
+    """
+    Return the list of results of calling function on each of the items, using
+    at most the given number of threads. Results are in the order of the
+    items, regardless of the order in which they are computed. If the function
+    raises, the exception is raised again in the calling thread.
+    """
+    items = list(items)
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while not errors:
+            with lock:
+                i = next(pending, None)
+            if i is None:
+                return
+            try:
+                results[i] = function(items[i])
+            except BaseException as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class HeaderCache(object):
+    """
+    Summaries and usage lines of the commands of a sub, keyed by file path and
+    validated against the modification time and size of each file.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.files = {}
+        """ Maps paths to (mtime, size, summary, usage) """
+
+        self._updated = set()
+
+    @classmethod
+    def load(cls, root):
+        """
+        Create the header cache of the sub with the given root, populated from
+        its cache file if there is a valid one.
+        """
+        headers = cls(cache.cache_file('headers', root))
+        data = cache.read_marshal(headers.cache_path)
+        if cls._is_valid_data(data):
+            headers.files = data['files']
+        return headers
+
+    @classmethod
+    def _is_valid_data(cls, data):
+        return (isinstance(data, dict)
+                and data.get('version') == cls.VERSION
+                and isinstance(data.get('files'), dict))
+
+    def summary(self, path):
+        """
+        Return (summary, usage) for a command file, only reading the file if
+        it changed since it was cached.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, None
+        record = self.files.get(path)
+        if (record is not None and record[0] == st.st_mtime
+                and record[1] == st.st_size):
+            return record[2], record[3]
+
+        summary, usage = read_summary(path)
+        if time.time() - st.st_mtime >= RACY_WINDOW:
+            self.files[path] = (st.st_mtime, st.st_size, summary, usage)
+            self._updated.add(path)
+        return summary, usage
+
+    def summaries(self, paths, workers=None):
+        """
+        Return the (summary, usage) pairs of several command files, in the
+        same order. Files that are not cached are read concurrently, see
+        scan_workers for the default number of threads.
+        """
+        if workers is None:
+            workers = scan_workers()
+        return parallel_map(self.summary, paths, workers)
+
+    def save(self):
+        """
+        Write the cache back to its file if anything was read, keeping the
+        records written by concurrent invocations in the meantime.
+        """
+        if not self._updated or self.cache_path is None:
+            return
+        files = {}
+        data = cache.read_marshal(self.cache_path)
+        if self._is_valid_data(data):
+            files = data['files']
+        for path in self._updated:
+            files[path] = self.files[path]
+        cache.write_marshal(self.cache_path, {
+            'version': self.VERSION,
+            'files': files,
+            })
+        self._updated.clear()
@@ -0,0 +1,687 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent index of the commands tree of a sub.
+
+The index stores, for every container (directory) under the commands
+directory, the modification time of the directory and the kind of each of its
+entries: container, executable, Python function command or plain file. With a
+warm index, resolving a command line costs one read of the index file plus one
+stat per container level, instead of several filesystem probes per token.
+
+A container whose modification time does not match the one in the index is
+considered stale. Lookups that hit a stale container give up, so that the
+caller can fall back to probing the filesystem, and the stale containers are
+scanned again and written back to the index with refresh().
+
+Changing the executable bit of a command does not change the modification
+time of its container, so the index cannot tell that a command is missing:
+lookups that miss fall back to the filesystem too, and a command that turns
+out not to be executable when run has its container scanned again.
+
+Long running processes can attach a watcher to an index, see watch, which
+drops the records of containers as soon as they change. The records of
+watched containers are trusted without a stat.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import stat
+import time
+
+from . import cache
+
+KIND_DIR = 'd'
+KIND_EXEC = 'x'
+KIND_FILE = 'f'
+KIND_PYTHON = 'p'
+
+EVAL_PREFIX = 'sh-'
+
+PYTHON_SUFFIX = '.py'
+""" Suffix of Python function commands, see pycommand """
+
+PYTHON_MARKER = b'subdue: main'
+""" Comment that makes a non-executable .py file a Python function command """
+
+MEMO_HEADER = b'Cache-TTL:'
+""" Header of commands whose output is memoized, see the memo module """
+
+HEADER_BYTES = 16384
+""" Headers must appear within this many bytes, as in memo.MAX_BYTES """
+
+ARCHIVE_SUFFIX = '.zip'
+""" Command roots with this suffix are packed subs, see archive """
+
+# Directories modified this recently are not trusted, since further changes
+# within the timestamp granularity of the filesystem would go unnoticed.
+RACY_WINDOW = 2.0
+
+_EXEC_BITS = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+
+class Probes(object):
+    """
+    Count of the filesystem probes (stat, access or directory listing calls)
+    made to resolve commands, for tracing and tests.
+    """
+    count = 0
+
+_scandir = getattr(os, 'scandir', None)
+
+
+def _kind_from_mode(mode):
+    if stat.S_ISDIR(mode):
+        return KIND_DIR
+    if mode & _EXEC_BITS:
+        return KIND_EXEC
+    return KIND_FILE
+
+
+def iter_dir(path):
+    """
+    Generate (name, kind) for each entry of a directory, as they are listed.
+    Containers are told apart by the file type that scandir reports, when
+    available, without a stat; any other entry takes a stat to tell whether
+    it is executable. Entries that cannot be stat'ed, like dangling symlinks,
+    are skipped. Plain .py files are read to tell Python function commands
+    apart, see declares_main.
+    """
+    if _scandir is not None:
+        for entry in _scandir(path):
+            try:
+                if entry.is_dir():
+                    kind = KIND_DIR
+                else:
+                    kind = _kind_from_mode(entry.stat().st_mode)
+            except OSError:
+                continue
+            yield entry.name, _python_kind(path, entry.name, kind)
+    else:
+        for name in os.listdir(path):
+            try:
+                kind = _kind_from_mode(os.stat(os.path.join(path, name)).st_mode)
+            except OSError:
+                continue
+            yield name, _python_kind(path, name, kind)
+
+
+def _python_kind(path, name, kind):
+    if (kind == KIND_FILE and name.endswith(PYTHON_SUFFIX)
+            and declares_main(os.path.join(path, name))):
+        return KIND_PYTHON
+    return kind
+
+
+def list_dir(path):
+    """
+    Return the entries of a directory as a dictionary mapping each name to its
+    scandir entry, or to None where scandir is not available, without finding
+    out their kinds. Return an empty dictionary if the directory cannot be
+    listed.
+    """
+    Probes.count += 1
+    try:
+        if _scandir is not None:
+            return dict((entry.name, entry) for entry in _scandir(path))
+        return dict.fromkeys(os.listdir(path))
+    except OSError:
+        return {}
+
+
+def scan_dir(path):
+    """
+    List a directory and return a dictionary mapping each entry name to its
+    kind. See iter_dir.
+    """
+    return dict(iter_dir(path))
+
+
+def declares_memo(path):
+    """
+    Quickly tell whether a command may declare a Cache-TTL header, without
+    importing the memo module, which parses the headers properly.
+    """
+    Probes.count += 1
+    try:
+        with open(path, 'rb') as f:
+            return MEMO_HEADER in f.read(HEADER_BYTES)
+    except (IOError, OSError):
+        return False
+
+
+def declares_main(path):
+    """
+    Tell whether a Python file opts in to be run as a Python function command,
+    with a '# subdue: main' comment among its headers.
+    """
+    Probes.count += 1
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(HEADER_BYTES)
+    except (IOError, OSError):
+        return False
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith(b'#') and line[1:].strip() == PYTHON_MARKER:
+            return True
+    return False
+
+
+def command_name(entry, kind):
+    """
+    Return the name used to run an entry of a container, or None if the entry
+    is not a command: eval commands lose their sh- prefix and Python function
+    commands their .py suffix.
+    """
+    if kind == KIND_DIR:
+        return entry
+    if kind == KIND_EXEC:
+        if entry.startswith(EVAL_PREFIX):
+            return entry[len(EVAL_PREFIX):]
+        return entry
+    if kind == KIND_PYTHON and len(entry) > len(PYTHON_SUFFIX):
+        return entry[:-len(PYTHON_SUFFIX)]
+    return None
+
+
+def kind_name(entry, kind):
+    """
+    Return how a command is described to users and tools: container, eval,
+    python (a Python function command) or command.
+    """
+    if kind == KIND_DIR:
+        return 'container'
+    if kind == KIND_PYTHON:
+        return 'python'
+    if entry.startswith(EVAL_PREFIX):
+        return 'eval'
+    return 'command'
+
+
+def container_commands(entries):
+    """
+    Return a sorted list of (name, entry, kind) for the commands in a container
+    listing. When several entries have the same name, the one that a command
+    line resolves to is kept: the entry named exactly like the command, then
+    the eval command, then the Python function command.
+    """
+    commands = {}
+    for entry, kind in entries.items():
+        name = command_name(entry, kind)
+        if name is None:
+            continue
+        rank = command_rank(name, entry, kind)
+        if name not in commands or rank < commands[name][0]:
+            commands[name] = (rank, entry, kind)
+    return [(name,) + commands[name][1:] for name in sorted(commands)]
+
+
+def command_rank(name, entry, kind):
+    """
+    Return the precedence of an entry among those of a container with the same
+    command name, lowest first, see container_commands.
+    """
+    return 0 if name == entry else 1 if kind == KIND_EXEC else 2
+
+
+def unique_commands(commands):
+    """
+    Filter (name, entry, kind, ...) tuples for the entries of a container, as
+    they are listed, keeping for each name the entry that a command line
+    resolves to, as container_commands does. Entries named like their command
+    always win, so they are generated right away; the others are generated
+    once the listing is over. Entries with no name are dropped.
+    """
+    generated = set()
+    pending = {}
+    for item in commands:
+        name, entry, kind = item[:3]
+        if name is None or name in generated:
+            continue
+        rank = command_rank(name, entry, kind)
+        if rank == 0:
+            generated.add(name)
+            pending.pop(name, None)
+            yield item
+        elif name not in pending or rank < pending[name][0]:
+            pending[name] = (rank, item)
+    for rank, item in pending.values():
+        yield item
+
+
+_PLAIN_RANK = {KIND_FILE: 0, KIND_PYTHON: 1}
+
+
+def merge_listings(listings):
+    """
+    Merge the listings of the same container in several command roots, given
+    in order of precedence. Return (entries, owners), where owners maps each
+    entry to the position of the listing it comes from. The first container or
+    executable with a given name wins; Python function commands only show
+    through when no root has a container or executable with their name, and
+    plain files when no root has anything else with their name.
+
+    Commands are resolved in one root after the other, trying all the variants
+    of a name in each, see command_name. So the first root that has a command
+    with a given name hides the entries for that name in later roots, even if
+    they are variants that would win in the same root, like foo over sh-foo.
+    """
+    entries = {}
+    owners = {}
+    claims = {}
+    for position, listing in enumerate(listings):
+        for name, kind in listing.items():
+            command = command_name(name, kind)
+            if command is not None:
+                claims.setdefault(command, position)
+            current = entries.get(name)
+            if current is None or (current in _PLAIN_RANK and
+                                   _PLAIN_RANK.get(kind, 2) > _PLAIN_RANK[current]):
+                entries[name] = kind
+                owners[name] = position
+    for name, kind in list(entries.items()):
+        command = command_name(name, kind)
+        if command is not None and claims[command] < owners[name]:
+            del entries[name]
+            del owners[name]
+    return entries, owners
+
+
+def join(rel, name):
+    """
+    Join a relative container path in the index with an entry name
+    """
+    return rel + '/' + name if rel else name
+
+
+def _remove_subtree(dirs, rel):
+    """
+    Remove a container and everything under it from a dictionary of records.
+    Return True if anything was removed.
+    """
+    prefix = rel + '/'
+    removed = False
+    for key in list(dirs):
+        if not rel or key == rel or key.startswith(prefix):
+            del dirs[key]
+            removed = True
+    return removed
+
+
+class CommandIndex(object):
+    """
+    Cached listing of a commands tree, keyed by container path relative to the
+    root of the tree, using '/' as separator and '' for the root itself.
+    """
+
+    VERSION = 4
+
+    def __init__(self, root, cache_path=None):
+        self.root = root
+        self.cache_path = cache_path
+        self.dirs = {}
+        """ Maps relative container paths to (mtime, {name: kind}) """
+
+        self.stale = set()
+        """ Containers found to be out of date during lookups """
+
+        self.watched = None
+        """ Containers whose records are kept up to date by a watcher, if
+        one is attached """
+
+        self.fresh = set()
+        """ Containers scanned since the watcher last looked at the index """
+
+        self._scanned = set()
+
+    @classmethod
+    def load(cls, root):
+        """
+        Create an index for the given commands directory, populated from the
+        cache file if there is a valid one.
+        """
+        index = cls(root, cache.cache_file('index', root))
+        data = cache.read_marshal(index.cache_path)
+        if index._is_valid_data(data):
+            index.dirs = data['dirs']
+        return index
+
+    def _is_valid_data(self, data):
+        return (isinstance(data, dict)
+                and data.get('version') == self.VERSION
+                and data.get('root') == self.root
+                and isinstance(data.get('dirs'), dict))
+
+    def path_for(self, rel):
+        """
+        Return the filesystem path of a relative path in the index
+        """
+        if not rel:
+            return self.root
+        return os.path.join(self.root, *rel.split('/'))
+
+    def member(self, rel):
+        """
+        Return (archive, member name) for an entry of a packed sub, to read it
+        without extracting it, or None for an entry in a directory, as here.
+        """
+        return None
+
+    def listing(self, rel):
+        """
+        Return the entries of a container if the index is up to date for it.
+        Otherwise, remember the container as stale and return None.
+        """
+        record = self.dirs.get(rel)
+        if record is not None and self.watched and rel in self.watched:
+            return record[1]
+        if record is not None and record[0] is not None:
+            Probes.count += 1
+            try:
+                if os.stat(self.path_for(rel)).st_mtime == record[0]:
+                    return record[1]
+            except OSError:
+                pass
+        self.stale.add(rel)
+        return None
+
+    def entries(self, rel):
+        """
+        Return the entries of a container, scanning it again if the index is
+        out of date for it. Return None if the container does not exist.
+        """
+        entries = self.listing(rel)
+        if entries is None:
+            entries = self.scan(rel)
+            self.stale.discard(rel)
+        return entries
+
+    def scan(self, rel):
+        """
+        Read a container from the filesystem and update the index with it.
+        """
+        path = self.path_for(rel)
+        Probes.count += 2
+        try:
+            # Stat before listing, so that a change that happens in between
+            # leaves an older mtime behind and is detected on the next lookup
+            mtime = os.stat(path).st_mtime
+            entries = scan_dir(path)
+        except OSError:
+            self._forget(rel)
+            return None
+        if time.time() - mtime < RACY_WINDOW:
+            mtime = None
+        self.dirs[rel] = (mtime, entries)
+        self._scanned.add(rel)
+        if self.watched is not None:
+            self.fresh.add(rel)
+        return entries
+
+    def declares_memo(self, rel):
+        """
+        Tell whether the command at a relative path may declare a Cache-TTL
+        header. Commands are read for it only when asked, never when their
+        container is scanned.
+        """
+        return declares_memo(self.path_for(rel))
+
+    def _forget(self, rel):
+        if _remove_subtree(self.dirs, rel):
+            self._scanned.add(rel)
+
+    def invalidate(self, rel, subtree=False):
+        """
+        Drop the record of a container, or of a container and all the
+        containers under it, so that it is scanned again when next needed.
+        """
+        if subtree:
+            _remove_subtree(self.dirs, rel)
+        else:
+            self.dirs.pop(rel, None)
+        if self.watched:
+            if subtree:
+                prefix = rel + '/'
+                self.watched.difference_update(
+                        [key for key in self.watched
+                         if not rel or key == rel or key.startswith(prefix)])
+            else:
+                self.watched.discard(rel)
+
+    def walk(self, rel=''):
+        """
+        Generate (relative path, entries) for a container and all the
+        containers under it, refreshing the index as needed.
+        """
+        entries = self.entries(rel)
+        if entries is None:
+            return
+        yield rel, entries
+        for name, kind in entries.items():
+            if kind == KIND_DIR:
+                for item in self.walk(join(rel, name)):
+                    yield item
+
+    def refresh(self, containers=()):
+        """
+        Scan all containers found stale during lookups, as well as any of the
+        given containers that is out of date, and save the index.
+        """
+        for rel in containers:
+            if rel not in self.stale:
+                self.listing(rel)
+        for rel in self.stale:
+            self.scan(rel)
+        self.stale.clear()
+        self.save()
+
+    def save(self):
+        """
+        Write the index back to its cache file if anything was scanned. Records
+        written by concurrent invocations in the meantime are kept, unless
+        this invocation scanned the same containers.
+        """
+        if not self._scanned or self.cache_path is None:
+            return
+        dirs = {}
+        data = cache.read_marshal(self.cache_path)
+        if self._is_valid_data(data):
+            dirs = data['dirs']
+        for rel in self._scanned:
+            if rel in self.dirs:
+                dirs[rel] = self.dirs[rel]
+            else:
+                _remove_subtree(dirs, rel)
+        for key, record in self.dirs.items():
+            dirs.setdefault(key, record)
+        cache.write_marshal(self.cache_path, {
+            'version': self.VERSION,
+            'root': self.root,
+            'dirs': dirs,
+            })
+        self._scanned.clear()
+
+
+class LayeredIndex(object):
+    """
+    Merged view of the indexes of several command roots, in order of
+    precedence, with the same interface as CommandIndex for lookups.
+
+    The merged listing of a container only involves the roots where the
+    container exists, which are known from the merged listing of its parent,
+    so a lookup costs one stat per container level and per root that has that
+    container, not per root. Nothing is merged ahead of time across calls, so
+    long running processes like the resolver daemon always see fresh data.
+    """
+
+    def __init__(self, indexes):
+        self.layers = list(indexes)
+        self.root = self.layers[0].root
+        self._merged = {}
+        """ Maps relative container paths to their last merged listing """
+
+    @classmethod
+    def load(cls, roots):
+        return cls(load_root_index(root) for root in roots)
+
+    @property
+    def stale(self):
+        return set().union(*(layer.stale for layer in self.layers))
+
+    def _merge(self, rel, scan):
+        """
+        Return (entries, owners, positions) for a container, where positions
+        are the roots that have it, or None if one of them is out of date and
+        scan is False.
+        """
+        if not rel:
+            positions = list(range(len(self.layers)))
+        else:
+            # Lookups go down from the root, so the parent has just been
+            # merged, unless the container is looked up directly
+            parent, _, name = rel.rpartition('/')
+            record = self._merged.get(parent) or self._merge(parent, scan)
+            if record is None:
+                return None
+            entries, _, parent_positions, listings = record
+            if entries.get(name) != KIND_DIR:
+                return {}, {}, [], {}
+            positions = [position for position in parent_positions
+                         if listings[position].get(name) == KIND_DIR]
+        listings = {}
+        for position in positions:
+            layer = self.layers[position]
+            listing = layer.entries(rel) if scan else layer.listing(rel)
+            if listing is None:
+                if not scan:
+                    return None
+                listing = {}
+            listings[position] = listing
+        entries, owners = merge_listings([listings[p] for p in positions])
+        owners = dict((name, positions[i]) for name, i in owners.items())
+        record = (entries, owners, positions, listings)
+        self._merged[rel] = record
+        return record
+
+    def listing(self, rel):
+        """
+        Return the merged entries of a container if the indexes of all the
+        roots that have it are up to date, None otherwise.
+        """
+        record = self._merge(rel, False)
+        if record is None or not record[2]:
+            return None
+        return record[0]
+
+    def entries(self, rel):
+        """
+        Return the merged entries of a container, scanning it again in the
+        roots where it is out of date. Return None if no root has it.
+        """
+        record = self._merge(rel, True)
+        if not record[2]:
+            return None
+        return record[0]
+
+    def _layer_for(self, rel):
+        """
+        Return the index of the root an entry comes from. For containers, that
+        is the first root that has them.
+        """
+        if not rel:
+            return self.layers[0]
+        parent, _, name = rel.rpartition('/')
+        record = self._merged.get(parent)
+        if record is None:
+            record = self._merge(parent, True)
+        position = record[1].get(name)
+        if position is None:
+            position = record[2][0] if record[2] else 0
+        return self.layers[position]
+
+    def path_for(self, rel):
+        """
+        Return the filesystem path of an entry in the root it comes from. For
+        containers, that is the first root that has them.
+        """
+        if not rel:
+            return self.root
+        return self._layer_for(rel).path_for(rel)
+
+    def member(self, rel):
+        """ See CommandIndex.member, for the root the entry comes from """
+        return self._layer_for(rel).member(rel)
+
+    def declares_memo(self, rel):
+        """ See CommandIndex.declares_memo, for the root the command is in """
+        return self._layer_for(rel).declares_memo(rel)
+
+    def invalidate(self, rel, subtree=False):
+        """ See CommandIndex.invalidate, for every root """
+        for layer in self.layers:
+            layer.invalidate(rel, subtree)
+        self._merged.clear()
+
+    def walk(self, rel=''):
+        entries = self.entries(rel)
+        if entries is None:
+            return
+        yield rel, entries
+        for name, kind in entries.items():
+            if kind == KIND_DIR:
+                for item in self.walk(join(rel, name)):
+                    yield item
+
+    def refresh(self, containers=()):
+        for layer in self.layers:
+            layer.refresh(containers)
+        self._merged.clear()
+
+    def save(self):
+        for layer in self.layers:
+            layer.save()
+
+
+def is_archive(root):
+    """ True if a command root is a packed sub, judging by its name alone """
+    return root.endswith(ARCHIVE_SUFFIX)
+
+
+def load_root_index(root):
+    """
+    Return the index of a single command root: a CommandIndex for a commands
+    directory, or an archive.ArchiveIndex for a packed sub.
+    """
+    if is_archive(root):
+        from . import archive
+        return archive.ArchiveIndex.load(root)
+    return CommandIndex.load(root)
+
+
+def load_index(roots):
+    """
+    Return the index of a list of command roots, in order of precedence: the
+    index of the root if there is only one, a LayeredIndex over those that
+    exist otherwise.
+    """
+    if len(roots) == 1:
+        return load_root_index(roots[0])
+    existing = [root for root in roots
+                if os.path.isdir(root) or is_archive(root) and os.path.isfile(root)]
+    if len(existing) == 1:
+        return load_root_index(existing[0])
+    return LayeredIndex.load(existing or roots[:1])
+
+
+def open_index(root):
+    """
+    Return the command index for a commands directory, or a list of them, or
+    None if on-disk caches are disabled. Packed subs can only be read through
+    their index, so they always have one.
+    """
+    roots = root if isinstance(root, (list, tuple)) else [root]
+    if cache.cache_dir() is None and not any(is_archive(r) for r in roots):
+        return None
+    return load_index(roots)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Memoization of the output of idempotent commands.
+
+A command that only queries something can declare, among its headers, for how
+long its output stays valid:
+
+    # Cache-TTL: 300
+    # Cache-Env: REGION PROFILE
+
+The driver then keeps the standard output and the exit status of each run,
+keyed by the path of the command, its modification time and size, its
+arguments and the values of the environment variables listed in Cache-Env.
+Runs with the same key within the TTL are served from the cache without
+running the command. The standard error and input are never cached.
+
+Entries are files in the memo directory of the cache. Serving an entry touches
+it, and after storing a new entry the least recently used ones are evicted
+until the directory fits in SUBDUE_MEMO_SIZE bytes.
+
+The driver only imports this module for commands that have a Cache-TTL header,
+which it looks for in a bounded read of each command about to run, see
+index.declares_memo.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import signal
+import subprocess
+import time
+import hashlib
+
+from . import cache
+
+TTL_HEADER = 'Cache-TTL:'
+""" Header that enables memoization """
+
+ENV_HEADER = 'Cache-Env:'
+""" Header with the environment variables that are part of the key """
+
+MAX_BYTES = 16384
+""" Headers must appear within this many bytes, as in headers.MAX_BYTES """
+
+SIZE_VAR = 'SUBDUE_MEMO_SIZE'
+""" Environment variable with the size limit of the memo cache, in bytes """
+
+DEFAULT_SIZE = 32 * 1024 * 1024
+
+
+def memo_dir():
+    """ Return the directory of the memo cache, or None if caching is off """
+    directory = cache.cache_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, 'memo')
+
+
+def size_limit():
+    try:
+        return max(int(os.environ.get(SIZE_VAR, DEFAULT_SIZE)), 0)
+    except ValueError:
+        return DEFAULT_SIZE
+
+
+def read_policy(path):
+    """
+    Return (ttl, environment variable names) from the headers of a command, or
+    None if it has no valid Cache-TTL header.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(MAX_BYTES)
+    except (IOError, OSError):
+        return None
+    ttl = None
+    names = []
+    for line in data.decode('utf-8', 'replace').splitlines():
+        text = line.strip()
+        if not text.startswith('#'):
+            continue
+        text = text[1:].strip()
+        if text.startswith(TTL_HEADER):
+            try:
+                ttl = float(text[len(TTL_HEADER):])
+            except ValueError:
+                return None
+        elif text.startswith(ENV_HEADER):
+            names.extend(text[len(ENV_HEADER):].split())
+    if ttl is None or ttl <= 0:
+        return None
+    return ttl, sorted(set(names))
+
+
+def memo_key(command, env, names):
+    """
+    Return the key of a run of a command with the given environment
+    """
+    st = os.stat(command.path)
+    parts = [command.path, repr(st.st_mtime), repr(st.st_size)]
+    parts.extend(command.arguments)
+    parts.extend('{0}={1}'.format(name, env.get(name)) for name in names)
+    data = '\0'.join(parts).encode('utf-8', 'backslashreplace')
+    return hashlib.sha1(data).hexdigest()
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def run(command, env, now=None):
+    """
+    Run a command through the memo cache. Return its exit status, or None if
+    the command does not declare a TTL or caching is disabled, in which case
+    the caller must run it.
+    """
+    policy = read_policy(command.path)
+    directory = memo_dir()
+    if policy is None or directory is None:
+        return None
+    ttl, names = policy
+    if now is None:
+        now = time.time()
+    path = os.path.join(directory, memo_key(command, env, names) + '.marshal')
+
+    entry = cache.read_marshal(path)
+    if entry is not None and 0 <= now - entry[0] < ttl:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        write_all(1, entry[2])
+        return entry[1]
+
+    status, output = tee([command.path] + command.arguments, env)
+    if status < 0:
+        # Killed by a signal, the output is probably incomplete
+        return 128 - status
+    limit = size_limit()
+    if len(output) <= limit and cache.write_marshal(path, (now, status, output)):
+        evict(directory, limit)
+    return status
+
+
+def tee(args, env):
+    """
+    Run a command, copying its standard output to ours as it is produced.
+    Return (return code, output).
+
+    Interrupts from the terminal reach the command too, which decides what to
+    do with them, so they are ignored here while it runs, as a shell does.
+    """
+    proc = subprocess.Popen(args, env=env, stdout=subprocess.PIPE)
+    try:
+        previous = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    except ValueError:
+        # Not in the main thread, where signals are handled
+        previous = None
+    try:
+        chunks = []
+        fd = proc.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            write_all(1, chunk)
+            chunks.append(chunk)
+        proc.stdout.close()
+        return proc.wait(), b''.join(chunks)
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGINT, previous)
+
+
+def evict(directory, limit):
+    """
+    Remove the least recently used entries until the memo cache takes at most
+    limit bytes.
+    """
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
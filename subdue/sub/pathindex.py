@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent index of the external commands of a sub found on PATH.
+
+With the lookupinpath option, a command line whose first token is not a
+command of the sub runs the executable called <sub name>-<token> found on
+PATH instead, the way git runs git-<command>. To avoid listing every PATH
+directory on each miss, the index keeps, for each directory, its modification
+time and the names of the executables in it that start with <sub name>-.
+
+A lookup costs one stat per PATH directory, to check that its record is
+still valid, plus a dictionary lookup. Only directories that changed since
+they were indexed are listed again, and only the entries with the prefix are
+checked to be executables, since PATH directories like /usr/bin are large. As
+with the command index, directories modified within the last RACY_WINDOW
+seconds are not trusted.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import time
+
+from . import cache
+from . import index as cmdindex
+
+
+class PathIndex(object):
+    """
+    Executables starting with a given prefix in the directories of PATH
+    """
+
+    VERSION = 1
+
+    def __init__(self, prefix, cache_path):
+        self.prefix = prefix
+        self.cache_path = cache_path
+        self.dirs = {}
+        self._scanned = set()
+
+    @classmethod
+    def load(cls, prefix):
+        """
+        Create an index for executables whose name starts with prefix,
+        populated from the cache file if there is a valid one.
+        """
+        index = cls(prefix, cache.cache_file('pathindex', prefix))
+        data = cache.read_marshal(index.cache_path)
+        if (isinstance(data, dict) and data.get('version') == cls.VERSION
+                and data.get('prefix') == prefix
+                and isinstance(data.get('dirs'), dict)):
+            index.dirs = data['dirs']
+        return index
+
+    def names(self, directory):
+        """
+        Return the names of the matching executables in a directory, listing
+        it again if its record is out of date.
+        """
+        cmdindex.Probes.count += 1
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return ()
+        record = self.dirs.get(directory)
+        if record is not None and record[0] == mtime:
+            return record[1]
+
+        cmdindex.Probes.count += 1
+        try:
+            candidates = [name for name in os.listdir(directory)
+                          if name.startswith(self.prefix)]
+        except OSError:
+            return ()
+        names = []
+        for name in sorted(candidates):
+            cmdindex.Probes.count += 1
+            path = os.path.join(directory, name)
+            if os.access(path, os.X_OK) and not os.path.isdir(path):
+                names.append(name)
+        if time.time() - mtime < cmdindex.RACY_WINDOW:
+            mtime = None
+        self.dirs[directory] = (mtime, names)
+        self._scanned.add(directory)
+        return names
+
+    def find(self, name, path):
+        """
+        Return the path of the executable <prefix><name> that comes first in
+        the given PATH string, or None.
+        """
+        command = self.prefix + name
+        for directory in path.split(os.pathsep):
+            if directory and command in self.names(directory):
+                return os.path.join(directory, command)
+        return None
+
+    def save(self):
+        """
+        Write the index back to its cache file if any directory was listed.
+        Records written by concurrent invocations for other directories are
+        kept.
+        """
+        if not self._scanned or self.cache_path is None:
+            return
+        dirs = {}
+        data = cache.read_marshal(self.cache_path)
+        if isinstance(data, dict) and data.get('version') == self.VERSION:
+            dirs = data.get('dirs') or {}
+        for directory in self._scanned:
+            dirs[directory] = self.dirs[directory]
+        cache.write_marshal(self.cache_path, {
+            'version': self.VERSION,
+            'prefix': self.prefix,
+            'dirs': dirs,
+            })
+        self._scanned.clear()
+
+
+def find_external_command(argv, sub_name, path):
+    """
+    Look for the external command for the first token of a command line in
+    the directories of the given PATH string. Return a Command for it, or None
+    if there is none.
+    """
+    from ._main import Command
+    token = argv[0]
+    if not token or token.startswith('-') or os.sep in token:
+        return None
+    index = PathIndex.load(sub_name + '-')
+    try:
+        command_path = index.find(token, path)
+    finally:
+        index.save()
+    if command_path is None:
+        return None
+    return Command([token], command_path, False, False, list(argv[1:]))
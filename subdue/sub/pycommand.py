@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Python function commands.
+
+A file called <name>.py in a container of a sub defines the command <name>,
+which is run inside the driver process instead of in a new interpreter, when
+it is not executable and opts in with a '# subdue: main' comment among its
+headers, see index.declares_main. Other .py files, like helper modules and
+scripts, are never imported. The module must define a function main(argv,
+env), which gets the arguments of the command and its environment, and
+returns its exit status (None means 0).
+
+Only the module of the command being run is imported. The environment of the
+driver process is replaced with the one of the command before importing it,
+so the _SUB_* variables are available in os.environ as for any other
+command, and sys.argv is set as if the module had been run as a script.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+
+MODULE_NAME = '_subdue_command'
+
+
+def load_module(path):
+    """
+    Import the Python file at path as a module, without adding it to
+    sys.modules under its file name.
+    """
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source(MODULE_NAME, path)
+    spec = spec_from_file_location(MODULE_NAME, path)
+    module = module_from_spec(spec)
+    sys.modules[MODULE_NAME] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_python_command(args, env=None):
+    """
+    Command runner for Python function commands. args[0] is the path to the
+    module and the rest are the arguments of the command. Return the exit
+    status of the command.
+    """
+    path = args[0]
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(env)
+
+    # Compiled drivers run with -S, but the command may need site packages
+    if sys.flags.no_site:
+        import site
+        site.main()
+
+    sys.argv = list(args)
+    sys.path.insert(0, os.path.dirname(path))
+    module = load_module(path)
+    main = getattr(module, 'main', None)
+    if not callable(main):
+        sys.exit("{0}: no main(argv, env) function".format(path))
+    status = main(list(args[1:]), dict(os.environ))
+    return 0 if status is None else status
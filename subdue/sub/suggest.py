@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Suggestions of similar commands for command lines that do not resolve.
+
+When a token is not found, similar commands are suggested, first those in the
+container where it was looked up, then those anywhere else in the tree. They
+are found through a trigram index of the names of all commands: only names
+that share enough trigrams with the token are considered, and only the best of
+those are compared with it by edit distance, so a typo in a very large tree
+does not cost a comparison with every command.
+
+The trigram index is kept in the cache, along with a signature of the records
+of the command index it was built from. It is reused as long as the command
+index has the same records, without walking the tree: the containers along
+the command line that failed have just been brought up to date by the lookup,
+and a change anywhere else shows up in the suggestions once the command index
+scans that container again. With caches disabled, only the commands in the
+container where the lookup failed are suggested, so that a typo never walks
+the whole tree.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import heapq
+import zlib
+
+from . import cache
+from . import index as cmdindex
+
+MAX_SUGGESTIONS = 5
+
+CANDIDATES = 30
+""" How many of the best trigram matches are compared by edit distance """
+
+
+def grams(word):
+    """ Return the set of trigrams of a word, with its boundaries marked """
+    padded = '^' + word.lower() + '$'
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def distance(a, b):
+    """
+    Return the edit distance between two strings, counting the swap of two
+    adjacent characters as a single edit.
+    """
+    a = a.lower()
+    b = b.lower()
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + cost)
+            if (previous2 is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+
+class GramIndex(object):
+    """
+    Trigram index of the names of all the commands of a tree. Each name is
+    indexed once, along with the containers that have a command with it.
+    """
+
+    VERSION = 1
+
+    def __init__(self, names, containers, postings=None):
+        self.names = names
+        self.containers = containers
+        if postings is None:
+            postings = {}
+            for position, name in enumerate(names):
+                for gram in grams(name):
+                    postings.setdefault(gram, []).append(position)
+        self.postings = postings
+
+    @classmethod
+    def build(cls, walked):
+        """
+        Create the index from (relative path, entries) pairs of containers
+        """
+        positions = {}
+        names = []
+        containers = []
+        for rel, entries in walked:
+            for name, _, _ in cmdindex.container_commands(entries):
+                position = positions.get(name)
+                if position is None:
+                    position = positions[name] = len(names)
+                    names.append(name)
+                    containers.append([])
+                containers[position].append(rel)
+        return cls(names, containers)
+
+    @classmethod
+    def load(cls, index):
+        """
+        Return the trigram index of the tree in a command index, reusing the
+        cached one while the records of the command index are the same.
+        Otherwise the tree is walked, which brings the command index up to
+        date, and the trigram index is built again.
+        """
+        layers = getattr(index, 'layers', [index])
+        path = cache.cache_file('suggest', '\0'.join(
+            layer.root for layer in layers))
+        data = cache.read_marshal(path)
+        if (isinstance(data, dict)
+                and data.get('signature') == cls.signature(layers)):
+            return cls(data['names'], data['containers'], data['postings'])
+
+        gram_index = cls.build(index.walk())
+        cache.write_marshal(path, {
+            'signature': cls.signature(layers),
+            'names': gram_index.names,
+            'containers': gram_index.containers,
+            'postings': gram_index.postings,
+            })
+        return gram_index
+
+    @classmethod
+    def signature(cls, layers):
+        """
+        Return the signature of the records of the indexes of some command
+        roots. Records too recent to have a trusted modification time are
+        signed by their entries.
+        """
+        signature = [cls.VERSION]
+        for layer in layers:
+            for rel in sorted(layer.dirs):
+                mtime, entries = layer.dirs[rel][:2]
+                if mtime is None:
+                    mtime = sorted(entries.items())
+                signature.append((layer.root, rel, mtime))
+        return zlib.crc32(repr(signature).encode('utf-8')) & 0xffffffff
+
+    def search(self, token):
+        """
+        Return the commands, as tuples of tokens, whose last token is close to
+        the given one, the closest first.
+        """
+        token_grams = grams(token)
+        counts = {}
+        for gram in token_grams:
+            for position in self.postings.get(gram, ()):
+                counts[position] = counts.get(position, 0) + 1
+
+        # Each edit changes at most three trigrams
+        limit = max(1, len(token) // 3)
+        least = len(token_grams) - 3 * limit
+        best = heapq.nlargest(CANDIDATES,
+                (item for item in counts.items() if item[1] >= least),
+                key=lambda item: item[1])
+        scored = []
+        for position, _ in best:
+            name = self.names[position]
+            name_distance = distance(token, name)
+            if name_distance <= limit:
+                for rel in self.containers[position]:
+                    tokens = tuple(rel.split('/') if rel else []) + (name,)
+                    scored.append((name_distance, len(tokens), tokens))
+        return [tokens for _, _, tokens in sorted(scored)]
+
+
+def suggestions(tokens, index):
+    """
+    Return the commands, as tuples of tokens, that the given tokens were
+    probably meant to be. The last token is the one that was not found, and
+    commands in the container where it was looked up come first.
+    """
+    container, token = tuple(tokens[:-1]), tokens[-1]
+    if cache.cache_dir() is None:
+        rel = '/'.join(container)
+        gram_index = GramIndex.build([(rel, index.entries(rel) or {})])
+    else:
+        gram_index = GramIndex.load(index)
+    commands = gram_index.search(token)
+    local = [command for command in commands if command[:-1] == container]
+    others = [command for command in commands if command[:-1] != container]
+    return (local + others)[:MAX_SUGGESTIONS]
+
+
+def format_suggestions(sub_name, tokens, index):
+    """
+    Return the lines that suggest commands for tokens that were not found, or
+    an empty list if there is nothing close.
+    """
+    commands = suggestions(tokens, index)
+    if not commands:
+        return []
+    lines = ['', 'The most similar commands are:' if len(commands) > 1
+             else 'The most similar command is:']
+    lines += ['    ' + ' '.join((sub_name,) + command) for command in commands]
+    return lines
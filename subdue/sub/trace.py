@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing trace of driver invocations.
+
+When the SUBDUE_TRACE environment variable holds a file path, every
+invocation of the driver appends one JSON line to that file, with a monotonic
+timestamp for each phase of do_main, the number of filesystem probes made to
+resolve the command, and the resolved command. The driver only imports this
+module when the variable is set, so tracing costs nothing otherwise.
+
+Phases are recorded as [name, seconds] pairs, in the order in which they end.
+Timestamps come from a monotonic clock, so only differences between them are
+meaningful. The trace also includes an estimate of how long the interpreter
+took to start, when the system can tell when the process started.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import os
+import sys
+import time
+
+from . import index as cmdindex
+
+TRACE_VAR = 'SUBDUE_TRACE'
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def process_age():
+    """
+    Return how many seconds ago the current process started, or None if it
+    cannot be known. Only Linux is supported, with the resolution of the
+    kernel clock ticks (usually 10ms).
+    """
+    try:
+        with open('/proc/self/stat', 'rb') as f:
+            stat = f.read().decode('ascii', 'replace')
+        with open('/proc/uptime', 'rb') as f:
+            uptime = float(f.read().split()[0])
+        # The command name may have spaces, fields are counted after it
+        start_ticks = int(stat.rsplit(')', 1)[1].split()[19])
+        return max(uptime - start_ticks / float(os.sysconf('SC_CLK_TCK')), 0.0)
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class Trace(object):
+    """
+    Timings of one invocation of the driver, written to a trace file
+    """
+
+    def __init__(self, path, argv):
+        self.path = path
+        self.start = monotonic()
+        self.wall_start = time.time()
+        self.startup = process_age()
+        self.argv = list(argv)
+        self.phases = [['start', self.start]]
+        self.probes_start = cmdindex.Probes.count
+        self.command = None
+        self.written = False
+
+    def mark(self, phase):
+        """
+        Record the end of a phase
+        """
+        self.phases.append([phase, monotonic()])
+
+    def resolved(self, command):
+        """
+        Record the command that the command line resolved to
+        """
+        self.command = {
+            'tokens': command.tokens,
+            'path': command.path,
+            'found': command.found,
+            'eval': bool(command.found and command.found_with_sh),
+            'container': bool(command.is_container),
+            'python': bool(command.is_python),
+            }
+
+    def builtin(self, name):
+        """
+        Record that the command line resolved to a built-in command
+        """
+        self.command = {'tokens': [name], 'builtin': True, 'found': True}
+
+    def wrap_runner(self, runner):
+        """
+        Return a command runner that writes the trace before running the
+        command, since the default runner replaces the current process.
+        """
+        def traced_runner(args, *rest, **kwargs):
+            self.mark('exec')
+            self.write()
+            return runner(args, *rest, **kwargs)
+        return traced_runner
+
+    def to_dict(self):
+        return {
+            'pid': os.getpid(),
+            'time': self.wall_start,
+            'argv': self.argv,
+            'startup': self.startup,
+            'phases': self.phases,
+            'probes': cmdindex.Probes.count - self.probes_start,
+            'command': self.command,
+            }
+
+    def write(self):
+        """
+        Append the trace to the trace file, only once. Errors writing the
+        trace are reported but never stop the command.
+        """
+        if self.written:
+            return
+        self.written = True
+        line = json.dumps(self.to_dict(), sort_keys=True) + '\n'
+        try:
+            # A single write in append mode keeps lines from concurrent
+            # invocations from mixing
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            sys.stderr.write("subdue: cannot write trace to {0}: {1}\n".format(
+                self.path, e))
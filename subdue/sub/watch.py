@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Change notifications for long running processes, like the resolver daemon
+and the zygote.
+
+A watcher is attached to a command index and keeps it up to date as the
+commands tree changes: every container with a record in the index is watched,
+a change in a container drops its record, and the removal or move of a
+container drops the records of everything under it, so only the affected
+subtrees are scanned again. In exchange, the records of watched containers are
+trusted without a stat, see index.CommandIndex.watched. A watcher can also
+watch extra files and directories, like the lib directory of a sub, and report
+which of them changed.
+
+Notifications come from Linux inotify, used through ctypes. Changes are only
+read when poll() is called, typically before answering each request, so no
+thread or extra file descriptor in the main loop of the process is needed.
+Where inotify is not available, or once its limits on watches or instances
+are exhausted, the watcher falls back to checking the modification times of
+everything it watches, at most once every POLL_INTERVAL seconds.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+import errno
+import struct
+
+from . import index as cmdindex
+
+POLL_INTERVAL = 1.0
+""" Seconds between checks of modification times when polling """
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+CONTAINER_MASK = (IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+""" Changes to the listing of a container, including the executable bits """
+
+PATH_MASK = (CONTAINER_MASK & ~IN_ONLYDIR) | IN_MODIFY | IN_CLOSE_WRITE
+""" Changes to the listing or the contents of an extra path """
+
+_EVENT = struct.Struct('iIII')
+
+_FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+_DECODE_ERRORS = 'surrogateescape' if sys.version_info[0] >= 3 else 'replace'
+
+
+class Inotify(object):
+    """
+    A non-blocking inotify instance
+    """
+
+    def __init__(self):
+        import ctypes
+        self._ctypes = ctypes
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self):
+        code = self._ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+    def add(self, path, mask):
+        """ Watch a path and return the watch descriptor """
+        if not isinstance(path, bytes):
+            path = path.encode(_FS_ENCODING)
+        wd = self._libc.inotify_add_watch(
+                self.fd, path, self._ctypes.c_uint32(mask))
+        if wd < 0:
+            self._raise()
+        return wd
+
+    def remove(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Return the pending events, as a list of (wd, mask, name), without
+        waiting for any.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            offset = 0
+            while offset + _EVENT.size <= len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask,
+                               name.decode(_FS_ENCODING, _DECODE_ERRORS)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _signature(path):
+    """
+    Return the modification times and modes of a path and everything under
+    it, to compare them when polling. None if the path does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = [('', st.st_mtime, st.st_mode)]
+    for directory, dirs, files in os.walk(path):
+        for name in sorted(dirs + files):
+            entry = os.path.join(directory, name)
+            try:
+                st = os.stat(entry)
+            except OSError:
+                continue
+            signature.append((os.path.relpath(entry, path),
+                              st.st_mtime, st.st_mode))
+    return signature
+
+
+class Watcher(object):
+    """
+    Keep the command indexes of an index, single or layered, up to date with
+    the filesystem, and report changes to extra paths. Packed subs never
+    change and are left alone.
+    """
+
+    def __init__(self, index=None, paths=(), use_inotify=True,
+                 interval=POLL_INTERVAL):
+        self.layers = []
+        if index is not None:
+            self.layers = [layer for layer in getattr(index, 'layers', [index])
+                           if isinstance(layer, cmdindex.CommandIndex)]
+        self.paths = list(paths)
+        self.interval = interval
+        self.changed = set()
+        """ Extra paths that changed since the last poll """
+
+        self.inotify = None
+        self._watches = {}
+        """ Maps (layer position, container) or (None, path) to their wd """
+        self._targets = {}
+        """ Maps each wd to what it watches. Paths reached through symlinks
+        can share a wd. """
+        self._signatures = {}
+        self._last_poll = time.time()
+
+        for layer in self.layers:
+            layer.watched = set()
+            layer.fresh = set(layer.dirs)
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                pass
+        for path in self.paths:
+            self._watch_path(path)
+        self.sync()
+
+    @property
+    def polling(self):
+        return self.inotify is None
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        for layer in self.layers:
+            layer.watched = None
+            layer.fresh.clear()
+
+    def _add(self, path, mask, target):
+        """
+        Watch a path for a target. Return True if watched, False if the path
+        does not exist and None if the watcher had to fall back to polling.
+        """
+        try:
+            wd = self.inotify.add(path, mask)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            # Out of watches (ENOSPC) or instances, or not allowed
+            self._fall_back()
+            return None
+        self._watches[target] = wd
+        self._targets.setdefault(wd, set()).add(target)
+        return True
+
+    def _unwatch(self, target):
+        wd = self._watches.pop(target, None)
+        if wd is None:
+            return
+        targets = self._targets.get(wd, set())
+        targets.discard(target)
+        if not targets:
+            self._targets.pop(wd, None)
+            self.inotify.remove(wd)
+
+    def _fall_back(self):
+        """
+        Give up on inotify and poll modification times from now on
+        """
+        self.inotify.close()
+        self.inotify = None
+        self._watches.clear()
+        self._targets.clear()
+        for path in self.paths:
+            self._watch_path(path)
+
+    def _watch_path(self, path):
+        if self.inotify is None:
+            self._signatures[path] = _signature(path)
+            return
+        walked = [(path, [], [])]
+        if os.path.isdir(path):
+            walked = os.walk(path)
+        for directory, _, _ in walked:
+            if self._add(directory, PATH_MASK, (None, directory)) is None:
+                # _fall_back() took care of all the paths
+                return
+
+    def sync(self):
+        """
+        Watch the containers scanned since the last call, and trust the
+        records of those that are known to be up to date.
+        """
+        for position, layer in enumerate(self.layers):
+            fresh, layer.fresh = layer.fresh, set()
+            for rel in fresh:
+                record = layer.dirs.get(rel)
+                if record is None:
+                    continue
+                path = layer.path_for(rel)
+                if self.inotify is not None and (position, rel) in self._watches:
+                    # Scanned while watched, any later change has an event
+                    layer.watched.add(rel)
+                    continue
+                if self.inotify is not None:
+                    added = self._add(path, CONTAINER_MASK, (position, rel))
+                    if added is False:
+                        layer.invalidate(rel, subtree=True)
+                        continue
+                # The container may have changed before it was watched
+                if record[0] is not None and _mtime(path) == record[0]:
+                    layer.watched.add(rel)
+                else:
+                    layer.invalidate(rel)
+
+    def poll(self):
+        """
+        Apply the changes made since the last call to the indexes, and return
+        the set of extra paths that changed.
+        """
+        if self.inotify is not None:
+            try:
+                events = self.inotify.read()
+            except OSError:
+                events = []
+                self._fall_back()
+            for wd, mask, name in events:
+                self._handle(wd, mask, name)
+        if self.inotify is None and time.time() - self._last_poll >= self.interval:
+            self._last_poll = time.time()
+            self._poll_mtimes()
+        self.sync()
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: watch everything again, checking that the
+            # records are still up to date
+            for target in list(self._watches):
+                if target[0] is not None:
+                    self._unwatch(target)
+            for layer in self.layers:
+                layer.watched.clear()
+                layer.fresh.update(layer.dirs)
+            self.changed.update(self.paths)
+            return
+        targets = self._targets.get(wd, ())
+        if mask & IN_IGNORED:
+            # The watch is gone, along with what it watched
+            for target in list(targets):
+                self._watches.pop(target, None)
+            self._targets.pop(wd, None)
+            return
+        for position, rel in list(targets):
+            if position is None:
+                self.changed.update(path for path in self.paths
+                                    if rel == path or rel.startswith(path + os.sep))
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self._drop(position, rel)
+                continue
+            if name and mask & IN_ISDIR:
+                self._drop(position, cmdindex.join(rel, name))
+            self.layers[position].invalidate(rel)
+
+    def _drop(self, position, rel):
+        """
+        Forget a container and everything under it, a directory that was
+        removed or moved away
+        """
+        self.layers[position].invalidate(rel, subtree=True)
+        prefix = rel + '/'
+        for target in list(self._watches):
+            if target[0] == position and (
+                    not rel or target[1] == rel or target[1].startswith(prefix)):
+                self._unwatch(target)
+
+    def _poll_mtimes(self):
+        for layer in self.layers:
+            for rel in list(layer.watched):
+                record = layer.dirs.get(rel)
+                if record is None or _mtime(layer.path_for(rel)) != record[0]:
+                    layer.invalidate(rel)
+        for path, signature in self._signatures.items():
+            current = _signature(path)
+            if current != signature:
+                self._signatures[path] = current
+                self.changed.add(path)
+
+
+def is_available():
+    """ Tell whether changes can be watched with inotify here """
+    try:
+        Inotify().close()
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,642 @@
+# -*- coding: utf-8 -*-
+"""
+Optional pre-forked zygote for Python command scripts.
+
+Commands that are Python scripts pay for the start of a new interpreter, and
+for importing their modules, on every call. The zygote of a sub is a server
+that has started once, imported the modules the commands of the sub need, and
+forks a child for each command, which runs the script with runpy.
+
+The modules imported up front are the Python modules in the lib directory of
+the sub, plus those listed, one per line, in the PRELOAD_FILE at the root of
+the sub.
+
+Drivers send each request over a Unix domain socket: a JSON line with the
+argv, environment and working directory of the command, along with their
+standard input, output and error passed as SCM_RIGHTS ancillary data, so the
+child reads and writes the same files the command would have. The server
+answers with a JSON line once the child has finished:
+
+    {"status": "exit", "code": 0}
+    {"status": "signal", "signal": 15}
+
+While the command runs, the driver forwards the signals it gets to the
+server, as {"signal": N} lines, and the server sends them to the child. The
+driver then exits with the same status, or dies of the same signal, as the
+child, just like a command started with execvp would. Job control signals are
+forwarded too: the child runs in a process group of its own, so it stops on
+SIGTSTP, and the driver stops along with it, so that the shell sees the job
+stopped. The child also gets the umask of the driver.
+
+The child is not in the session of the terminal of the driver, so it has no
+controlling terminal. Commands run from a terminal, with standard input
+connected to it, could tell, for example by opening /dev/tty or with
+getpass, so they are never handed to the zygote.
+
+Only scripts whose shebang names a Python interpreter of the same major
+version as the zygote are run this way. Anything else, or any failure to
+reach the zygote, falls back to execvp.
+
+As with the resolver daemon, the socket lives in a runtime directory private
+to the user, both ends check that the other one runs as the same user, and
+the zygote only takes commands for its own sub: the driver sends the root of
+the sub along with the command, and the zygote echoes it when it starts it.
+
+The preloaded modules go out of date when the lib directory or the PRELOAD_FILE
+of the sub change. The zygote watches them, see watch, and once they change
+it answers {"status": "stale"} to new commands, which then fall back to
+execvp, and exits as soon as the commands it is running finish.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import array
+import select
+import signal
+import socket
+import traceback
+
+from . import cache
+
+IDLE_TIMEOUT = 600
+""" Seconds without requests after which the zygote shuts down """
+
+CLIENT_TIMEOUT = 2.0
+""" Seconds a driver waits for the zygote to accept a command """
+
+PRELOAD_FILE = 'preload.txt'
+""" File in the root of a sub with the names of the modules to preload """
+
+FORWARDED_SIGNALS = ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT', 'SIGUSR1',
+                     'SIGUSR2', 'SIGWINCH', 'SIGTSTP', 'SIGTTIN', 'SIGTTOU',
+                     'SIGCONT')
+
+STOP_SIGNALS = ('SIGTSTP', 'SIGTTIN', 'SIGTTOU')
+""" Forwarded signals that stop the driver as well as the command """
+
+
+def is_supported():
+    """
+    Passing file descriptors needs socket.sendmsg, from Python 3.3
+    """
+    return hasattr(socket.socket, 'sendmsg')
+
+
+def socket_path_for(root):
+    """
+    Return the path of the socket of the zygote for the sub at root.
+    """
+    return cache.runtime_file('zygote', root, 'sock')
+
+
+def is_python_script(path):
+    """
+    Tell whether the shebang of a file names a Python interpreter that this
+    one can stand for: python, or python with the same major version.
+    """
+    try:
+        with open(path, 'rb') as f:
+            line = f.readline(256)
+    except (IOError, OSError):
+        return False
+    if not line.startswith(b'#!'):
+        return False
+    words = line[2:].decode('utf-8', 'replace').split()
+    if words and os.path.basename(words[0]) == 'env':
+        words = [word for word in words[1:] if not word.startswith('-')]
+    if not words:
+        return False
+    interpreter = os.path.basename(words[0])
+    major = 'python{0}'.format(sys.version_info[0])
+    return (interpreter in ('python', major)
+            or interpreter.startswith(major + '.'))
+
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+class LineReader(object):
+    """
+    Split what is received from a socket in lines
+    """
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.buffer = data
+
+    def read_line(self):
+        """
+        Return the next line as a decoded JSON message, or None at the end.
+        """
+        while b'\n' not in self.buffer:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+
+def request(root, message, timeout=CLIENT_TIMEOUT):
+    """
+    Send a control request (ping or stop) to the zygote of the sub at root.
+    Return the response, or None if there is no zygote.
+    """
+    path = socket_path_for(root)
+    if not cache.is_private_dir(os.path.dirname(path)):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        if not cache.peer_is_current_user(sock):
+            return None
+        _send(sock, message)
+        return LineReader(sock).read_line()
+    except (socket.error, socket.timeout, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+class ZygoteRunner(object):
+    """
+    Command runner that runs Python scripts in the zygote of a sub, and any
+    other command, or any command when the zygote cannot be reached, with
+    the fallback runner.
+    """
+
+    def __init__(self, root, fallback):
+        self.root = os.path.abspath(root)
+        self.socket_path = socket_path_for(root)
+        self.fallback = fallback
+
+    def __call__(self, args, env=None):
+        if (is_supported() and not os.isatty(0)
+                and is_python_script(args[0])):
+            sock = self.connect(args, env)
+            if sock is not None:
+                self.wait(sock)
+        if env is None:
+            return self.fallback(args)
+        return self.fallback(args, env=env)
+
+    def connect(self, args, env):
+        """
+        Hand the command over to the zygote. Return the connection, or None if
+        the zygote did not take the command.
+        """
+        if not cache.is_private_dir(os.path.dirname(self.socket_path)):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(self.socket_path)
+            if not cache.peer_is_current_user(sock):
+                sock.close()
+                return None
+            message = json.dumps({
+                'op': 'run',
+                'root': self.root,
+                'argv': list(args),
+                'env': dict(os.environ if env is None else env),
+                'cwd': os.getcwd(),
+                'umask': current_umask(),
+                }).encode('utf-8') + b'\n'
+            fds = array.array('i', [0, 1, 2]).tobytes()
+            sent = sock.sendmsg([message], [
+                (socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            if sent < len(message):
+                sock.sendall(message[sent:])
+            reader = LineReader(sock)
+            response = reader.read_line()
+        except (socket.error, socket.timeout, ValueError):
+            sock.close()
+            return None
+        if (response is None or response.get('status') != 'started'
+                or response.get('root') != self.root):
+            sock.close()
+            return None
+        sock.settimeout(None)
+        self.reader = reader
+        return sock
+
+    def wait(self, sock):
+        """
+        Forward signals to the command until it finishes, then exit like it.
+        """
+        stop_signals = set(getattr(signal, name) for name in STOP_SIGNALS
+                           if hasattr(signal, name))
+        def forward(signum, frame):
+            try:
+                _send(sock, {'signal': signum})
+            except socket.error:
+                pass
+            if signum in stop_signals:
+                os.kill(os.getpid(), signal.SIGSTOP)
+        for name in FORWARDED_SIGNALS:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), forward)
+
+        try:
+            response = self.reader.read_line()
+        except (socket.error, ValueError):
+            response = None
+        for name in FORWARDED_SIGNALS:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), signal.SIG_DFL)
+        sock.close()
+
+        if response is None:
+            sys.exit("subdue: lost the connection to the zygote")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if response.get('status') == 'signal':
+            signum = response['signal']
+            try:
+                signal.signal(signum, signal.SIG_DFL)
+            except (OSError, ValueError):
+                # SIGKILL and SIGSTOP cannot be handled anyway
+                pass
+            os.kill(os.getpid(), signum)
+            # Signals that do not kill by default, like SIGWINCH
+            os._exit(128 + signum)
+        os._exit(response.get('code', 1))
+
+
+def _receive_request(conn):
+    """
+    Receive a request, along with the file descriptors passed with it.
+    Return (message, fds).
+    """
+    fds = array.array('i')
+    data, ancdata, flags, _ = conn.recvmsg(
+            65536, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            payload = payload[:len(payload) - len(payload) % fds.itemsize]
+            fds.frombytes(payload)
+    reader = LineReader(conn, data)
+    return reader.read_line(), list(fds)
+
+
+def read_preload_list(root):
+    """
+    Return the names of the modules to preload for the sub at root
+    """
+    modules = []
+    lib = os.path.join(root, 'lib')
+    if os.path.isdir(lib):
+        for name in sorted(os.listdir(lib)):
+            if name.endswith('.py') and name != '__init__.py':
+                modules.append(name[:-3])
+    try:
+        with open(os.path.join(root, PRELOAD_FILE)) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    modules.append(line)
+    except (IOError, OSError):
+        pass
+    return modules
+
+
+class Zygote(object):
+    """
+    Server that runs Python command scripts of one sub in forked children.
+    """
+
+    def __init__(self, paths, idle_timeout=IDLE_TIMEOUT, use_watch=True):
+        self.paths = paths
+        self.idle_timeout = idle_timeout
+        self.socket_path = socket_path_for(paths.root)
+        self.sock = None
+        self.running = False
+        self.use_watch = use_watch
+        self.watcher = None
+        self.children = {}
+        """ Maps the pid of each running child to the connection to its
+        driver, or to None if the driver went away """
+
+        self.preloaded = []
+        self.failed_preloads = []
+        self._sys_path = list(sys.path)
+
+    def preload(self):
+        """
+        Import the modules listed for preloading. Modules that fail to import
+        are skipped, the scripts will get the error when they import them.
+        """
+        if sys.flags.no_site:
+            import site
+            site.main()
+        self._sys_path = list(sys.path)
+        sys.path.insert(0, self.paths.lib)
+        for name in read_preload_list(self.paths.root):
+            try:
+                __import__(name)
+                self.preloaded.append(name)
+            except Exception:
+                self.failed_preloads.append(name)
+        sys.path[:] = self._sys_path
+
+    def bind(self):
+        """
+        Create the listening socket. Return False if another zygote is already
+        serving this sub.
+        """
+        cache.make_runtime_dir()
+        if os.path.exists(self.socket_path):
+            if request(self.paths.root, {'op': 'ping'}) is not None:
+                return False
+            # Left behind by a zygote that did not exit cleanly
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.sock.listen(64)
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        """
+        Run commands until stopped, or until idle for longer than
+        idle_timeout with no command running.
+        """
+        import time
+        wakeup_read, wakeup_write = os.pipe()
+        for fd in (wakeup_read, wakeup_write):
+            _set_nonblocking(fd)
+        previous_wakeup = signal.set_wakeup_fd(wakeup_write)
+        previous_handler = signal.signal(signal.SIGCHLD, _ignore_signal)
+        self.running = True
+        last_activity = time.time()
+        if self.use_watch:
+            from . import watch
+            self.watcher = watch.Watcher(paths=[
+                self.paths.lib, os.path.join(self.paths.root, PRELOAD_FILE)])
+        try:
+            while self.running or self.children:
+                readable = [wakeup_read] + [
+                        conn for conn in self.children.values() if conn]
+                if self.running:
+                    readable.append(self.sock)
+                timeout = None
+                if not self.children:
+                    timeout = max(last_activity + self.idle_timeout - time.time(), 0)
+                ready, _, _ = select.select(readable, [], [], timeout)
+                if not ready and not self.children:
+                    break
+                if wakeup_read in ready:
+                    try:
+                        os.read(wakeup_read, 512)
+                    except OSError:
+                        pass
+                for conn in ready:
+                    if conn is self.sock:
+                        self.accept()
+                    elif conn is not wakeup_read:
+                        self.forward_signals(conn)
+                self.reap()
+                last_activity = time.time()
+        finally:
+            signal.set_wakeup_fd(previous_wakeup)
+            signal.signal(signal.SIGCHLD, previous_handler)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+            if self.watcher is not None:
+                self.watcher.close()
+            self.close()
+
+    def accept(self):
+        conn, _ = self.sock.accept()
+        if not cache.peer_is_current_user(conn):
+            conn.close()
+            return
+        try:
+            conn.settimeout(CLIENT_TIMEOUT)
+            message, fds = _receive_request(conn)
+            conn.settimeout(None)
+        except (socket.error, socket.timeout, ValueError):
+            conn.close()
+            return
+        try:
+            op = message and message.get('op')
+            if op == 'run' and self.watcher is not None and self.watcher.poll():
+                # The preloaded modules are out of date
+                _send(conn, {'status': 'stale'})
+                self.running = False
+            elif op == 'run' and message.get('root') != os.path.abspath(
+                    self.paths.root):
+                _send(conn, {'status': 'error', 'message': 'wrong sub'})
+            elif op == 'run' and len(fds) == 3:
+                self.run(conn, message, fds)
+                conn = None
+            elif op == 'ping':
+                _send(conn, {'status': 'ok', 'pid': os.getpid(),
+                             'preloaded': self.preloaded,
+                             'failed': self.failed_preloads})
+            elif op == 'stop':
+                _send(conn, {'status': 'ok'})
+                self.running = False
+            else:
+                _send(conn, {'status': 'error', 'message': 'bad request'})
+        except socket.error:
+            pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+            if conn is not None:
+                conn.close()
+
+    def run(self, conn, message, fds):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.sock.close()
+                for other in self.children.values():
+                    if other is not None:
+                        other.close()
+                conn.close()
+                code = run_child(message, fds, self._sys_path)
+            except BaseException:
+                code = 1
+            os._exit(code)
+        self.children[pid] = conn
+        _send(conn, {'status': 'started', 'pid': pid,
+                     'root': os.path.abspath(self.paths.root)})
+
+    def forward_signals(self, conn):
+        """
+        Read the signals a driver forwards and send them to its child
+        """
+        pid = [pid for pid, other in self.children.items() if other is conn][0]
+        try:
+            data = conn.recv(4096)
+        except socket.error:
+            data = b''
+        if not data:
+            # The driver is gone, like the terminal of a process would
+            self.children[pid] = None
+            conn.close()
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass
+            return
+        for line in data.splitlines():
+            try:
+                signum = int(json.loads(line.decode('utf-8'))['signal'])
+                os.kill(pid, signum)
+            except (ValueError, KeyError, TypeError, OSError):
+                pass
+
+    def reap(self):
+        """
+        Report the status of finished children to their drivers
+        """
+        for pid in list(self.children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done, status = pid, 1 << 8
+            if done == 0:
+                continue
+            conn = self.children.pop(pid)
+            if conn is None:
+                continue
+            if os.WIFSIGNALED(status):
+                response = {'status': 'signal', 'signal': os.WTERMSIG(status)}
+            else:
+                response = {'status': 'exit', 'code': os.WEXITSTATUS(status)}
+            try:
+                _send(conn, response)
+            except socket.error:
+                pass
+            conn.close()
+
+
+def _ignore_signal(signum, frame):
+    pass
+
+
+def current_umask():
+    """
+    Return the umask of this process, which can only be read by setting it
+    """
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def run_child(message, fds, sys_path):
+    """
+    Run a script in a forked child of the zygote, as the process started by
+    execvp would, and return its exit status.
+    """
+    import io
+    import runpy
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Stop signals are ignored in the orphaned process group of the zygote
+    os.setpgid(0, 0)
+    if message.get('umask') is not None:
+        os.umask(message['umask'])
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = io.open(0, 'r', closefd=False)
+    sys.stdout = io.open(1, 'w', buffering=1 if os.isatty(1) else -1,
+                         closefd=False)
+    sys.stderr = io.open(2, 'w', buffering=1, closefd=False)
+
+    os.chdir(message['cwd'])
+    os.environ.clear()
+    os.environ.update(message['env'])
+    script = message['argv'][0]
+    sys.argv = list(message['argv'])
+    sys.path[:] = [os.path.dirname(script)] + sys_path
+
+    code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        code = _exit_code(e.code)
+    except KeyboardInterrupt:
+        # Like the interpreter, die of the signal that was not handled
+        _finish()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGINT)
+        code = 128 + signal.SIGINT
+    except BaseException:
+        # Leave the frames of the zygote out, as the interpreter would
+        kind, value, tb = sys.exc_info()
+        while tb is not None and tb.tb_frame.f_code.co_filename != script:
+            tb = tb.tb_next
+        traceback.print_exception(kind, value, tb)
+        code = 1
+    _finish()
+    return code
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _finish():
+    """
+    Do what the interpreter does before exiting, which os._exit skips: wait
+    for the threads that are not daemons, run the atexit handlers and flush
+    the standard streams. Handlers registered by the modules preloaded in the
+    zygote run too, as they would if the command had imported them.
+    """
+    import atexit
+    import threading
+    shutdown = getattr(threading, '_shutdown', None)
+    if shutdown is not None:
+        try:
+            shutdown()
+        except Exception:
+            pass
+    run_exitfuncs = getattr(atexit, '_run_exitfuncs', None)
+    if run_exitfuncs is not None:
+        try:
+            run_exitfuncs()
+        except Exception:
+            pass
+    _flush()
+
+
+def _flush():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (IOError, OSError, ValueError):
+            pass
@@ -0,0 +1,332 @@
+"""
+Benchmarks for the hot paths of the sub driver.
+
+A synthetic sub is generated with the requested number of commands, spread
+over a tree of containers of the given depth and fanout, and the following
+are measured, both with cold subdue caches (the cache directory is emptied
+before every run) and with warm ones:
+
+  * find_command_path  Resolution of the deepest command in the sub
+  * dispatch           Full do_main dispatch with a no-op command runner
+  * commands           The commands built-in, listing the whole sub
+  * init               Rendering of the init --full output for bash
+  * startup            Running a no-op command through the driver process
+  * suggest            Suggestions for a typo in the name of the deepest command
+
+Results are written as JSON, so that runs can be compared across commits:
+
+    python -m test.benchmark --commands 10000 --depth 4 -o before.json
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from .utils import age_tree
+from subdue.main import DIRECTORIES, create_default_driver
+from subdue.sub import _main
+from subdue.sub import cache
+from subdue.sub import index as cmdindex
+
+timer = getattr(time, 'perf_counter', time.time)
+
+BENCHMARKS = ['find_command_path', 'dispatch', 'commands', 'init', 'startup',
+              'suggest']
+
+MAX_DEPTH = 8
+
+
+class SyntheticSub(object):
+    """
+    A generated sub. target holds the command line of its deepest command,
+    which is a no-op.
+    """
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+        self.driver = os.path.join(root, 'bin', name)
+        self.commands = os.path.join(root, 'commands')
+        self.target = None
+        self.command_count = 0
+        self.container_count = 0
+
+
+def make_containers(commands, depth, fanout):
+    """
+    Return the relative paths of the containers of a synthetic sub, in breadth
+    first order, starting with the root. There are never more containers than
+    commands, so that every container holds at least one command.
+    """
+    containers = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [cmdindex.join(parent, 'grp{0}'.format(i))
+                 for parent in level for i in range(fanout)]
+        level = level[:commands - len(containers)]
+        if not level:
+            break
+        containers += level
+    return containers
+
+
+def make_sub(parent, name='bench', commands=1000, depth=3, fanout=4,
+             sh_ratio=0.1):
+    """
+    Create a synthetic sub under parent. Commands are distributed round robin
+    over the containers, and the given ratio of them are eval commands.
+    """
+    if not 0 <= depth <= MAX_DEPTH:
+        raise ValueError("depth must be between 0 and {0}".format(MAX_DEPTH))
+    sub = SyntheticSub(os.path.join(parent, name), name)
+    for directory in DIRECTORIES:
+        os.makedirs(os.path.join(sub.root, directory))
+    create_default_driver(sub.root, name)
+
+    containers = make_containers(commands, depth, fanout)
+    for rel in containers[1:]:
+        os.mkdir(os.path.join(sub.commands, *rel.split('/')))
+
+    deepest = None
+    for i in range(commands):
+        rel = containers[i % len(containers)]
+        is_eval = int((i + 1) * sh_ratio) > int(i * sh_ratio)
+        name = 'cmd{0}'.format(i)
+        filename = 'sh-' + name if is_eval else name
+        path = os.path.join(sub.commands, *(rel.split('/') + [filename]))
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n# Summary: Command number {0}\n'.format(i))
+        os.chmod(path, 0o700)
+        if not is_eval and (deepest is None or
+                            rel.count('/') >= deepest[0].count('/')):
+            deepest = (rel, name)
+
+    if deepest is None:
+        raise ValueError("the sub needs at least one command that is not eval")
+    sub.target = [token for token in deepest[0].split('/') if token]
+    sub.target.append(deepest[1])
+    sub.command_count = commands
+    sub.container_count = len(containers) - 1
+    age_tree(sub.root)
+    return sub
+
+
+class NullOutput(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run_quietly(function):
+    """
+    Call function with the standard output discarded, and with the
+    environment restored afterwards, since the driver modifies it.
+    """
+    environ = dict(os.environ)
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        return function()
+    finally:
+        sys.stdout = stdout
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def no_op_runner(args, env=None):
+    pass
+
+
+def clear_caches():
+    directory = cache.cache_dir()
+    if directory and os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+
+def statistics(samples):
+    """
+    Summarize timings, given in seconds, as milliseconds
+    """
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2.0
+    to_ms = lambda seconds: round(seconds * 1000.0, 4)
+    return {
+        'runs': len(ordered),
+        'min': to_ms(ordered[0]),
+        'median': to_ms(median),
+        'mean': to_ms(sum(ordered) / len(ordered)),
+        'max': to_ms(ordered[-1]),
+        }
+
+
+def measure(function, repeat, cold):
+    """
+    Time repeated calls of function. Cold runs start with empty caches, warm
+    runs are preceded by an untimed call that fills them.
+    """
+    samples = []
+    if not cold:
+        function()
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        start = timer()
+        function()
+        samples.append(timer() - start)
+    return statistics(samples)
+
+
+def benchmark_functions(sub):
+    """
+    Return the function to time for each benchmark
+    """
+    paths = _main.SubPaths(sub.root, sub.driver)
+
+    def find_command_path():
+        index = cmdindex.open_index(paths.commands)
+        command = _main.find_command_path(sub.target, paths, index=index)
+        assert command.found
+
+    def driver_main(argv):
+        def call():
+            return run_quietly(lambda: _main.do_main(
+                argv, sub_path=sub.root, driver_path=sub.driver,
+                command_runner=no_op_runner, use_daemon=False))
+        return call
+
+    def suggest():
+        # The last two characters of the deepest command swapped
+        typo = sub.target[:-1] + [sub.target[-1][:-2] + sub.target[-1][:-3:-1]]
+        try:
+            driver_main(typo)()
+        except SystemExit as e:
+            assert 'similar' in str(e.code)
+
+    def startup():
+        # The driver has the path to subdue built in
+        subprocess.check_call([sub.driver] + sub.target)
+
+    return {
+        'find_command_path': find_command_path,
+        'dispatch': driver_main(sub.target),
+        'commands': driver_main(['commands', '--recursive']),
+        'init': driver_main(['init', '--full', '--shell', 'bash']),
+        'startup': startup,
+        'suggest': suggest,
+        }
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def run(commands=1000, depth=3, fanout=4, sh_ratio=0.1, repeat=10,
+        benchmarks=None, workdir=None):
+    """
+    Generate a synthetic sub, run the benchmarks on it and return the results
+    as a JSON serializable dictionary.
+    """
+    benchmarks = benchmarks or BENCHMARKS
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix='subdue-bench-')
+    previous_cache_dir = os.environ.get(cache.CACHE_DIR_VAR)
+    os.environ[cache.CACHE_DIR_VAR] = os.path.join(workdir, 'cache')
+    try:
+        sub = make_sub(workdir, commands=commands, depth=depth,
+                       fanout=fanout, sh_ratio=sh_ratio)
+        functions = benchmark_functions(sub)
+        results = {}
+        for name in benchmarks:
+            results[name] = {
+                'cold': measure(functions[name], repeat, cold=True),
+                'warm': measure(functions[name], repeat, cold=False),
+                }
+    finally:
+        if previous_cache_dir is None:
+            del os.environ[cache.CACHE_DIR_VAR]
+        else:
+            os.environ[cache.CACHE_DIR_VAR] = previous_cache_dir
+        if own_workdir:
+            shutil.rmtree(workdir)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'commit': git_commit(),
+            'time': time.time(),
+            'parameters': {
+                'commands': commands,
+                'containers': sub.container_count,
+                'depth': depth,
+                'fanout': fanout,
+                'sh_ratio': sh_ratio,
+                'repeat': repeat,
+                'target': sub.target,
+                },
+            },
+        'results': results,
+        }
+
+
+def parse_args(argv):
+    """ Parse and validate command line arguments """
+    parser = argparse.ArgumentParser(
+            prog='python -m test.benchmark',
+            description="Benchmark the driver on a synthetic sub")
+    parser.add_argument("--commands", type=int, default=1000,
+                        help="number of commands (10 to 100000 is sensible)")
+    parser.add_argument("--depth", type=int, default=3,
+                        choices=range(MAX_DEPTH + 1), metavar='0-8',
+                        help="maximum nesting of containers")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="containers in each container")
+    parser.add_argument("--sh-ratio", type=float, default=0.1,
+                        help="fraction of eval (sh-) commands")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="timed runs of each benchmark")
+    parser.add_argument("--only", action='append', choices=BENCHMARKS,
+                        help="run only this benchmark, can be repeated")
+    parser.add_argument("-o", "--output",
+                        help="write the results to this file, instead of "
+                             "the standard output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = run(commands=args.commands, depth=args.depth,
+                  fanout=args.fanout, sh_ratio=args.sh_ratio,
+                  repeat=args.repeat, benchmarks=args.only)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
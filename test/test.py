@@ -8,6 +8,7 @@ import subdue
 import subdue.core
 import subdue.sub
 from .utils import SubdueTestCase, TemporaryDirectory, OutStreamCheckedCapture
+from . import utils
 
 class TestMain(SubdueTestCase):
 
@@ -132,7 +133,39 @@ class TestMain(SubdueTestCase):
             self.assertIsExecutable(driver)
             with open(driver) as f:
                 driver_text = f.read()
-            self.assertEqual(driver_text, subdue.core.DEFAULT_DRIVER_CODE)
+            subroot = os.path.join(d, 'mysub')
+            self.assertEqual(driver_text, subdue.core.make_driver_code(subroot, driver))
+            self.assertTrue(driver_text.startswith('#!{0} -S\n'.format(sys.executable)))
+            self.assertIn('sub_path={0!r}'.format(subroot), driver_text)
+            self.assertIn('driver_path={0!r}'.format(driver), driver_text)
+
+    def test_modify_compile(self):
+        with TemporaryDirectory(cd=True) as d:
+            with OutStreamCheckedCapture(self):
+                subdue.main(['subdue', 'new', 'mysub'])
+            os.rename(os.path.join(d, 'mysub'), os.path.join(d, 'moved'))
+            os.rename(os.path.join(d, 'moved', 'bin', 'mysub'),
+                      os.path.join(d, 'moved', 'bin', 'moved'))
+            utils.create_subcommand(os.path.join(d, 'moved'), 'where', """\
+                #!/bin/sh
+                echo "$_SUB_NAME_ $_SUB_PATH_ROOT_"
+                """)
+
+            with OutStreamCheckedCapture(self):
+                subdue.main(['subdue', 'modify', '--compile', 'moved'])
+            with OutStreamCheckedCapture(self) as cap:
+                return_code = utils.call_driver_for(os.path.join(d, 'moved'), ['where'])
+            self.assertEqual(return_code, 0, str(cap))
+            cap.stdout.matches('^moved {0}$'.format(os.path.join(d, 'moved')))
+
+    def test_modify_compile_without_driver(self):
+        with TemporaryDirectory(cd=True) as d:
+            with OutStreamCheckedCapture(self):
+                subdue.main(['subdue', 'new', '--thin', 'mysub'])
+            with OutStreamCheckedCapture(self) as cap:
+                with self.assertRaises(SystemExit):
+                    subdue.main(['subdue', 'modify', '--compile', 'mysub'])
+            cap.stderr.contains('has no driver')
 
 
 
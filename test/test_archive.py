@@ -0,0 +1,185 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import errno
+import json
+import shutil
+import zipfile
+
+from .utils import SubdueTestCase, TempSub
+from . import utils
+import subdue
+import subdue.sub
+from subdue.sub import _main
+from subdue.sub import archive
+from subdue.sub import cache
+from subdue.sub import index as cmdindex
+
+
+class TestArchive(SubdueTestCase):
+
+    def _make_archive(self, s):
+        s.create_subcommand('grp/hi', 'sh', 'echo "hi $* $(helper)"')
+        s.create_subcommand('grp/other', 'sh', 'echo other')
+        s.create_subcommand('sh-setfoo', 'sh', 'echo FOO=1')
+        s.create_subcommand('same', 'sh', 'echo other')
+        utils.create_subcommand(s.sub_root, 'greet.py',
+                '# subdue: main\n'
+                'def main(argv, env):\n    print("hello " + " ".join(argv))\n')
+        os.chmod(os.path.join(s.sub_root, 'commands', 'greet.py'), 0o600)
+        lib = os.path.join(s.sub_root, 'lib')
+        if not os.path.isdir(lib):
+            os.mkdir(lib)
+        utils.create_subcommand(s.sub_root, '../lib/helper', 'echo helped', 'sh')
+
+        output = os.path.join(s.sub_root, 'exa.zip')
+        with utils.OutStreamCapture() as cap:
+            subdue.main(['subdue', 'pack', s.sub_root, '-o', output])
+        self.assertIn('Packed 6 files', cap.stdout)
+        return output
+
+    def test_pack(self):
+        with TempSub(self, name='exa') as s:
+            output = self._make_archive(s)
+
+            # A regular zip file, with the member index at the end
+            with zipfile.ZipFile(output) as z:
+                self.assertEqual(z.read('commands/grp/hi'),
+                        open(os.path.join(s.sub_root, 'commands', 'grp', 'hi'),
+                             'rb').read())
+                self.assertEqual(z.namelist()[-1], archive.INDEX_MEMBER)
+
+            packed = archive.Archive.open(output)
+            self.assertIs(archive.Archive.open(output), packed)
+            expected = cmdindex.CommandIndex(os.path.join(s.sub_root, 'commands'))
+            self.assertEqual(packed.dirs, dict(expected.walk()))
+            self.assertEqual(packed.read('lib/helper'),
+                    open(os.path.join(s.sub_root, 'lib', 'helper'), 'rb').read())
+
+            # Resolution only reads the archive
+            index = cmdindex.open_index([output])
+            self.assertIsInstance(index, archive.ArchiveIndex)
+            probes = cmdindex.Probes.count
+            command = _main.find_command_in_index(['grp', 'hi', 'x'], index)
+            self.assertEqual(cmdindex.Probes.count, probes)
+            self.assertEqual(command.path, os.path.join(
+                archive.Archive.open(output).tree, 'commands', 'grp', 'hi'))
+            self.assertEqual(command.arguments, ['x'])
+
+            with open(os.path.join(s.sub_root, 'bad.zip'), 'wb') as f:
+                f.write(b'not an archive')
+            self.assertRaises(archive.ArchiveError, archive.Archive,
+                              os.path.join(s.sub_root, 'bad.zip'))
+
+    def test_driver(self):
+        with TempSub(self, name='exa') as s:
+            output = self._make_archive(s)
+            driver = os.path.join(s.sub_root, 'bin', 'exa')
+
+            def run(*args):
+                caller = utils.SubprocessCaller()
+                with utils.OutStreamCapture() as cap:
+                    subdue.sub.main(list(args), sub_path=output,
+                                    driver_path=driver, exit=False,
+                                    command_runner=caller)
+                return caller.returncode, cap.stdout
+
+            self.assertEqual(run('grp', 'hi', 'there'), (0, 'hi there helped\n'))
+            self.assertEqual(run('greet', 'you'), (None, 'hello you\n'))
+            self.assertEqual(run('commands', '-r', '--sort'), (None,
+                'greet\ngrp\ngrp hi\ngrp other\nsame\nsetfoo\n'))
+
+            # JSON listings have the words of the container too, and the paths
+            # of the commands in the archive
+            listed = [json.loads(line) for line in
+                      run('commands', '--json', '--sort', 'grp')[1].splitlines()]
+            self.assertEqual([item['command'] for item in listed],
+                             [['grp', 'hi'], ['grp', 'other']])
+            self.assertEqual(listed[1]['path'],
+                             os.path.join(output, 'commands', 'grp', 'other'))
+            self.assertIn('>> grp', run('help')[1])
+            self.assertIn('other', run('help', 'grp')[1])
+
+            # Only what has been run or read is extracted, besides lib
+            tree = archive.Archive.open(output).tree
+            self.assertTrue(os.path.isfile(os.path.join(tree, 'lib', 'helper')))
+            self.assertTrue(os.access(os.path.join(tree, 'commands', 'grp', 'hi'),
+                                      os.X_OK))
+            self.assertFalse(os.path.exists(os.path.join(tree, 'commands', 'same')))
+            self.assertFalse(os.path.exists(os.path.join(tree, 'commands', 'grp',
+                                                         'other')))
+
+            # Files with the same contents are stored once
+            run('grp', 'other')
+            run('same')
+            objects = os.listdir(os.path.join(archive.extract_dir(), 'objects'))
+            self.assertEqual(len(objects), 4)
+
+            # Failing to extract a command is reported as such
+            def cannot_link(source, target):
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            os.remove(os.path.join(tree, 'commands', 'grp', 'hi'))
+            write_atomic, link = cache.write_atomic, os.link
+            cache.write_atomic = lambda *args: False
+            os.link = cannot_link
+            try:
+                with utils.OutStreamCapture():
+                    result = subdue.sub.main(['grp', 'hi'], sub_path=output,
+                                             driver_path=driver, exit=False)
+            finally:
+                cache.write_atomic, os.link = write_atomic, link
+            self.assertIn('Cannot extract commands/grp/hi', str(result.code))
+
+            # Stored files are checked against the index before being linked
+            stored = os.path.join(archive.extract_dir(), 'objects',
+                                  sorted(objects)[0])
+            os.chmod(stored, 0o700)
+            with open(stored, 'w') as f:
+                f.write('#!/bin/sh\necho planted\n')
+            shutil.rmtree(tree)
+            self.assertEqual(run('grp', 'hi')[1], 'hi  helped\n')
+            self.assertEqual(run('grp', 'other')[1], 'other\n')
+            self.assertEqual(run('same')[1], 'other\n')
+
+            # Without caches, files are only extracted to a private directory
+            copy = os.path.join(s.sub_root, 'copy.zip')
+            shutil.copy(output, copy)
+            runtime = os.path.join(s.sub_root, 'runtime')
+            os.makedirs(os.path.join(runtime, 'subdue'))
+            os.chmod(os.path.join(runtime, 'subdue'), 0o755)
+            saved = dict((name, os.environ.get(name))
+                         for name in ('SUBDUE_CACHE_DIR', 'XDG_RUNTIME_DIR'))
+            os.environ['SUBDUE_CACHE_DIR'] = ''
+            os.environ['XDG_RUNTIME_DIR'] = runtime
+            try:
+                with utils.OutStreamCapture():
+                    result = subdue.sub.main(['grp', 'hi'], sub_path=copy,
+                                             driver_path=driver, exit=False)
+                self.assertIn('Cannot extract archives', str(result.code))
+                os.chmod(os.path.join(runtime, 'subdue'), 0o700)
+                caller = utils.SubprocessCaller()
+                with utils.OutStreamCapture() as cap:
+                    subdue.sub.main(['grp', 'hi'], sub_path=copy,
+                                    driver_path=driver, exit=False,
+                                    command_runner=caller)
+                self.assertEqual(cap.stdout, 'hi  helped\n')
+                self.assertTrue(archive.Archive.open(copy).tree.startswith(
+                    os.path.join(runtime, 'subdue', 'archives')))
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+
+            # A packed sub can also be a command root of another sub
+            shutil.rmtree(os.path.join(s.sub_root, 'commands', 'grp'))
+            caller = utils.SubprocessCaller()
+            with utils.OutStreamCapture() as cap:
+                subdue.sub.main(['grp', 'hi'], sub_path=s.sub_root,
+                                driver_path=driver, exit=False,
+                                command_runner=caller,
+                                command_roots=['commands', output])
+            self.assertEqual(cap.stdout, 'hi  helped\n')
@@ -0,0 +1,36 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import os
+
+from .utils import SubdueTestCase, TemporaryDirectory
+from . import benchmark
+
+
+class TestBenchmark(SubdueTestCase):
+
+    def test_make_sub(self):
+        with TemporaryDirectory() as d:
+            sub = benchmark.make_sub(d, commands=30, depth=2, fanout=2,
+                                     sh_ratio=0.2)
+            found = []
+            for path, dirs, files in os.walk(sub.commands):
+                found += files
+            self.assertEqual(sub.container_count, 6)
+            self.assertEqual(len(found), 30)
+            self.assertEqual(len([f for f in found if f.startswith('sh-')]), 6)
+            self.assertEqual(len(sub.target), 3)
+            self.assertTrue(os.path.isfile(
+                os.path.join(sub.commands, *sub.target)))
+
+    def test_run(self):
+        results = benchmark.run(commands=10, depth=2, fanout=2, repeat=1)
+        json.dumps(results)
+        self.assertEqual(sorted(results['results']), sorted(benchmark.BENCHMARKS))
+        for name, result in results['results'].items():
+            for mode in ('cold', 'warm'):
+                self.assertEqual(result[mode]['runs'], 1)
+                self.assertGreater(result[mode]['max'], 0)
+        self.assertEqual(results['meta']['parameters']['commands'], 10)
@@ -2,13 +2,23 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import os
+import re
+import json
 
-from .utils import SubdueTestCase, TempSub
+from .utils import SubdueTestCase, TempSub, OutStreamCheckedCapture, age_tree
+from . import utils
+import subdue
+from subdue.builtincmd import init
+from subdue.sub import index as cmdindex
 
 
 def lines(items):
     return '\n'.join(items.split()) + '\n'
 
+def lines_exact(items):
+    return re.escape(''.join(item + '\n' for item in items))
+
 class TestBuiltinCommands(SubdueTestCase):
 
     def test_commands(self):
@@ -40,3 +50,237 @@ class TestBuiltinCommands(SubdueTestCase):
             s.run('commands',  'dir2').assertSucess(
                     ).stdout.matches(lines('cmd2.1'), anchored=True)
 
+    def test_commands_recursive(self):
+        with TempSub(self, name='boo', thin=False) as s:
+            # b/sh-y can never be run, b/y takes precedence
+            for command in ['b/y', 'b/sh-x', 'b/sh-y', 'a', 'sh-c/z']:
+                s.create_subcommand(command, 'sh', '')
+            utils.create_subcommand(s.sub_root, 'b/notes', '')
+            os.chmod(os.path.join(s.sub_root, 'commands', 'b', 'notes'), 0o600)
+            expected = ['a', 'b', 'b x', 'b y', 'sh-c', 'sh-c z']
+
+            s.run('commands', '--recursive', '--sort').assertSucess(
+                    ).stdout.matches(lines_exact(expected), anchored=True)
+
+            # Unsorted output has the same commands, with every container
+            # before its contents
+            out = s.run('commands', '-r').assertSucess().stdout.text.splitlines()
+            self.assertEqual(sorted(out), expected)
+            self.assertLess(out.index('b'), out.index('b x'))
+
+            out = s.run('commands', '-r', '--json', '--sort', 'b').assertSucess(
+                    ).stdout.text.splitlines()
+            self.assertEqual([json.loads(line) for line in out], [
+                {'command': ['b', 'x'], 'kind': 'eval',
+                 'path': os.path.join(s.sub_root, 'commands', 'b', 'sh-x')},
+                {'command': ['b', 'y'], 'kind': 'command',
+                 'path': os.path.join(s.sub_root, 'commands', 'b', 'y')},
+                ])
+
+
+    def test_init_native(self):
+        with TempSub(self, name='nat', thin=False) as s:
+            s.create_subcommand('grp/show', 'sh', 'echo "show $_SUB_COMMAND_ [$*] $_SUB_IS_EVAL_"')
+            s.create_subcommand('sh-setvar', 'sh', 'echo "FOO=evalled"')
+            s.create_subcommand('memo', 'sh', '# Cache-TTL: 60\necho memo')
+            commands = os.path.join(s.sub_root, 'commands')
+            age_tree(commands)
+            driver = os.path.join(s.sub_root, 'bin', 'nat')
+
+            # The driver is moved away after init, so anything that works
+            # afterwards has not started it
+            script = """
+                eval "$("{driver}" init --full --native --shell bash)"
+                mv "{driver}" "{driver}.moved"
+                _subdue_nat_native grp show a "b c"
+                _subdue_nat_native setvar
+                echo "FOO=$FOO"
+                _subdue_nat_native memo 2>/dev/null
+                echo "memo rc=$?"
+                SUBDUE_NAT_COMMAND_ROOTS=/elsewhere _subdue_nat_native grp show 2>/dev/null
+                echo "roots rc=$?"
+                touch "{commands}/grp"
+                _subdue_nat_native grp show 2>/dev/null
+                echo "stale rc=$?"
+                """.format(driver=driver, commands=commands)
+            with OutStreamCheckedCapture(self) as cap:
+                return_code = utils.call_bash(script)
+            self.assertEqual(return_code, 0, str(cap))
+            cap.stdout.matches(lines_exact([
+                'show grp show [a b c] 0',
+                'FOO=evalled',
+                'memo rc=127',
+                'roots rc=127',
+                'stale rc=127',
+                ]), anchored=True)
+
+    def test_init_cache(self):
+        with TempSub(self, name='ini', thin=False) as s:
+            driver = os.path.join(s.sub_root, 'bin', 'ini')
+            cached = init.init_cache_path(driver, 'bash')
+            load = s.run('init', '--shell', 'bash').assertSucess().stdout.text
+            self.assertIn("source '{0}' 2>/dev/null ||".format(cached), load)
+            self.assertFalse(os.path.exists(cached))
+
+            # The first shell runs the driver and caches its output, the
+            # second one does not need the driver, and touching the driver
+            # makes the third one generate the output again
+            script = """
+                {load}
+                type -t _subdue_ini_wrapper
+                chmod -x "{driver}"
+                unalias ini; unset -f _subdue_ini_wrapper
+                {load}
+                type -t _subdue_ini_wrapper
+                touch "{driver}"
+                chmod +x "{driver}"
+                {load}
+                [[ "{cached}" -nt "{driver}" ]] && echo refreshed
+                """.format(load=load, driver=driver, cached=cached)
+            with OutStreamCheckedCapture(self) as cap:
+                return_code = utils.call_bash(script)
+            self.assertEqual(return_code, 0, str(cap))
+            cap.stdout.matches(lines_exact(['function', 'function', 'refreshed']),
+                               anchored=True)
+            with open(cached) as f:
+                self.assertIn('_subdue_ini_wrapper', f.read())
+
+            # Another version of subdue never uses the same output, whatever
+            # the modification times of its files
+            version = subdue.__version__
+            subdue.__version__ = version + '.post1'
+            try:
+                self.assertNotEqual(init.init_cache_path(driver, 'bash'), cached)
+            finally:
+                subdue.__version__ = version
+
+    def test_dispatch_table(self):
+        with TempSub(self, name='nat', thin=False) as s:
+            for command in ['a/b', 'sh-e', 'sh-f', 'f', 'sh-g/x']:
+                s.create_subcommand(command, 'sh', '')
+            table = init.make_dispatch_table(
+                    cmdindex.CommandIndex(os.path.join(s.sub_root, 'commands')))
+        self.assertEqual(table, [
+            ('a', 'c'), ('a/b', 'x'), ('e', 's'), ('f', 'x'),
+            ('sh-e', 'x'), ('sh-f', 'x'), ('sh-g', 'c'), ('sh-g/x', 'x'),
+            ])
+
+    def test_completions(self):
+        commands = [
+                'dir1/cmd1.1',
+                'dir1/dir1.1/cmd1.1.1',
+                'dir1/dir1.1/other',
+                'cmd1',
+                'sh-eval',
+                'sh-absurd/contained',
+                ]
+        with TempSub(self, name='comp', thin=False) as s:
+            for command in commands:
+                s.create_subcommand(command, 'sh', '')
+            s.create_subcommand('dir1/notexec', 'sh', '')
+            os.chmod(os.path.join(s.sub_root, 'commands', 'dir1', 'notexec'), 0o600)
+
+            s.run('completions', '').assertSucess().stdout.matches(
+                    lines('catalog cmd1 commands completions daemon dir1 eval '
+                          'help init run-many sh-absurd zygote'), anchored=True)
+            s.run('completions', 'c').assertSucess().stdout.matches(
+                    lines('catalog cmd1 commands completions'), anchored=True)
+            s.run('completions', 'e').assertSucess().stdout.matches(
+                    lines('eval'), anchored=True)
+            s.run('completions', 'dir1', '').assertSucess().stdout.matches(
+                    lines('cmd1.1 dir1.1'), anchored=True)
+            s.run('completions', 'dir1', 'dir1.1', 'c').assertSucess(
+                    ).stdout.matches(lines('cmd1.1.1'), anchored=True)
+            s.run('completions', 'cmd1', '').assertSucess(
+                    ).stdout.matches('', anchored=True)
+            s.run('completions', 'nope', '').assertSucess(
+                    ).stdout.matches('', anchored=True)
+            s.run('completions', 'dir1', '-').assertSucess(
+                    ).stdout.matches('', anchored=True)
+            s.run('completions', 'dir1', '-x', 'd').assertSucess(
+                    ).stdout.matches(lines('dir1.1'), anchored=True)
+
+    def test_help(self):
+        with TempSub(self, name='exa', thin=False) as s:
+            s.create_subcommand('foo', 'sh', """
+                # Usage: %COMMAND% [-e]
+                # Summary: Foo all foos
+                # Help:
+                # Foo them all.
+                #
+                # Options:
+                #    -e  Only the even foos
+                """)
+            s.create_subcommand('sh-distim', 'sh', '# Summary: Make Gostak distim')
+            s.create_subcommand('undoc', 'sh', '')
+            s.create_subcommand('baz/qux', 'sh', '# Summary: Qux it')
+            utils.create_subcommand(s.sub_root, 'baz/doc.txt', '# Summary: Bazinga!')
+            utils.create_subcommand(s.sub_root, 'doc.txt', '# Help:\n# The banner')
+            for doc in ('doc.txt', 'baz/doc.txt'):
+                os.chmod(os.path.join(s.sub_root, 'commands', doc), 0o600)
+
+            s.run('help').assertSucess().stdout.matches(lines_exact([
+                'Usage: exa <command> [<args>]',
+                '',
+                'The banner',
+                '',
+                'These are the available subcommands for exa:',
+                '   >> baz     Bazinga!',
+                '      distim  Make Gostak distim',
+                '      foo     Foo all foos',
+                '      undoc   --',
+                '',
+                "See 'exa help <command>' for information on a specific command.",
+                ]), anchored=True)
+            s.run('help', 'foo').assertSucess().stdout.matches(lines_exact([
+                'Usage: exa foo [-e]',
+                '',
+                'Foo them all.',
+                '',
+                'Options:',
+                '   -e  Only the even foos',
+                ]), anchored=True)
+            s.run('help', 'baz').assertSucess().stdout.matches(lines_exact([
+                'Usage: exa baz <command> [<args>]',
+                '',
+                'The banner',
+                '',
+                'These are the available subcommands for exa baz:',
+                '      qux  Qux it',
+                '',
+                "See 'exa help baz <command>' for information on a specific command.",
+                ]), anchored=True)
+            s.run('help', 'undoc').assertSucess().stdout.matches(lines_exact([
+                "This command isn't documented yet.",
+                ]), anchored=True)
+            s.run('help', 'nope').assertFailure()
+
+    def test_run_many(self):
+        with TempSub(self, name='exa', thin=False) as s:
+            s.create_subcommand('greet', 'sh', """
+                echo "$_SUB_COMMAND_: $1 $2"
+                echo "to stderr" >&2
+                [ "$2" != fail ] || exit 3
+                """)
+            s.create_subcommand('sh-env', 'sh', 'echo export A=1')
+            s.create_subcommand('box/cmd', 'sh', '')
+
+            cap = s.run('run-many', '-j', '2', '-q', 'greet', 'hi', '--',
+                        'a', 'b', 'c').assertSucess()
+            self.assertEqual(sorted(cap.stdout.text.splitlines()), [
+                'a\tgreet: hi a', 'b\tgreet: hi b', 'c\tgreet: hi c'])
+            self.assertEqual(sorted(cap.stderr.text.splitlines()), [
+                'a\tto stderr', 'b\tto stderr', 'c\tto stderr'])
+
+            cap = s.run('run-many', '--group', 'greet', '{}', 'fail', '--', 'x', 'y')
+            self.assertEqual(cap.return_code, 3)
+            self.assertEqual(sorted(cap.stdout.text.splitlines()), [
+                'greet: x fail', 'greet: y fail'])
+            cap.stderr.contains('exa greet: 2 runs, 2 failed')
+            cap.stderr.contains('exa greet: failed with status 3 (x)')
+
+            s.run('run-many', '-q', 'greet', '--').assertSucess(
+                    ).stdout.is_empty()
+            s.run('run-many', 'env', '--', 'a').assertFailure()
+            s.run('run-many', 'box', '--', 'a').assertFailure()
+            s.run('run-many', 'nope', '--', 'a').assertFailure()
@@ -0,0 +1,127 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import json
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from . import utils
+from subdue.sub import catalog
+from subdue.sub import index as cmdindex
+
+
+class TestCatalog(SubdueTestCase):
+
+    def _make_sub(self, s):
+        s.create_subcommand('deploy', 'sh', """
+            # Usage: %COMMAND% <target>
+            # Summary: Deploy to a target
+            # Env: REGION PROFILE
+            """)
+        s.create_subcommand('sh-setenv', 'sh', """
+            # Summary: Set the environment
+            # Cache-TTL: 60
+            # Cache-Env: PROFILE
+            """)
+        s.create_subcommand('db/migrate', 'sh', '')
+        utils.create_subcommand(s.sub_root, 'db/doc.txt', '# Summary: Databases')
+        utils.create_subcommand(s.sub_root, 'db/notes', '# Summary: Not a command')
+        utils.create_subcommand(s.sub_root, 'report.py',
+                '# Summary: Report\n# subdue: main\n'
+                'def main(argv, env):\n    pass\n')
+        for name in ('db/doc.txt', 'db/notes', 'report.py'):
+            os.chmod(os.path.join(s.sub_root, 'commands', name), 0o600)
+        return os.path.join(s.sub_root, 'commands')
+
+    def test_records(self):
+        with TempSub(self, name='cat') as s:
+            commands = self._make_sub(s)
+            records = list(catalog.Catalog.load([commands]).walk())
+            self.assertEqual([record['command'] for record in records], [
+                ['db'], ['db', 'migrate'], ['deploy'], ['report'], ['setenv']])
+            db, migrate, deploy, report, setenv = records
+            self.assertEqual(db['summary'], 'Databases')
+            self.assertTrue(db['container'])
+            self.assertEqual(db['path'], os.path.join(commands, 'db'))
+            self.assertEqual(migrate['interpreter'], utils.which('sh'))
+            self.assertEqual(deploy, {
+                'command': ['deploy'],
+                'path': os.path.join(commands, 'deploy'),
+                'kind': 'command',
+                'container': False,
+                'eval': False,
+                'summary': 'Deploy to a target',
+                'usage': '%COMMAND% <target>',
+                'env': ['PROFILE', 'REGION'],
+                'interpreter': utils.which('sh'),
+                })
+            self.assertEqual(report['kind'], 'python')
+            self.assertIsNone(report['interpreter'])
+            self.assertTrue(setenv['eval'])
+            self.assertEqual(setenv['env'], ['PROFILE'])
+
+    def test_incremental(self):
+        with TempSub(self, name='cat') as s:
+            commands = self._make_sub(s)
+            age_tree(commands)
+            first = list(self.walk(commands))
+
+            # Unchanged: only the containers are stat'ed
+            probes = cmdindex.Probes.count
+            self.assertEqual(list(self.walk(commands)), first)
+            self.assertEqual(cmdindex.Probes.count - probes, 2)
+
+            # A new command: its container is listed again, and only the new
+            # file is read
+            s.create_subcommand('db/backup', 'sh', '# Summary: Back up')
+            age_tree(os.path.join(commands, 'db', 'backup'))
+            read = []
+            original = catalog.DirectorySource.read
+            catalog.DirectorySource.read = lambda self, rel: (
+                    read.append(rel) or original(self, rel))
+            try:
+                records = list(self.walk(commands))
+            finally:
+                catalog.DirectorySource.read = original
+            self.assertEqual(read, ['db/backup'])
+            self.assertEqual(records[1]['summary'], 'Back up')
+
+            # Editing in place is noticed when verifying
+            with open(os.path.join(commands, 'deploy'), 'a') as f:
+                f.write('# Env: EXTRA\n')
+            records = list(self.walk(commands, verify=True))
+            self.assertEqual(records[3]['env'], ['EXTRA', 'PROFILE', 'REGION'])
+
+    def walk(self, commands, verify=False):
+        commands_catalog = catalog.Catalog.load([commands])
+        for record in commands_catalog.walk(verify):
+            yield record
+        commands_catalog.save()
+
+    def test_layers(self):
+        with TempSub(self, name='cat') as s:
+            commands = self._make_sub(s)
+            extra = os.path.join(s.sub_root, 'extra')
+            os.makedirs(os.path.join(extra, 'db'))
+            utils.create_subcommand(s.sub_root, '../extra/db/seed', '# Summary: Seed', 'sh')
+            utils.create_subcommand(s.sub_root, '../extra/deploy', '# Summary: Other', 'sh')
+            records = list(catalog.Catalog.load([commands, extra]).walk())
+            self.assertEqual([(r['command'], r['summary']) for r in records], [
+                (['db'], 'Databases'),
+                (['db', 'migrate'], None),
+                (['db', 'seed'], 'Seed'),
+                (['deploy'], 'Deploy to a target'),
+                (['report'], 'Report'),
+                (['setenv'], 'Set the environment'),
+                ])
+
+    def test_builtin(self):
+        with TempSub(self, name='cat', thin=False) as s:
+            self._make_sub(s)
+            out = s.run('catalog').assertSucess().stdout.text.splitlines()
+            records = [json.loads(line) for line in out]
+            self.assertEqual(records[2]['usage'], 'cat deploy <target>')
+
+            text = s.run('catalog', '--format', 'json').assertSucess().stdout.text
+            self.assertEqual(json.loads(text), records)
@@ -2,7 +2,19 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import os
+import re
+import textwrap
+
 from .utils import SubdueTestCase, TempSub
+from . import utils
+
+
+def create_python_command(sub_root, name, contents):
+    utils.create_subcommand(sub_root, name,
+                            '# subdue: main\n' + textwrap.dedent(contents))
+    os.chmod(os.path.join(sub_root, 'commands', *name.split('/')), 0o600)
+
 
 class TestCommandExecution(SubdueTestCase):
 
@@ -26,3 +38,51 @@ class TestCommandExecution(SubdueTestCase):
                 ).run_it('foo', 'bar', '-a', 'baz'
                 ).assertSucess(
                 ).stdout.matches(r'^My arguments: foo bar -a baz')
+
+    def test_python_function_command(self):
+        with TempSub(self, name='py', thin=False) as sub:
+            create_python_command(sub.sub_root, 'tools/greet.py', '''\
+                import os
+                import sys
+
+                def main(argv, env):
+                    print("Hello {0} from {1} [{2}] {3}".format(
+                        ' '.join(argv), env['_SUB_COMMAND_'],
+                        os.environ['_SUB_PATH_COMMAND_'], sys.argv[1:]))
+                    return len(argv)
+                ''')
+            path = os.path.join(sub.sub_root, 'commands', 'tools', 'greet.py')
+
+            sub.run('tools', 'greet', 'a', 'b').assertFailure(
+                ).stdout.matches(re.escape(
+                    "Hello a b from tools greet [{0}] ['a', 'b']".format(path)))
+            sub.run('tools', 'greet').assertSucess()
+            sub.run('commands', 'tools').assertSucess(
+                ).stdout.matches('^greet$', anchored=True)
+
+    def test_python_command_precedence(self):
+        with TempSub(self, name='py', thin=False) as sub:
+            sub.create_subcommand('cmd', 'sh', 'echo "script"')
+            create_python_command(sub.sub_root, 'cmd.py',
+                    'def main(argv, env):\n    print("python")\n')
+            sub.run('cmd').assertSucess().stdout.matches('^script$')
+
+    def test_python_command_without_main(self):
+        with TempSub(self, name='py', thin=False) as sub:
+            create_python_command(sub.sub_root, 'nomain.py', 'x = 1\n')
+            sub.run('nomain').assertFailure().stderr.contains('no main(argv, env)')
+
+    def test_python_files_without_opt_in(self):
+        with TempSub(self, name='py', thin=False) as sub:
+            # Helper modules are not commands
+            utils.create_subcommand(sub.sub_root, 'helper.py',
+                                    'print("imported")\n')
+            os.chmod(os.path.join(sub.sub_root, 'commands', 'helper.py'), 0o600)
+            # Executable scripts only run as themselves, even if they opt in
+            sub.create_subcommand('tool.py', 'sh', '# subdue: main\necho tool')
+            sub.run('commands').assertSucess(
+                ).stdout.matches('^tool.py$', anchored=False)
+            self.assertNotIn('helper', sub.run('commands').stdout.text)
+            sub.run('helper').assertFailure().stdout.matches('^$')
+            sub.run('tool').assertFailure().stdout.matches('^$')
+            sub.run('tool.py').assertSucess().stdout.matches('^tool$')
@@ -0,0 +1,188 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import threading
+import tempfile
+import shutil
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from . import utils
+from subdue.sub import _main
+from subdue.sub import daemon
+from subdue.sub import index as cmdindex
+
+
+class TestResolverDaemon(SubdueTestCase):
+
+    def setUp(self):
+        super(TestResolverDaemon, self).setUp()
+        self._prev_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        self.runtime_dir = tempfile.mkdtemp()
+        os.environ['XDG_RUNTIME_DIR'] = self.runtime_dir
+
+    def tearDown(self):
+        if self._prev_runtime_dir is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = self._prev_runtime_dir
+        shutil.rmtree(self.runtime_dir)
+        super(TestResolverDaemon, self).tearDown()
+
+    def start_daemon(self, sub_root, idle_timeout=10):
+        server = daemon.ResolverDaemon(_main.SubPaths(sub_root), idle_timeout)
+        self.assertTrue(server.bind())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        return server, thread
+
+    def stop_daemon(self, sub_root, thread):
+        daemon.request(sub_root, {'op': 'stop'})
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_resolve(self):
+        with TempSub(self, name='daem') as s:
+            s.create_subcommand('dir/cmd', 'sh', 'echo "in cmd $_SUB_COMMAND_ $@"')
+            s.create_subcommand('sh-evalme', 'sh', '')
+            server, thread = self.start_daemon(s.sub_root)
+            try:
+                response = daemon.request(s.sub_root, {
+                    'op': 'resolve', 'argv': ['dir', 'cmd', 'x'], 'shell': 'bash'})
+                self.assertEqual(response['status'], 'exec')
+                self.assertEqual(response['path'],
+                        os.path.join(s.sub_root, 'commands', 'dir', 'cmd'))
+                self.assertEqual(response['arguments'], ['x'])
+                self.assertEqual(response['env']['_SUB_COMMAND_'], 'dir cmd')
+                self.assertEqual(response['env']['_SUB_SHELL_'], 'bash')
+                self.assertEqual(response['env']['_SUB_IS_EVAL_'], '0')
+
+                response = daemon.request(s.sub_root, {
+                    'op': 'resolve', 'argv': ['evalme']})
+                self.assertEqual(response['env']['_SUB_IS_EVAL_'], '1')
+
+                response = daemon.request(s.sub_root, {
+                    'op': 'resolve', 'argv': ['dir', 'nope']})
+                self.assertEqual(response['status'], 'error')
+
+                response = daemon.request(s.sub_root, {
+                    'op': 'resolve', 'argv': ['commands']})
+                self.assertEqual(response['status'], 'fallback')
+
+                # A driver uses the daemon when it is running
+                caller = utils.SubprocessCaller()
+                with utils.OutStreamCheckedCapture(self) as cap:
+                    handled = daemon.run_through_daemon(
+                            s.sub_root, ['dir', 'cmd', 'y'], command_runner=caller)
+                self.assertTrue(handled)
+                self.assertEqual(caller.returncode, 0)
+                cap.stdout.matches('^in cmd dir cmd y$')
+
+                # And when going through the whole driver
+                s.run('dir', 'cmd', 'z').assertSucess(
+                        ).stdout.matches('^in cmd dir cmd z$')
+            finally:
+                self.stop_daemon(s.sub_root, thread)
+            self.assertFalse(os.path.exists(server.socket_path))
+
+    def test_fallback_without_daemon(self):
+        with TempSub(self, name='daem') as s:
+            s.create_subcommand('cmd', 'sh', 'echo "in cmd"')
+            self.assertFalse(daemon.run_through_daemon(s.sub_root, ['cmd']))
+            s.run('cmd').assertSucess().stdout.matches('^in cmd$')
+
+    def test_idle_timeout(self):
+        with TempSub(self, name='daem') as s:
+            server, thread = self.start_daemon(s.sub_root, idle_timeout=0.2)
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(os.path.exists(server.socket_path))
+            self.assertIsNone(daemon.request(s.sub_root, {'op': 'ping'}))
+
+    def test_watched_index(self):
+        with TempSub(self, name='daem') as s:
+            s.create_subcommand('dir/cmd', 'sh', '')
+            age_tree(os.path.join(s.sub_root, 'commands'))
+            templates = os.path.join(s.sub_root, 'templates')
+            os.mkdir(templates)
+            original = daemon.template_dir
+            daemon.template_dir = lambda: templates
+            server, thread = self.start_daemon(s.sub_root)
+            try:
+                resolve = {'op': 'resolve', 'argv': ['dir', 'cmd']}
+                self.assertEqual(daemon.request(s.sub_root, resolve)['status'], 'exec')
+
+                # Once watched, the tree is not probed at all
+                probes = cmdindex.Probes.count
+                self.assertEqual(daemon.request(s.sub_root, resolve)['status'], 'exec')
+                self.assertEqual(cmdindex.Probes.count, probes)
+
+                s.create_subcommand('dir/new', 'sh', '')
+                response = daemon.request(s.sub_root, {
+                    'op': 'resolve', 'argv': ['dir', 'new']})
+                self.assertEqual(response['status'], 'exec')
+
+                # A new version of subdue retires the daemon
+                with open(os.path.join(templates, 'new.tpl'), 'w') as f:
+                    f.write('')
+                self.assertEqual(daemon.request(s.sub_root, resolve)['status'],
+                                 'fallback')
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+            finally:
+                daemon.template_dir = original
+                self.stop_daemon(s.sub_root, thread)
+
+    def test_untrusted_runtime_dir(self):
+        with TempSub(self, name='daem') as s:
+            s.create_subcommand('cmd', 'sh', 'echo "in cmd"')
+            server, thread = self.start_daemon(s.sub_root)
+            try:
+                # Requests for another sub with the same socket are declined
+                response = daemon.request(s.sub_root, {
+                    'op': 'resolve', 'argv': ['cmd'], 'root': '/elsewhere'})
+                self.assertEqual(response['status'], 'fallback')
+
+                # A runtime directory others can use is not trusted
+                directory = os.path.dirname(server.socket_path)
+                os.chmod(directory, 0o755)
+                self.assertIsNone(daemon.request(s.sub_root, {'op': 'ping'}))
+                self.assertFalse(daemon.run_through_daemon(s.sub_root, ['cmd']))
+                self.assertRaises(OSError, daemon.ResolverDaemon(
+                    _main.SubPaths(s.sub_root)).bind)
+                os.chmod(directory, 0o700)
+            finally:
+                self.stop_daemon(s.sub_root, thread)
+
+    def test_command_roots_override(self):
+        with TempSub(self, name='daem') as s:
+            s.create_subcommand('dir/x', 'sh', 'echo base')
+            overlay = os.path.join(s.sub_root, 'over')
+            utils.create_subcommand(s.sub_root, '../over/dir/x', 'echo overlay', 'sh')
+            driver = os.path.join(s.sub_root, 'bin', 'daem')
+            server, thread = self.start_daemon(s.sub_root)
+            try:
+                caller = utils.SubprocessCaller()
+                with utils.OutStreamCheckedCapture(self) as cap:
+                    self.assertTrue(daemon.run_through_daemon(
+                        s.sub_root, ['dir', 'x'], driver_path=driver,
+                        command_runner=caller))
+                cap.stdout.matches('^base$')
+
+                # Roots from the environment of the driver are not the ones
+                # of the daemon, so the driver resolves by itself
+                variable = _main.command_roots_var('daem')
+                os.environ[variable] = overlay
+                try:
+                    self.assertFalse(daemon.run_through_daemon(
+                        s.sub_root, ['dir', 'x'], driver_path=driver))
+                    caller = utils.SubprocessCaller()
+                    with utils.OutStreamCheckedCapture(self) as cap:
+                        _main.do_main(['dir', 'x'], sub_path=s.sub_root,
+                                      driver_path=driver, command_runner=caller)
+                    cap.stdout.matches('^overlay$')
+                finally:
+                    del os.environ[variable]
+            finally:
+                self.stop_daemon(s.sub_root, thread)
@@ -3,8 +3,10 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import os
+import json
 
-from .utils import SubdueTestCase, TemporaryDirectory, OutStreamCheckedCapture
+from .utils import SubdueTestCase, TemporaryDirectory, OutStreamCheckedCapture, age_tree
+from .utils import TempSub
 from . import utils
 import subdue
 
@@ -17,7 +19,7 @@ class TestDriverMain(SubdueTestCase):
         """
         with OutStreamCheckedCapture(self) as cap:
             subdue.sub.main([], exit=False)
-        cap.stdout.contains("built-in command: help not yet implemented")
+        cap.stdout.contains("Usage: ")
 
     def test_top_level_launch_thin(self):
         """
@@ -103,3 +105,147 @@ class TestDriverOptions(SubdueTestCase):
             self.assertIsEval(sub_root, 'eval')
             self.assertIsNotEval(sub_root, 'sh-eval')
             self.assertIsNotEval(sub_root, 'foobar')
+
+    def test_eval_fd(self):
+        subname = 'evalsub'
+        with TemporaryDirectory(cd=True) as d:
+
+            with OutStreamCheckedCapture(self):
+                subdue.main(['subdue', 'new', subname])
+
+            sub_root = os.path.join(d, subname)
+            driver = os.path.join(sub_root, 'bin', subname)
+            utils.create_subcommand(sub_root, 'sh-eval', """\
+                #!/bin/bash
+                echo "This is my eval command"
+                """)
+            utils.create_subcommand(sub_root, 'foobar', """\
+                #!/bin/bash
+                echo "This is my regular command"
+                """)
+
+            # Eval output goes to the descriptor, after the marker
+            with OutStreamCheckedCapture(self) as cap:
+                return_code = utils.call_bash(
+                        '"{0}" --eval-fd 3 eval 3>&1 >/dev/null'.format(driver))
+            self.assertEqual(return_code, 0)
+            cap.stdout.matches(subdue.sub._main.EVAL_MARKER +
+                    '\nThis is my eval command\n', anchored=True)
+
+            # Regular commands leave the descriptor alone
+            with OutStreamCheckedCapture(self) as cap:
+                return_code = utils.call_bash(
+                        '"{0}" --eval-fd 3 foobar 3>/dev/null'.format(driver))
+            self.assertEqual(return_code, 0)
+            cap.stdout.matches('This is my regular command\n', anchored=True)
+
+    def test_shell_wrapper(self):
+        subname = 'wrapsub'
+        with TemporaryDirectory(cd=True) as d:
+
+            with OutStreamCheckedCapture(self):
+                subdue.main(['subdue', 'new', subname])
+
+            sub_root = os.path.join(d, subname)
+            driver = os.path.join(sub_root, 'bin', subname)
+            utils.create_subcommand(sub_root, 'sh-setvar', """\
+                #!/bin/bash
+                echo "FOO=evalled"
+                """)
+            utils.create_subcommand(sub_root, 'fail', """\
+                #!/bin/bash
+                echo "failing"
+                exit 3
+                """)
+
+            script = """
+                eval "$("{0}" init --full --shell bash)"
+                _subdue_{1}_wrapper setvar
+                echo "setvar rc=$? FOO=$FOO"
+                _subdue_{1}_wrapper fail
+                echo "fail rc=$?"
+                """.format(driver, subname)
+            with OutStreamCheckedCapture(self) as cap:
+                return_code = utils.call_bash(script)
+            self.assertEqual(return_code, 0, str(cap))
+            cap.stdout.matches('setvar rc=0 FOO=evalled\nfailing\nfail rc=3\n',
+                               anchored=True)
+
+
+class TestDriverArgs(SubdueTestCase):
+
+    def test_parse_args(self):
+        parse_args = subdue.sub._main.parse_args
+
+        args = parse_args(['--shell', 'bash', '--eval-fd', '3', 'cmd', '-x', '--shell'])
+        self.assertEqual(args.shell, 'bash')
+        self.assertEqual(args.eval_fd, 3)
+        self.assertFalse(args.is_eval)
+        self.assertFalse(args.help)
+        self.assertEqual(args.args, ['cmd', '-x', '--shell'])
+
+        args = parse_args(['--shell=zsh', '--is-eval', 'cmd'])
+        self.assertEqual(args.shell, 'zsh')
+        self.assertTrue(args.is_eval)
+        self.assertEqual(args.args, ['cmd'])
+
+        args = parse_args(['-h'])
+        self.assertTrue(args.help)
+        self.assertEqual(args.args, [])
+
+        with OutStreamCheckedCapture(self) as cap:
+            self.assertRaises(SystemExit, parse_args, ['--bogus', 'cmd'])
+        cap.stderr.contains('--bogus')
+
+
+class TestDriverTrace(SubdueTestCase):
+
+    def setUp(self):
+        super(TestDriverTrace, self).setUp()
+        self.trace_dir = TemporaryDirectory()
+        self.trace_path = os.path.join(self.trace_dir.name, 'trace.jsonl')
+        os.environ['SUBDUE_TRACE'] = self.trace_path
+
+    def tearDown(self):
+        del os.environ['SUBDUE_TRACE']
+        self.trace_dir.__exit__(None, None, None)
+        super(TestDriverTrace, self).tearDown()
+
+    def read_trace(self):
+        with open(self.trace_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_trace(self):
+        with TempSub(self, name='traced', thin=False) as s:
+            s.create_subcommand('dir/cmd', 'sh', 'true')
+            age_tree(os.path.join(s.sub_root, 'commands'))
+            s.run('dir', 'cmd', 'arg').assertSucess()
+            s.run('dir', 'cmd', 'arg').assertSucess()
+            s.run('commands').assertSucess()
+            path = os.path.join(s.sub_root, 'commands', 'dir', 'cmd')
+
+        cold, warm, builtin = self.read_trace()
+        self.assertEqual(cold['argv'], ['dir', 'cmd', 'arg'])
+        self.assertEqual([phase for phase, _ in cold['phases']], [
+            'start', 'parse_args', 'paths', 'environment', 'find_command_path',
+            'environment_save', 'exec'])
+        timestamps = [timestamp for _, timestamp in cold['phases']]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(cold['command']['path'], path)
+        self.assertEqual(cold['command']['tokens'], ['dir', 'cmd'])
+        self.assertFalse(cold['command']['eval'])
+
+        # With a warm index, there is one probe per container level, and the
+        # command is read for a Cache-TTL header before running it
+        self.assertGreater(cold['probes'], warm['probes'])
+        self.assertEqual(warm['probes'], 3)
+
+        self.assertEqual(builtin['command']['tokens'], ['commands'])
+        self.assertTrue(builtin['command']['builtin'])
+        self.assertEqual(builtin['phases'][-1][0], 'end')
+
+    def test_unwritable_trace(self):
+        os.environ['SUBDUE_TRACE'] = os.path.join(self.trace_path, 'nope')
+        with TempSub(self, name='traced', thin=False) as s:
+            s.create_subcommand('cmd', 'sh', 'echo "ran"')
+            s.run('cmd').assertSucess().stdout.matches('^ran$')
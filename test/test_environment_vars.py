@@ -83,6 +83,46 @@ class TestEnvironmentVariables(SubdueTestCase):
             self.assertEqual(os.path.join(s.sub_root, 'bin'), paths.pop(0))
             self.assertEqual(os.path.join(s.sub_root, 'lib'), paths.pop(0))
 
+    def test_nested_path(self):
+        """
+        Calling the sub from one of its commands does not grow PATH
+        """
+        with TempSub(self, name='nested', thin=False) as s:
+            s.create_subcommand('inner', 'sh', 'echo "$PATH"')
+            s.create_subcommand('outer', 'sh', 'echo "$PATH"; nested inner')
+            out = s.run('outer').assertSucess().stdout.text.splitlines()
+        self.assertEqual(len(out), 2)
+        self.assertEqual(out[0], out[1])
+        paths = out[0].split(':')
+        self.assertEqual(paths.count(os.path.join(s.sub_root, 'bin')), 1)
+
+    def test_custom_runner(self):
+        """
+        Runners given to main only get the argv of the command, and find its
+        environment in the one of this process
+        """
+        import subdue.sub
+        calls = []
+        def runner(args):
+            calls.append((args, os.environ.get('_SUB_COMMAND_')))
+        with TempSub(self, name='custom') as s:
+            s.create_subcommand('show', 'sh', '')
+            environ = dict(os.environ)
+            try:
+                subdue.sub.main(['show', 'x'], sub_path=s.sub_root, exit=False,
+                                command_runner=runner)
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            path = os.path.join(s.sub_root, 'commands', 'show')
+        self.assertEqual(calls, [([path, 'x'], 'show')])
+
+    def test_normalize_path(self):
+        from subdue.sub._main import normalize_path
+        self.assertEqual(
+                normalize_path(['/a/b/', '/usr/bin', '/a//b', '', '/usr/bin/', '.']),
+                ['/a/b', '/usr/bin', '.'])
+
 
 class TestEnvironmentVariablesOnThinSub(SubdueTestCase):
 
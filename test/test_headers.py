@@ -0,0 +1,128 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import time
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from subdue.sub import headers
+
+
+class TestHeaders(SubdueTestCase):
+
+    def test_parse(self):
+        doc = headers.parse_headers([
+            '#!/bin/sh',
+            '  #  Usage: exa foo [-e]  ',
+            '# Summary: Foo all foos',
+            '# Help:',
+            '# Foo them all.',
+            '#',
+            '# Options:',
+            '#    -e  Only the even foos',
+            '',
+            '# Not help',
+            ])
+        self.assertEqual(doc['usage'], 'exa foo [-e]')
+        self.assertEqual(doc['summary'], 'Foo all foos')
+        self.assertEqual(doc['help'],
+                'Foo them all.\n\nOptions:\n   -e  Only the even foos')
+
+    def test_directives_must_be_early(self):
+        lines = ['echo'] * headers.MAX_LINES + ['# Summary: Too late']
+        self.assertIsNone(headers.parse_headers(lines)['summary'])
+
+    def test_bounded_prefix(self):
+        with TempSub(self, name='hdr') as s:
+            s.create_subcommand('big', 'sh', '# Summary: Big one\n' +
+                    'echo\n' * headers.MAX_BYTES)
+            path = os.path.join(s.sub_root, 'commands', 'big')
+            lines = headers.read_prefix(path)
+            self.assertEqual(len(lines), headers.MAX_LINES)
+            self.assertEqual(headers.read_summary(path), ('Big one', None))
+
+    def test_cache(self):
+        with TempSub(self, name='hdr') as s:
+            s.create_subcommand('foo', 'sh', '# Summary: Foo all foos')
+            path = os.path.join(s.sub_root, 'commands', 'foo')
+            age_tree(path)
+
+            reads = []
+            read_summary = headers.read_summary
+            def counting_read_summary(path):
+                reads.append(path)
+                return read_summary(path)
+            headers.read_summary = counting_read_summary
+            try:
+                cache = headers.HeaderCache.load(s.sub_root)
+                self.assertEqual(cache.summary(path), ('Foo all foos', None))
+                cache.save()
+                self.assertEqual(len(reads), 1)
+
+                # A new invocation does not read the file again
+                cache = headers.HeaderCache.load(s.sub_root)
+                self.assertEqual(cache.summary(path), ('Foo all foos', None))
+                self.assertEqual(len(reads), 1)
+
+                # Until it changes
+                with open(path, 'a') as f:
+                    f.write('# Usage: foo\n')
+                age_tree(path, 30)
+                cache = headers.HeaderCache.load(s.sub_root)
+                self.assertEqual(cache.summary(path), ('Foo all foos', 'foo'))
+                self.assertEqual(len(reads), 2)
+            finally:
+                headers.read_summary = read_summary
+
+    def test_recent_files_not_cached(self):
+        with TempSub(self, name='hdr') as s:
+            s.create_subcommand('foo', 'sh', '# Summary: Foo all foos')
+            path = os.path.join(s.sub_root, 'commands', 'foo')
+            cache = headers.HeaderCache.load(s.sub_root)
+            self.assertEqual(cache.summary(path), ('Foo all foos', None))
+            self.assertNotIn(path, cache.files)
+
+    def test_parallel_map(self):
+        def slow_square(n):
+            time.sleep(0.001 * (n % 3))
+            return n * n
+        items = list(range(50))
+        expected = [n * n for n in items]
+        for workers in (1, 4, 100):
+            self.assertEqual(
+                    headers.parallel_map(slow_square, items, workers), expected)
+        self.assertEqual(headers.parallel_map(slow_square, [], 4), [])
+
+        def fail(n):
+            raise ValueError(n)
+        self.assertRaises(ValueError, headers.parallel_map, fail, items, 4)
+
+    def test_scan_workers(self):
+        previous = os.environ.get(headers.WORKERS_VAR)
+        try:
+            os.environ[headers.WORKERS_VAR] = '3'
+            self.assertEqual(headers.scan_workers(), 3)
+            os.environ[headers.WORKERS_VAR] = '0'
+            self.assertEqual(headers.scan_workers(), 1)
+            os.environ[headers.WORKERS_VAR] = 'many'
+            self.assertEqual(headers.scan_workers(), headers.DEFAULT_WORKERS)
+        finally:
+            if previous is None:
+                del os.environ[headers.WORKERS_VAR]
+            else:
+                os.environ[headers.WORKERS_VAR] = previous
+
+    def test_summaries_order(self):
+        with TempSub(self, name='hdr') as s:
+            paths = []
+            for i in range(40):
+                name = 'cmd{0:02}'.format(i)
+                s.create_subcommand(name, 'sh', '# Summary: Number {0}'.format(i))
+                paths.append(os.path.join(s.sub_root, 'commands', name))
+            cache = headers.HeaderCache.load(s.sub_root)
+            serial = cache.summaries(paths, workers=1)
+            cache = headers.HeaderCache.load(s.sub_root)
+            parallel = cache.summaries(paths, workers=8)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial[7], ('Number 7', None))
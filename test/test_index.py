@@ -0,0 +1,160 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from . import utils
+import subdue.sub
+from subdue.sub import _main
+from subdue.sub import index as cmdindex
+
+
+class TestCommandIndex(SubdueTestCase):
+
+    COMMANDS = [
+        'cmd1',
+        'sh-evalme',
+        'dir1/cmd1.1',
+        'dir1/dir1.1/cmd1.1.1',
+        ]
+
+    def _make_sub(self, s):
+        for command in self.COMMANDS:
+            s.create_subcommand(command, 'sh', '')
+        commands = os.path.join(s.sub_root, 'commands')
+        age_tree(commands)
+        return _main.SubPaths(s.sub_root), commands
+
+    def assertSameCommand(self, expected, actual):
+        self.assertEqual(repr(expected), repr(actual))
+
+    def test_index_matches_filesystem(self):
+        with TempSub(self, name='idx') as s:
+            paths, commands = self._make_sub(s)
+            index = cmdindex.open_index(commands)
+            for argv in (['cmd1', 'a'], ['evalme'], ['dir1', 'cmd1.1', '-x'],
+                         ['dir1', 'dir1.1', 'cmd1.1.1'], ['dir1'],
+                         ['dir1', 'nope'], ['nope', 'cmd1']):
+                expected = _main.find_command_in_filesystem(argv, paths)
+                self.assertSameCommand(expected,
+                        _main.find_command_path(argv, paths, index=index))
+
+            # Everything has been scanned and saved now, a new index resolves
+            # the same commands without falling back to the filesystem
+            index = cmdindex.open_index(commands)
+            for argv in (['cmd1', 'a'], ['evalme'],
+                         ['dir1', 'dir1.1', 'cmd1.1.1'], ['dir1']):
+                expected = _main.find_command_in_filesystem(argv, paths)
+                self.assertSameCommand(expected,
+                        _main.find_command_in_index(argv, index))
+
+            # Misses are left to the filesystem, since making a file
+            # executable does not change its container
+            self.assertIsNone(
+                    _main.find_command_in_index(['dir1', 'nope'], index))
+
+    def test_cold_index_falls_back(self):
+        with TempSub(self, name='idx') as s:
+            paths, commands = self._make_sub(s)
+            index = cmdindex.open_index(commands)
+            self.assertIsNone(_main.find_command_in_index(['cmd1'], index))
+            self.assertEqual(index.stale, set(['']))
+            command = _main.find_command_path(['cmd1'], paths, index=index)
+            self.assertTrue(command.found)
+            self.assertEqual(index.stale, set())
+            self.assertTrue(os.path.isfile(index.cache_path))
+
+    def test_stale_container_is_rescanned(self):
+        with TempSub(self, name='idx') as s:
+            paths, commands = self._make_sub(s)
+            index = cmdindex.open_index(commands)
+            _main.find_command_path(['dir1', 'cmd1.1'], paths, index=index)
+
+            s.create_subcommand('dir1/new', 'sh', '')
+            index = cmdindex.open_index(commands)
+            self.assertIsNone(_main.find_command_in_index(['dir1', 'new'], index))
+            self.assertEqual(index.stale, set(['dir1']))
+            command = _main.find_command_path(['dir1', 'new'], paths, index=index)
+            self.assertTrue(command.found)
+
+            age_tree(commands)
+            index = cmdindex.open_index(commands)
+            _main.find_command_path(['dir1', 'new'], paths, index=index)
+            index = cmdindex.open_index(commands)
+            command = _main.find_command_in_index(['dir1', 'new'], index)
+            self.assertIsNotNone(command)
+            self.assertTrue(command.found)
+
+    def test_permission_changes(self):
+        with TempSub(self, name='idx') as s:
+            paths, commands = self._make_sub(s)
+            s.create_subcommand('dir1/later', 'sh', 'echo later')
+            later = os.path.join(commands, 'dir1', 'later')
+            os.chmod(later, 0o644)
+            age_tree(commands)
+
+            def run(*args):
+                caller = utils.SubprocessCaller()
+                with utils.OutStreamCapture() as cap:
+                    result = subdue.sub.main(list(args), sub_path=s.sub_root,
+                                             exit=False, command_runner=caller)
+                return result, cap.stdout
+
+            result = run('dir1', 'later')[0]
+            self.assertIn("no such command `dir1 later'", str(result.code))
+
+            # Becoming executable does not change the container
+            os.chmod(later, 0o755)
+            self.assertEqual(run('dir1', 'later')[1], 'later\n')
+            index = cmdindex.open_index(commands)
+            self.assertTrue(
+                    _main.find_command_in_index(['dir1', 'later'], index).found)
+
+            # Nor does the opposite, which is found out when running it
+            os.chmod(later, 0o644)
+            with utils.OutStreamCapture():
+                result = subdue.sub.main(['dir1', 'later'], sub_path=s.sub_root,
+                                         exit=False)
+            self.assertIn("no such command `dir1 later'", str(result.code))
+            index = cmdindex.open_index(commands)
+            self.assertIsNone(
+                    _main.find_command_in_index(['dir1', 'later'], index))
+
+    def test_concurrent_writers_keep_records(self):
+        with TempSub(self, name='idx') as s:
+            paths, commands = self._make_sub(s)
+            first = cmdindex.open_index(commands)
+            second = cmdindex.open_index(commands)
+            first.scan('dir1')
+            second.scan('dir1/dir1.1')
+            first.save()
+            second.save()
+            merged = cmdindex.open_index(commands)
+            self.assertIn('dir1', merged.dirs)
+            self.assertIn('dir1/dir1.1', merged.dirs)
+
+    @unittest.skipUnless(hasattr(os, 'scandir'), "needs os.scandir")
+    def test_filesystem_probes(self):
+        with TempSub(self, name='idx') as s:
+            paths, commands = self._make_sub(s)
+            with open(os.path.join(commands, 'pyfunc.py'), 'w') as f:
+                f.write('# subdue: main\ndef main(argv, env):\n    pass\n')
+            # One listing per container, plus one probe for the executable
+            # that matches. Misses only cost the listing. Python function
+            # commands are also checked not to be executable, and read.
+            for argv, expected in ((['dir1', 'dir1.1', 'cmd1.1.1'], 4),
+                                   (['cmd1', 'a'], 2),
+                                   (['evalme'], 2),
+                                   (['pyfunc'], 3),
+                                   (['dir1', 'nope'], 2),
+                                   (['nope', 'cmd1'], 1)):
+                probes = cmdindex.Probes.count
+                _main.find_command_in_filesystem(argv, paths)
+                self.assertEqual(cmdindex.Probes.count - probes, expected, argv)
+
+    def test_disabled_cache(self):
+        os.environ['SUBDUE_CACHE_DIR'] = ''
+        self.assertIsNone(cmdindex.open_index('/nonexistent'))
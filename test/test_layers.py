@@ -0,0 +1,127 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import re
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from . import utils
+from subdue.sub import _main
+from subdue.sub import index as cmdindex
+
+
+class TestLayeredCommands(SubdueTestCase):
+
+    LAYERS = {
+        'user': ['dir/mine', 'shadow', 'only-user', 'sh-base'],
+        'team': ['dir/sub/deep', 'dir/shadowed', 'sh-team', 'box/x'],
+        'commands': ['shadow/hidden', 'dir/base', 'dir/shadowed', 'base',
+                     'box'],
+        }
+
+    def _make_sub(self, s):
+        for layer, commands in self.LAYERS.items():
+            for command in commands:
+                utils.create_subcommand(
+                        s.sub_root, '../{0}/{1}'.format(layer, command),
+                        'echo {0} {1}'.format(layer, command), 'sh')
+        age_tree(s.sub_root)
+        return _main.SubPaths(s.sub_root, os.path.join(s.sub_root, 'bin', 'exa'),
+                              command_roots=['team', 'commands'])
+
+    def setUp(self):
+        super(TestLayeredCommands, self).setUp()
+        self.var = _main.command_roots_var('exa')
+        os.environ[self.var] = 'user'
+
+    def tearDown(self):
+        del os.environ[self.var]
+        super(TestLayeredCommands, self).tearDown()
+
+    def test_command_roots(self):
+        self.assertEqual(self.var, 'SUBDUE_EXA_COMMAND_ROOTS')
+        paths = _main.SubPaths('/sub', '/sub/bin/exa',
+                               command_roots=['/team', 'commands', '/team'])
+        self.assertEqual(paths.command_roots,
+                         ['/sub/user', '/team', '/sub/commands'])
+        del os.environ[self.var]
+        self.assertEqual(_main.SubPaths('/sub', '/sub/bin/exa').command_roots,
+                         ['/sub/commands'])
+        os.environ[self.var] = 'user'
+
+    def test_resolution(self):
+        with TempSub(self, name='exa') as s:
+            paths = self._make_sub(s)
+            root = s.sub_root
+            expected = [
+                (['dir', 'mine'], 'user/dir/mine'),
+                (['dir', 'shadowed'], 'team/dir/shadowed'),
+                (['dir', 'base'], 'commands/dir/base'),
+                (['dir', 'sub', 'deep'], 'team/dir/sub/deep'),
+                (['shadow', 'hidden'], 'user/shadow'),
+                (['team'], 'team/sh-team'),
+                (['box', 'x'], 'team/box/x'),
+                (['dir'], 'user/dir'),
+                # All the variants of a name are tried in a root before the
+                # next one
+                (['base'], 'user/sh-base'),
+                (['nope'], None),
+                ]
+            index = cmdindex.open_index(paths.command_roots)
+            self.assertIsInstance(index, cmdindex.LayeredIndex)
+            for find in (
+                    lambda argv: _main.find_command_in_filesystem(argv, paths),
+                    lambda argv: _main.find_command_path(argv, paths, index=index),
+                    lambda argv: _main.find_command_in_index(argv, index)):
+                for argv, path in expected:
+                    command = find(argv)
+                    if command is None and path is None:
+                        # Misses are left to the filesystem by the index
+                        continue
+                    self.assertEqual(command.path, path and os.path.join(root, path),
+                                     argv)
+            index.save()
+
+            # Without an index, each container is listed once in each root
+            # that has it: three times at the top and for dir, then once for
+            # dir/sub, plus a probe for deep
+            probes = cmdindex.Probes.count
+            command = _main.find_command_in_filesystem(['dir', 'sub', 'deep'], paths)
+            self.assertEqual(command.path, os.path.join(root, 'team/dir/sub/deep'))
+            self.assertEqual(cmdindex.Probes.count - probes, 3 + 3 + 2)
+
+            # A warm index only checks the containers in the roots that have
+            # them: one per root at the top, two for dir, one for dir/sub
+            index = cmdindex.open_index(paths.command_roots)
+            probes = cmdindex.Probes.count
+            command = _main.find_command_path(['dir', 'sub', 'deep'], paths,
+                                              index=index)
+            self.assertEqual(command.path, os.path.join(root, 'team/dir/sub/deep'))
+            self.assertEqual(cmdindex.Probes.count - probes, 3 + 3 + 1)
+
+    def test_builtins(self):
+        with TempSub(self, name='exa', thin=False) as s:
+            self._make_sub(s)
+            # The driver only knows about the commands directory and the
+            # roots in the environment
+            s.run('commands').assertSucess().stdout.matches(
+                    '\n'.join(['base', 'box', 'dir', 'only-user', 'shadow']) + '\n',
+                    anchored=True)
+            s.run('commands', 'dir').assertSucess().stdout.matches(
+                    '\n'.join(['base', 'mine', 'shadowed']) + '\n', anchored=True)
+            s.run('commands', 'shadow').assertFailure()
+            s.run('commands', '--recursive', '--sort').assertSucess(
+                    ).stdout.matches('\n'.join([
+                        'base', 'box', 'dir', 'dir base', 'dir mine',
+                        'dir shadowed', 'only-user', 'shadow']) + '\n',
+                        anchored=True)
+            s.run('dir', 'mine').assertSucess().stdout.matches(
+                    'user dir/mine\n', anchored=True)
+            s.run('base').assertSucess().stdout.matches(
+                    'user sh-base\n', anchored=True)
+            s.run('help').assertSucess().stdout.contains('only-user')
+            s.run('help', 'dir').assertSucess().stdout.matches(
+                    re.escape('   mine'))
+            s.run('completions', 'dir', '').assertSucess().stdout.matches(
+                    'base\nmine\nshadowed\n', anchored=True)
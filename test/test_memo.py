@@ -0,0 +1,132 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import signal
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from subdue.sub import memo
+from subdue.sub import _main
+from subdue.sub import index as cmdindex
+
+
+QUERY = """
+    # Summary: Expensive query
+    # Cache-TTL: 300
+    # Cache-Env: REGION
+    echo run >> "$_SUB_PATH_ROOT_/runs"
+    echo "answer $1 $REGION"
+    exit 2
+    """
+
+
+class TestMemo(SubdueTestCase):
+
+    def runs(self, s):
+        path = os.path.join(s.sub_root, 'runs')
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return len(f.readlines())
+
+    def test_read_policy(self):
+        with TempSub(self, name='exa') as s:
+            s.create_subcommand('query', 'sh', QUERY)
+            s.create_subcommand('plain', 'sh', 'echo')
+            s.create_subcommand('bad', 'sh', '# Cache-TTL: soon')
+            commands = os.path.join(s.sub_root, 'commands')
+            self.assertEqual(memo.read_policy(os.path.join(commands, 'query')),
+                             (300.0, ['REGION']))
+            self.assertIsNone(memo.read_policy(os.path.join(commands, 'plain')))
+            self.assertIsNone(memo.read_policy(os.path.join(commands, 'bad')))
+            self.assertTrue(cmdindex.declares_memo(os.path.join(commands, 'bad')))
+            self.assertFalse(cmdindex.declares_memo(os.path.join(commands, 'plain')))
+
+    def test_indexed_policy(self):
+        with TempSub(self, name='exa') as s:
+            s.create_subcommand('grp/query', 'sh', QUERY)
+            s.create_subcommand('grp/plain', 'sh', 'echo')
+            commands = os.path.join(s.sub_root, 'commands')
+            age_tree(commands)
+
+            # Scanning a container does not read its commands
+            index = cmdindex.CommandIndex(commands)
+            probes = cmdindex.Probes.count
+            list(index.walk())
+            self.assertEqual(cmdindex.Probes.count - probes, 4)
+
+            # Each command is read when asked about
+            for name, expected in (('query', True), ('plain', False)):
+                probes = cmdindex.Probes.count
+                self.assertEqual(index.declares_memo('grp/' + name), expected)
+                self.assertEqual(cmdindex.Probes.count - probes, 1)
+
+    def test_driver(self):
+        with TempSub(self, name='exa', thin=False) as s:
+            s.create_subcommand('query', 'sh', QUERY)
+
+            for _ in range(2):
+                cap = s.run('query', 'x')
+                self.assertEqual(cap.return_code, 2)
+                cap.stdout.matches('answer x \n', anchored=True)
+            self.assertEqual(self.runs(s), 1)
+
+            s.run('--no-cache', 'query', 'x').stdout.matches('answer x \n')
+            self.assertEqual(self.runs(s), 2)
+
+            s.run('query', 'y').stdout.matches('answer y \n')
+            self.assertEqual(self.runs(s), 3)
+
+            os.environ['REGION'] = 'eu'
+            try:
+                s.run('query', 'x').stdout.matches('answer x eu\n')
+                s.run('query', 'x').stdout.matches('answer x eu\n')
+            finally:
+                del os.environ['REGION']
+            self.assertEqual(self.runs(s), 4)
+
+            # Editing the command makes its cached output stale
+            path = os.path.join(s.sub_root, 'commands', 'query')
+            with open(path, 'a') as f:
+                f.write('# edited\n')
+            s.run('query', 'x')
+            self.assertEqual(self.runs(s), 5)
+
+    def test_interrupt(self):
+        with TempSub(self, name='exa') as s:
+            s.create_subcommand('query', 'sh',
+                                '# Cache-TTL: 300\nkill -INT $PPID\necho done')
+            path = os.path.join(s.sub_root, 'commands', 'query')
+            command = _main.Command(['query'], path, False, False, [])
+            # Interrupting the driver while the command runs does not stop it
+            self.assertEqual(memo.run(command, dict(os.environ)), 0)
+            self.assertIs(signal.getsignal(signal.SIGINT),
+                          signal.default_int_handler)
+
+    def test_ttl_and_eviction(self):
+        with TempSub(self, name='exa') as s:
+            s.create_subcommand('query', 'sh', QUERY)
+            path = os.path.join(s.sub_root, 'commands', 'query')
+            env = dict(os.environ, _SUB_PATH_ROOT_=s.sub_root)
+
+            def run(arg, now):
+                command = _main.Command(['query'], path, False, False, [arg])
+                return memo.run(command, env, now=now)
+
+            self.assertEqual(run('a', 1000.0), 2)
+            self.assertEqual(run('a', 1299.0), 2)
+            self.assertEqual(self.runs(s), 1)
+            self.assertEqual(run('a', 1300.0), 2)
+            self.assertEqual(self.runs(s), 2)
+
+            directory = memo.memo_dir()
+            entry_size = os.path.getsize(
+                    os.path.join(directory, os.listdir(directory)[0]))
+            os.environ[memo.SIZE_VAR] = str(entry_size * 2)
+            try:
+                run('b', 1000.0)
+                run('c', 1000.0)
+            finally:
+                del os.environ[memo.SIZE_VAR]
+            self.assertEqual(len(os.listdir(directory)), 2)
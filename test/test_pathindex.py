@@ -0,0 +1,97 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+
+from .utils import SubdueTestCase, TempSub, TemporaryDirectory, age_tree
+from . import utils
+import subdue.sub
+from subdue.sub import index as cmdindex
+from subdue.sub import pathindex
+
+
+def create_executable(directory, name, contents='#!/bin/sh\n'):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, 0o700)
+    return path
+
+
+class TestPathIndex(SubdueTestCase):
+
+    def test_find(self):
+        with TemporaryDirectory() as tmp:
+            first = os.path.join(tmp, 'first')
+            second = os.path.join(tmp, 'second')
+            os.mkdir(first)
+            os.mkdir(second)
+            create_executable(second, 'exa-foo')
+            create_executable(second, 'exa-bar')
+            create_executable(first, 'exa-bar')
+            create_executable(first, 'other-foo')
+            os.chmod(create_executable(first, 'exa-plain'), 0o600)
+            for directory in (first, second):
+                age_tree(directory)
+            path = os.pathsep.join([first, os.path.join(tmp, 'none'), second])
+
+            index = pathindex.PathIndex.load('exa-')
+            self.assertEqual(index.find('foo', path), os.path.join(second, 'exa-foo'))
+            self.assertEqual(index.find('bar', path), os.path.join(first, 'exa-bar'))
+            self.assertIsNone(index.find('plain', path))
+            self.assertIsNone(index.find('nope', path))
+            self.assertEqual(index.dirs[first][1], ['exa-bar'])
+            os.mkdir(os.path.join(second, 'exa-dir'))
+            create_executable(second, 'other-bar')
+            age_tree(second)
+
+            # Only the entries with the prefix are checked when listing
+            index.dirs.pop(second)
+            probes = cmdindex.Probes.count
+            self.assertEqual(index.names(second), ['exa-bar', 'exa-foo'])
+            self.assertEqual(cmdindex.Probes.count - probes, 5)
+            index.save()
+
+            # A warm index only checks the modification time of each directory
+            index = pathindex.PathIndex.load('exa-')
+            probes = cmdindex.Probes.count
+            self.assertEqual(index.find('foo', path), os.path.join(second, 'exa-foo'))
+            self.assertEqual(cmdindex.Probes.count - probes, 3)
+
+            # New executables are found once their directory changes
+            create_executable(first, 'exa-foo')
+            age_tree(first, 30)
+            self.assertEqual(index.find('foo', path), os.path.join(first, 'exa-foo'))
+
+    def test_driver(self):
+        with TempSub(self, name='exa') as s:
+            s.create_subcommand('foo', 'sh', 'echo in tree')
+            bin_dir = os.path.join(s.sub_root, 'bin')
+            create_executable(bin_dir, 'exa-foo', '#!/bin/sh\necho external foo\n')
+            create_executable(bin_dir, 'exa-bar', '#!/bin/sh\necho "external $@"\n')
+            create_executable(bin_dir, 'exa-commands', '#!/bin/sh\necho external\n')
+
+            driver = os.path.join(bin_dir, 'exa')
+
+            def run(*args, **kwargs):
+                caller = utils.SubprocessCaller()
+                with utils.OutStreamCapture() as cap:
+                    subdue.sub.main(list(args), sub_path=s.sub_root,
+                                    driver_path=driver, exit=False,
+                                    command_runner=caller, **kwargs)
+                return caller.returncode, cap.stdout
+
+            self.assertEqual(run('foo', lookupinpath=True),
+                             (0, 'in tree\n'))
+            self.assertEqual(run('bar', 'baz', lookupinpath=True),
+                             (0, 'external baz\n'))
+            self.assertEqual(run('foo', 'bar', lookupinpath=True),
+                             (0, 'in tree\n'))
+            rc, out = run('commands', lookupinpath=True)
+            self.assertIsNone(rc)
+            self.assertIn('foo', out)
+            with utils.OutStreamCapture():
+                result = subdue.sub.main(['bar'], sub_path=s.sub_root,
+                                         driver_path=driver, exit=False)
+            self.assertIsInstance(result, SystemExit)
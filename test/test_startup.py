@@ -0,0 +1,96 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import re
+import sys
+import subprocess
+import unittest
+
+from .utils import SubdueTestCase, TempSub
+from . import utils
+
+# Modules that running a plain user command must not load
+FORBIDDEN_MODULES = [
+    'argparse',
+    'inspect',
+    'pkgutil',
+    'string',
+    'json',
+    'socket',
+    'subdue.builtincmd.help',
+    'subdue.builtincmd.commands',
+    'subdue.builtincmd.init',
+    'subdue.builtincmd.daemon',
+    'subdue.builtincmd.completions',
+    'subdue.builtincmd.zygote',
+    'subdue.builtincmd.runmany',
+    'subdue.builtincmd.catalog',
+    'subdue.sub.zygote',
+    'subdue.sub.memo',
+    'subdue.sub.pathindex',
+    'subdue.sub.suggest',
+    'subdue.sub.archive',
+    'zipfile',
+    'mmap',
+    'subdue.sub.watch',
+    'subdue.sub.catalog',
+    'ctypes',
+    ]
+
+# Upper bound for the cumulative import time of the subdue package, in
+# microseconds, as reported by python -X importtime. This is generous on
+# purpose, the list above is what catches most regressions.
+STARTUP_BUDGET_US = 50000
+
+IMPORTTIME_LINE = re.compile(
+        r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def parse_importtime(text):
+    """
+    Return a dictionary with the cumulative import time of each module
+    """
+    modules = {}
+    for line in text.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2))
+    return modules
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs Python 3.7")
+class TestDriverStartup(SubdueTestCase):
+
+    def run_with_importtime(self, sub_root, args):
+        env = os.environ.copy()
+        kwargs = {'env': env}
+        utils._add_subdue_to_env(kwargs)
+        driver = os.path.join(sub_root, 'bin', os.path.basename(sub_root))
+        proc = subprocess.Popen(
+                [sys.executable, '-X', 'importtime', driver] + args,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0, stderr)
+        return parse_importtime(stderr.decode('utf-8'))
+
+    def test_plain_command_imports(self):
+        with TempSub(self, name='fast') as s:
+            s.create_subcommand('dir/noop', 'sh', 'true')
+            modules = self.run_with_importtime(s.sub_root, ['dir', 'noop'])
+
+        self.assertIn('subdue.sub._main', modules)
+        for module in FORBIDDEN_MODULES:
+            self.assertNotIn(module, modules,
+                    "{0} imported when running a plain command".format(module))
+        self.assertLessEqual(modules['subdue'], STARTUP_BUDGET_US,
+                "Importing subdue took {0}us, budget is {1}us".format(
+                    modules['subdue'], STARTUP_BUDGET_US))
+
+    def test_builtins_still_load(self):
+        with TempSub(self, name='fast') as s:
+            s.create_subcommand('noop', 'sh', 'true')
+            modules = self.run_with_importtime(s.sub_root, ['commands'])
+        self.assertIn('subdue.builtincmd.commands', modules)
+        self.assertNotIn('subdue.builtincmd.init', modules)
@@ -0,0 +1,103 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from subdue.sub import _main
+from subdue.sub import cache
+from subdue.sub import index as cmdindex
+from subdue.sub import suggest
+
+
+class TestSuggest(SubdueTestCase):
+
+    COMMANDS = ['deploy', 'status', 'db/migrate', 'db/status', 'db/dump',
+                'cloud/db/migrate', 'cloud/sh-login']
+
+    def _make_sub(self, s):
+        for command in self.COMMANDS:
+            s.create_subcommand(command, 'sh', 'true')
+        age_tree(s.sub_root)
+        return cmdindex.open_index(os.path.join(s.sub_root, 'commands'))
+
+    def test_distance(self):
+        self.assertEqual(suggest.distance('status', 'status'), 0)
+        self.assertEqual(suggest.distance('stauts', 'status'), 1)
+        self.assertEqual(suggest.distance('Status', 'statu'), 1)
+        self.assertEqual(suggest.distance('', 'abc'), 3)
+        self.assertEqual(suggest.distance('kitten', 'sitting'), 3)
+
+    def test_search(self):
+        gram_index = suggest.GramIndex.build([
+            ('', {'status': cmdindex.KIND_EXEC, 'deploy': cmdindex.KIND_EXEC,
+                  'db': cmdindex.KIND_DIR}),
+            ('db', {'status': cmdindex.KIND_EXEC, 'migrate': cmdindex.KIND_EXEC}),
+            ])
+        self.assertEqual(gram_index.search('stauts'),
+                         [('status',), ('db', 'status')])
+        self.assertEqual(gram_index.search('migrat'), [('db', 'migrate')])
+        self.assertEqual(gram_index.search('xyz'), [])
+
+    def test_suggestions(self):
+        with TempSub(self, name='exa') as s:
+            index = self._make_sub(s)
+            # Commands in the container where the token failed come first
+            self.assertEqual(suggest.suggestions(['db', 'stauts'], index),
+                             [('db', 'status'), ('status',)])
+            self.assertEqual(suggest.suggestions(['stauts'], index),
+                             [('status',), ('db', 'status')])
+            self.assertEqual(suggest.suggestions(['migrte'], index),
+                             [('db', 'migrate'), ('cloud', 'db', 'migrate')])
+            self.assertEqual(suggest.suggestions(['cloud', 'logni'], index),
+                             [('cloud', 'login')])
+            self.assertEqual(suggest.suggestions(['unrelated'], index), [])
+
+    def test_cache(self):
+        with TempSub(self, name='exa') as s:
+            index = self._make_sub(s)
+            suggest.GramIndex.load(index)
+            index.save()
+            path = cache.cache_file('suggest', index.root)
+            self.assertTrue(os.path.exists(path))
+            signature = cache.read_marshal(path)['signature']
+
+            # Unchanged records reuse the cached trigram index, without
+            # walking the tree
+            index = cmdindex.open_index(index.root)
+            probes = cmdindex.Probes.count
+            suggest.GramIndex.load(index)
+            self.assertEqual(cmdindex.Probes.count, probes)
+            self.assertEqual(cache.read_marshal(path)['signature'], signature)
+
+            # A new command changes the signature once its container is
+            # scanned again, as the lookup that failed does
+            s.create_subcommand('db/restore', 'sh', 'true')
+            age_tree(s.sub_root, 30)
+            index.refresh(['', 'db'])
+            self.assertEqual(suggest.suggestions(['db', 'restroe'], index),
+                             [('db', 'restore')])
+            self.assertNotEqual(cache.read_marshal(path)['signature'], signature)
+
+    def test_disabled_cache(self):
+        with TempSub(self, name='exa') as s:
+            self._make_sub(s)
+            os.environ['SUBDUE_CACHE_DIR'] = ''
+            index = cmdindex.load_index([os.path.join(s.sub_root, 'commands')])
+            # Only the container where the lookup failed is looked at
+            self.assertEqual(suggest.suggestions(['db', 'stauts'], index),
+                             [('db', 'status')])
+            self.assertEqual(sorted(index.dirs), ['db'])
+            self.assertEqual(suggest.suggestions(['migrte'], index), [])
+
+    def test_driver(self):
+        with TempSub(self, name='exa', thin=False) as s:
+            self._make_sub(s)
+            result = s.run('db', 'stauts').assertFailure()
+            self.assertEqual(result.return_code, 1)
+            result.stderr.contains("exa: no such command `db stauts'")
+            result.stderr.contains('The most similar commands are:')
+            result.stderr.contains('    exa db status\n    exa status')
+            s.run('zzz').assertFailure().stderr.matches(
+                    "exa: no such command `zzz'\n", anchored=True)
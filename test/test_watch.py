@@ -0,0 +1,135 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import errno
+import shutil
+import time
+import unittest
+
+from .utils import SubdueTestCase, TempSub, age_tree
+from subdue.sub import _main
+from subdue.sub import index as cmdindex
+from subdue.sub import watch
+
+
+class TestWatcher(SubdueTestCase):
+
+    COMMANDS = [
+        'cmd1',
+        'dir1/cmd1.1',
+        'dir1/dir1.1/cmd1.1.1',
+        'dir2/cmd2.1',
+        ]
+
+    def _make_index(self, s):
+        for command in self.COMMANDS:
+            s.create_subcommand(command, 'sh', '')
+        commands = os.path.join(s.sub_root, 'commands')
+        age_tree(commands)
+        index = cmdindex.CommandIndex(commands)
+        list(index.walk())
+        return index, commands
+
+    def resolve(self, index, argv):
+        """ Resolve from the index alone, return (command, probes) """
+        probes = cmdindex.Probes.count
+        command = _main.find_command_in_index(argv, index)
+        return command, cmdindex.Probes.count - probes
+
+    @unittest.skipUnless(watch.is_available(), "needs inotify")
+    def test_inotify(self):
+        with TempSub(self, name='wat') as s:
+            index, commands = self._make_index(s)
+            watcher = watch.Watcher(index)
+            self.assertFalse(watcher.polling)
+            self.assertEqual(index.watched, set(index.dirs))
+
+            # Watched containers are trusted without probes
+            command, probes = self.resolve(index, ['dir1', 'dir1.1', 'cmd1.1.1'])
+            self.assertTrue(command.found)
+            self.assertEqual(probes, 0)
+
+            # A new command drops the record of its container only
+            s.create_subcommand('dir1/new', 'sh', '')
+            self.assertEqual(watcher.poll(), set())
+            self.assertEqual(sorted(index.dirs), ['', 'dir1/dir1.1', 'dir2'])
+            self.assertIsNone(self.resolve(index, ['dir1', 'new'])[0])
+            index.refresh()
+            watcher.poll()
+            command, probes = self.resolve(index, ['dir1', 'new'])
+            self.assertTrue(command.found)
+            self.assertEqual(probes, 0)
+
+            # So does a change of the executable bit, which keeps the mtime
+            os.chmod(os.path.join(commands, 'dir2', 'cmd2.1'), 0o600)
+            watcher.poll()
+            self.assertNotIn('dir2', index.dirs)
+
+            # Containers scanned again while watched are trusted right away
+            list(index.walk())
+            watcher.poll()
+            self.assertEqual(index.watched, set(index.dirs))
+
+            # Removing a container drops its whole subtree, and its parent
+            shutil.rmtree(os.path.join(commands, 'dir1'))
+            watcher.poll()
+            self.assertEqual(sorted(index.dirs), ['dir2'])
+            self.assertEqual(sorted(index.watched), ['dir2'])
+            watcher.close()
+            self.assertIsNone(index.watched)
+
+    @unittest.skipUnless(watch.is_available(), "needs inotify")
+    def test_moved_container(self):
+        with TempSub(self, name='wat') as s:
+            index, commands = self._make_index(s)
+            watcher = watch.Watcher(index)
+            os.rename(os.path.join(commands, 'dir1'),
+                      os.path.join(commands, 'moved'))
+            watcher.poll()
+            self.assertEqual(sorted(index.dirs), ['dir2'])
+
+            # The moved containers are scanned and watched again where they
+            # are now
+            s.create_subcommand('moved/dir1.1/other', 'sh', '')
+            list(index.walk())
+            watcher.poll()
+            self.assertIn('moved', index.watched)
+            self.assertIsNone(self.resolve(index, ['dir1'])[0])
+            self.assertIn('other', index.entries('moved/dir1.1'))
+
+    def test_polling(self):
+        with TempSub(self, name='wat') as s:
+            index, commands = self._make_index(s)
+            lib = os.path.join(s.sub_root, 'lib')
+            watcher = watch.Watcher(index, [lib], use_inotify=False, interval=0)
+            self.assertTrue(watcher.polling)
+            self.assertEqual(self.resolve(index, ['dir1', 'cmd1.1'])[1], 0)
+
+            s.create_subcommand('dir2/new', 'sh', '')
+            with open(os.path.join(lib, 'helper.py'), 'w') as f:
+                f.write('')
+            self.assertEqual(watcher.poll(), set([lib]))
+            self.assertEqual(sorted(index.dirs), ['', 'dir1', 'dir1/dir1.1'])
+            self.assertEqual(watcher.poll(), set())
+
+    @unittest.skipUnless(watch.is_available(), "needs inotify")
+    def test_watch_limit(self):
+        def exhausted(path, mask):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        with TempSub(self, name='wat') as s:
+            index, commands = self._make_index(s)
+            original = watch.Inotify.add
+            watch.Inotify.add = lambda self, path, mask: exhausted(path, mask)
+            try:
+                watcher = watch.Watcher(index, interval=0)
+            finally:
+                watch.Inotify.add = original
+            self.assertTrue(watcher.polling)
+            self.assertEqual(index.watched, set(index.dirs))
+
+            time.sleep(0.01)
+            os.utime(os.path.join(commands, 'dir1'), None)
+            watcher.poll()
+            self.assertEqual(sorted(index.dirs), ['', 'dir1/dir1.1', 'dir2'])
@@ -0,0 +1,236 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import signal
+import subprocess
+import tempfile
+import shutil
+import time
+import unittest
+
+from .utils import SubdueTestCase, TempSub
+from . import utils
+from subdue.sub import zygote
+
+
+@unittest.skipUnless(zygote.is_supported(), "needs socket.sendmsg")
+class TestZygote(SubdueTestCase):
+
+    def setUp(self):
+        super(TestZygote, self).setUp()
+        self._prev_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        self.runtime_dir = tempfile.mkdtemp()
+        os.environ['XDG_RUNTIME_DIR'] = self.runtime_dir
+
+    def tearDown(self):
+        if self._prev_runtime_dir is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = self._prev_runtime_dir
+        shutil.rmtree(self.runtime_dir)
+        super(TestZygote, self).tearDown()
+
+    def start_zygote(self, sub_root):
+        kwargs = {}
+        utils._add_subdue_to_env(kwargs)
+        driver = os.path.join(sub_root, 'bin', os.path.basename(sub_root))
+        server = subprocess.Popen(
+                [driver, 'zygote', 'start', '--foreground', '--idle-timeout', '30'],
+                **kwargs)
+        for _ in range(200):
+            if zygote.request(sub_root, {'op': 'ping'}) is not None:
+                return server
+            time.sleep(0.05)
+        server.kill()
+        self.fail("The zygote did not start")
+
+    def stop_zygote(self, sub_root, server):
+        zygote.request(sub_root, {'op': 'stop'})
+        self.assertEqual(server.wait(), 0)
+        self.assertFalse(os.path.exists(zygote.socket_path_for(sub_root)))
+
+    def run_driver(self, sub_root, *args, **kwargs):
+        kwargs.update({'stdin': subprocess.PIPE, 'stdout': subprocess.PIPE,
+                       'stderr': subprocess.PIPE})
+        utils._add_subdue_to_env(kwargs)
+        driver = os.path.join(sub_root, 'bin', os.path.basename(sub_root))
+        proc = subprocess.Popen([driver] + list(args), **kwargs)
+        out, err = proc.communicate()
+        return proc.returncode, out.decode('utf-8'), err.decode('utf-8')
+
+    def test_is_python_script(self):
+        with TempSub(self, name='zyg') as s:
+            for name, shebang, expected in [
+                    ('env', '#!/usr/bin/env python', True),
+                    ('major', '#!/usr/bin/python{0}'.format(
+                        os.sys.version_info[0]), True),
+                    ('other', '#!/usr/bin/python1', False),
+                    ('shell', '#!/bin/sh', False),
+                    ]:
+                utils.create_subcommand(s.sub_root, name, shebang + '\n')
+                path = os.path.join(s.sub_root, 'commands', name)
+                self.assertEqual(zygote.is_python_script(path), expected, name)
+
+    def test_run(self):
+        with TempSub(self, name='zyg', thin=False) as s:
+            utils.create_subcommand(s.sub_root, 'py/show', """\
+                #!/usr/bin/env python3
+                import os, sys
+                print(sys.argv[1:], os.environ['_SUB_COMMAND_'], os.getppid())
+                sys.exit(int(sys.argv[1]))
+                """)
+            utils.create_subcommand(s.sub_root, 'die', """\
+                #!/usr/bin/env python3
+                import os, signal
+                os.kill(os.getpid(), signal.SIGTERM)
+                """)
+            utils.create_subcommand(s.sub_root, 'boom', """\
+                #!/usr/bin/env python3
+                raise ValueError('boom')
+                """)
+            utils.create_subcommand(s.sub_root, 'finish', """\
+                #!/usr/bin/env python3
+                import atexit, sys, threading, time
+                def late():
+                    time.sleep(0.2)
+                    print('thread')
+                atexit.register(print, 'atexit')
+                threading.Thread(target=late).start()
+                sys.stdout.write('main\\n')
+                """)
+            with open(os.path.join(s.sub_root, 'lib', 'preloadme.py'), 'w') as f:
+                f.write('VALUE = 1\n')
+
+            server = self.start_zygote(s.sub_root)
+            try:
+                status = zygote.request(s.sub_root, {'op': 'ping'})
+                self.assertEqual(status['preloaded'], ['preloadme'])
+
+                rc, out, err = self.run_driver(s.sub_root, 'py', 'show', '3')
+                self.assertEqual(rc, 3, err)
+                self.assertEqual(out, "['3'] py show {0}\n".format(server.pid))
+
+                rc, out, err = self.run_driver(s.sub_root, 'die')
+                self.assertEqual(rc, -signal.SIGTERM)
+
+                # The child exits as the interpreter would
+                rc, out, err = self.run_driver(s.sub_root, 'finish')
+                self.assertEqual((rc, out), (0, 'main\nthread\natexit\n'), err)
+
+                rc, out, err = self.run_driver(s.sub_root, 'boom')
+                self.assertEqual(rc, 1)
+                self.assertIn('ValueError: boom', err)
+                self.assertNotIn('runpy', err)
+            finally:
+                self.stop_zygote(s.sub_root, server)
+
+            # Without the zygote, the script is run as usual
+            rc, out, err = self.run_driver(s.sub_root, 'py', 'show', '0')
+            self.assertEqual(rc, 0, err)
+            self.assertNotEqual(out, "['0'] py show {0}\n".format(server.pid))
+
+    def test_signal_forwarding(self):
+        with TempSub(self, name='zyg', thin=False) as s:
+            utils.create_subcommand(s.sub_root, 'wait', """\
+                #!/usr/bin/env python3
+                import signal, sys, time
+                def handler(signum, frame):
+                    print('got', signum)
+                    sys.exit(7)
+                signal.signal(signal.SIGUSR1, handler)
+                print('ready', flush=True)
+                time.sleep(10)
+                """)
+            server = self.start_zygote(s.sub_root)
+            try:
+                kwargs = {'stdin': subprocess.PIPE, 'stdout': subprocess.PIPE}
+                utils._add_subdue_to_env(kwargs)
+                driver = os.path.join(s.sub_root, 'bin', 'zyg')
+                proc = subprocess.Popen([driver, 'wait'], **kwargs)
+                self.assertEqual(proc.stdout.readline(), b'ready\n')
+                proc.send_signal(signal.SIGUSR1)
+                out, _ = proc.communicate()
+                self.assertEqual(proc.returncode, 7)
+                self.assertEqual(out, 'got {0}\n'.format(
+                    int(signal.SIGUSR1)).encode('ascii'))
+            finally:
+                self.stop_zygote(s.sub_root, server)
+
+    def test_job_control(self):
+        with TempSub(self, name='zyg', thin=False) as s:
+            utils.create_subcommand(s.sub_root, 'wait', """\
+                #!/usr/bin/env python3
+                import os, signal, sys, time
+                continued = []
+                signal.signal(signal.SIGCONT,
+                              lambda signum, frame: continued.append(signum))
+                signal.signal(signal.SIGUSR1, lambda signum, frame: sys.exit(7))
+                print('ready', oct(os.umask(0)), flush=True)
+                while not continued:
+                    time.sleep(0.01)
+                print('continued', flush=True)
+                time.sleep(10)
+                """)
+            server = self.start_zygote(s.sub_root)
+            try:
+                kwargs = {'stdin': subprocess.PIPE, 'stdout': subprocess.PIPE,
+                          'preexec_fn': lambda: os.umask(0o027)}
+                utils._add_subdue_to_env(kwargs)
+                driver = os.path.join(s.sub_root, 'bin', 'zyg')
+                proc = subprocess.Popen([driver, 'wait'], **kwargs)
+                self.assertEqual(proc.stdout.readline(), b'ready 0o27\n')
+
+                # The driver stops along with the command, and both go on
+                proc.send_signal(signal.SIGTSTP)
+                _, status = os.waitpid(proc.pid, os.WUNTRACED)
+                self.assertTrue(os.WIFSTOPPED(status))
+                proc.send_signal(signal.SIGCONT)
+                self.assertEqual(proc.stdout.readline(), b'continued\n')
+                proc.send_signal(signal.SIGUSR1)
+                proc.communicate()
+                self.assertEqual(proc.returncode, 7)
+            finally:
+                self.stop_zygote(s.sub_root, server)
+
+    def test_terminal_bypass(self):
+        with TempSub(self, name='zyg') as s:
+            utils.create_subcommand(s.sub_root, 'ask', '#!/usr/bin/env python3\n')
+            path = os.path.join(s.sub_root, 'commands', 'ask')
+            calls = []
+            runner = zygote.ZygoteRunner(s.sub_root, calls.append)
+            runner.connect = lambda args, env: self.fail("used the zygote")
+            isatty = os.isatty
+            os.isatty = lambda fd: fd == 0
+            try:
+                runner([path])
+            finally:
+                os.isatty = isatty
+            self.assertEqual(calls, [[path]])
+
+    def test_stale_preloads(self):
+        with TempSub(self, name='zyg', thin=False) as s:
+            utils.create_subcommand(s.sub_root, 'ppid', """\
+                #!/usr/bin/env python3
+                import os
+                print(os.getppid())
+                """)
+            preload = os.path.join(s.sub_root, 'lib', 'preloadme.py')
+            with open(preload, 'w') as f:
+                f.write('VALUE = 1\n')
+            server = self.start_zygote(s.sub_root)
+            try:
+                rc, out, err = self.run_driver(s.sub_root, 'ppid')
+                self.assertEqual(out, '{0}\n'.format(server.pid), err)
+
+                # Once the modules change, commands run as usual and the
+                # zygote goes away
+                with open(preload, 'w') as f:
+                    f.write('VALUE = 2\n')
+                rc, out, err = self.run_driver(s.sub_root, 'ppid')
+                self.assertEqual(rc, 0, err)
+                self.assertNotEqual(out, '{0}\n'.format(server.pid))
+                self.assertEqual(server.wait(), 0)
+            finally:
+                self.stop_zygote(s.sub_root, server)
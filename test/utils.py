@@ -9,6 +9,7 @@ import tempfile
 import shutil
 import subprocess
 import textwrap
+import time
 import io
 
 import subdue
@@ -225,6 +226,20 @@ class TempSub(TemporaryDirectory):
 
 class SubdueTestCase(unittest.TestCase):
 
+    def setUp(self):
+        # Keep the caches of every test isolated from the user's and from
+        # other tests. Subprocesses inherit this through the environment.
+        self._prev_cache_dir = os.environ.get('SUBDUE_CACHE_DIR')
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['SUBDUE_CACHE_DIR'] = self.cache_dir
+
+    def tearDown(self):
+        if self._prev_cache_dir is None:
+            del os.environ['SUBDUE_CACHE_DIR']
+        else:
+            os.environ['SUBDUE_CACHE_DIR'] = self._prev_cache_dir
+        shutil.rmtree(self.cache_dir)
+
     def assertOsPathIsDir(self, path, msg=None):
         if not os.path.isdir(path):
             msg = self._formatMessage(msg,
@@ -313,6 +328,21 @@ def create_subcommand(sub_root, name, contents, interpreter=None):
     os.chmod(sub_command_file, 448) # 0700, for python 2.7 vs 3.X compat
 
 
+def age_tree(path, seconds=60):
+    """
+    Move the modification time of a file, or of a directory and everything
+    under it, to the past, beyond subdue.sub.index.RACY_WINDOW, so that the
+    caches of subdue trust them. Dangling symlinks are left alone.
+    """
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+    for directory, dirs, files in os.walk(path):
+        for name in dirs + files:
+            entry = os.path.join(directory, name)
+            if os.path.exists(entry):
+                os.utime(entry, (past, past))
+
+
 def call_driver_for(sub_root, args=None, **kwargs):
     if args is None:
         args = []
@@ -320,16 +350,25 @@ def call_driver_for(sub_root, args=None, **kwargs):
     sub_driver = os.path.join(sub_root, 'bin', sub_name)
     return call_driver(sub_driver, args, **kwargs)
 
-def call_driver(sub_driver, args=None, **kwargs):
+def _add_subdue_to_env(kwargs):
     # Get the environment and add the subdue path to the PYTHONPATH
     env = kwargs.get('env', os.environ).copy()
     subdue_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     env['PYTHONPATH'] = ':'.join([env.get('PYTHONPATH', ''), subdue_path])
     kwargs['env'] = env
 
+def call_driver(sub_driver, args=None, **kwargs):
+    _add_subdue_to_env(kwargs)
     return_code = subprocess_call([sub_driver] + args, **kwargs)
     return return_code
 
+def call_bash(script, **kwargs):
+    """
+    Run a bash script in an environment where subdue can be imported
+    """
+    _add_subdue_to_env(kwargs)
+    return subprocess_call(['bash', '-c', script], **kwargs)
+
 def call_thin(sub_root, args=None, **kwargs):
     if args is None:
         args = []